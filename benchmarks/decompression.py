@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+""" Measure how many megabytes per second each installed decompression
+    backend reads from the same synthetic inetnum dump, compressed with
+    gzip, bzip2 and, if the zstd command is installed, zstd.
+
+    Usage: python -m benchmarks.decompression [objects] """
+import bz2
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from block_finder.blockfinder import decompression_backends
+from benchmarks.lir_parser import write_inetnum_file
+
+
+def write_compressed_files(temp_dir, object_count):
+    """ Write the dump compressed in every format and return the size of
+        the uncompressed data and the paths of the compressed files. """
+    gz_path = os.path.join(temp_dir, 'ripe.db.inetnum.gz')
+    write_inetnum_file(gz_path, object_count)
+    with gzip.open(gz_path) as gz_file:
+        data = gz_file.read()
+    paths = [gz_path, os.path.join(temp_dir, 'ripe.db.inetnum.bz2')]
+    with bz2.BZ2File(paths[1], 'wb') as bz2_file:
+        bz2_file.write(data)
+    zstd = [backend for backend in decompression_backends
+            if backend.name == 'zstd'][0]
+    if zstd.available():
+        paths.append(os.path.join(temp_dir, 'ripe.db.inetnum.zst'))
+        with open(paths[2], 'wb') as zst_file:
+            subprocess.Popen(['zstd', '-cq'], stdin=subprocess.PIPE,
+                             stdout=zst_file).communicate(data)
+    return len(data), paths
+
+
+def measure(backend, path, size):
+    start_time = time.time()
+    compressed_file = backend.open(path)
+    while compressed_file.read(2 ** 20):
+        pass
+    compressed_file.close()
+    seconds = time.time() - start_time
+    print('%-8s %-4s %7.2f s %8.1f MB/s' %
+          (backend.name, backend.suffix, seconds, size / seconds / 2 ** 20))
+
+
+def main():
+    object_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        size, paths = write_compressed_files(temp_dir, object_count)
+        for backend in decompression_backends:
+            if not backend.available():
+                print('%-8s %-4s not installed' %
+                      (backend.name, backend.suffix))
+                continue
+            for path in paths:
+                if path.endswith(backend.suffix):
+                    measure(backend, path, size)
+    finally:
+        shutil.rmtree(temp_dir, True)
+
+
+if __name__ == '__main__':
+    main()
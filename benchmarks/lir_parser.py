@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+""" Measure how many RPSL objects per second the LIR file parser handles,
+    compared to the line-by-line parser of earlier versions, on a
+    synthetic gzipped inetnum dump.
+
+    Usage: python -m benchmarks.lir_parser [objects [jobs]] """
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from block_finder.blockfinder import DownloaderParser, ipaddr
+
+
+def write_inetnum_file(path, object_count):
+    """ Write a gzipped inetnum dump with the given number of objects that
+        look like those in the RIPE database. """
+    rng = random.Random(0)
+    lir_file = gzip.open(path, 'wb')
+    for i in range(object_count):
+        start_num = rng.getrandbits(24) << 8
+        lir_file.write((
+            'inetnum:        %s - %s\n'
+            'netname:        NET-%d\n'
+            'descr:          Example network\n'
+            'country:        %s\n'
+            'admin-c:        DUMY-RIPE\n'
+            'tech-c:         DUMY-RIPE\n'
+            'status:         ASSIGNED PA\n'
+            'mnt-by:         EXAMPLE-MNT\n'
+            'created:        2010-01-01T00:00:00Z\n'
+            'last-modified:  2010-01-01T00:00:00Z\n'
+            'source:         RIPE\n'
+            'remarks:        * THIS OBJECT IS MODIFIED\n'
+            'remarks:        * Please note that all data that is generally '
+            'regarded as personal\n\n' % (
+                ipaddr.IPv4Address(start_num),
+                ipaddr.IPv4Address(start_num + 255), i,
+                rng.choice(['DE', 'NL', 'RU', 'GB']))).encode('ascii'))
+    lir_file.close()
+
+
+def parse_line_by_line(path):
+    """ Parse an LIR file like blockfinder 4.0.1 did. """
+    lir_file = gzip.open(path)
+    entry = False
+    for line in lir_file:
+        line = line.decode('utf-8', 'ignore').replace("\n", "")
+        if line == "":
+            entry = False
+        elif not entry and "inetnum:" in line:
+            try:
+                line = line.replace("inetnum:", "").strip()
+                start_num = int(ipaddr.IPv4Address(
+                    line.split("-")[0].strip()))
+                end_num = int(ipaddr.IPv4Address(line.split("-")[1].strip()))
+                entry = True
+                num_type = 'ipv4'
+            except Exception:
+                pass
+        elif not entry and "inet6num:" in line:
+            try:
+                network_ipaddr = ipaddr.IPv6Network(
+                    line.replace("inet6num:", "").strip())
+                start_num = int(network_ipaddr.network_address)
+                end_num = int(network_ipaddr.broadcast_address)
+                entry = True
+                num_type = 'ipv6'
+            except Exception:
+                pass
+        elif entry and "country:" in line:
+            yield (start_num, end_num, num_type,
+                   line.replace("country:", "").strip(), 'ripencc')
+    lir_file.close()
+
+
+def parse_in_chunks(path, jobs):
+    downloader_parser = DownloaderParser(os.path.dirname(path), None, None,
+                                         jobs=jobs)
+    return downloader_parser._iter_lir_rows([os.path.basename(path)])
+
+
+def measure(name, rows, object_count):
+    start_time = time.time()
+    row_count = 0
+    for _ in rows:
+        row_count += 1
+    seconds = time.time() - start_time
+    print('%-8s %8d rows %7.2f s %10d objects/s' %
+          (name, row_count, seconds, object_count / seconds))
+
+
+def main():
+    object_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, 'ripe.db.inetnum.gz')
+        write_inetnum_file(path, object_count)
+        measure('before', parse_line_by_line(path), object_count)
+        measure('after', parse_in_chunks(path, 1), object_count)
+        measure('%d jobs' % jobs, parse_in_chunks(path, jobs), object_count)
+    finally:
+        shutil.rmtree(temp_dir, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+""" Measure how many country code lookups per second a single core answers
+    with SQL queries, with the in-memory lookup engine, and with the
+    compiled database, on a database cache built from a synthetic
+    delegated file, and report how large the lookup tables are.
+
+    Usage: python -m benchmarks.lookups [lines [lookups]] """
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from block_finder.blockfinder import (CompiledDatabase, DatabaseCache,
+                                      DownloaderParser, MemoryLookupEngine)
+from benchmarks.rir_parser import write_delegated_file
+
+
+def measure(name, fetch_country_code, lookup_nums):
+    start_time = time.time()
+    for lookup_num in lookup_nums:
+        fetch_country_code('ipv4', 'rir', lookup_num)
+    seconds = time.time() - start_time
+    print('%-9s %8d lookups %7.2f s %10d lookups/s' %
+          (name, len(lookup_nums), seconds, len(lookup_nums) / seconds))
+
+
+def main():
+    line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lookup_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        cache_dir = temp_dir + '/'
+        write_delegated_file(os.path.join(temp_dir, 'delegated-synthetic'),
+                             line_count)
+        database_cache = DatabaseCache(cache_dir)
+        database_cache.connect_to_database()
+        database_cache.set_db_version()
+        DownloaderParser(cache_dir, database_cache, None).parse_rir_files(
+            ['delegated-synthetic'])
+        rng = random.Random(0)
+        lookup_nums = [rng.getrandbits(32) for _ in range(lookup_count)]
+
+        engine = MemoryLookupEngine(database_cache)
+        start_time = time.time()
+        table = engine.load('ipv4', 'rir')
+        print('memory table: %d ranges, %d bytes, loaded in %.2f s' %
+              (len(table), engine.memory_footprint(),
+               time.time() - start_time))
+        compiled_path = os.path.join(temp_dir, CompiledDatabase.file_name)
+        CompiledDatabase.compile(database_cache, compiled_path)
+        compiled_database = CompiledDatabase(compiled_path)
+        print('compiled database: %d bytes' %
+              os.path.getsize(compiled_path))
+
+        measure('sql', database_cache.fetch_country_code, lookup_nums)
+        measure('memory', engine.fetch_country_code, lookup_nums)
+        measure('compiled', compiled_database.fetch_country_code,
+                lookup_nums)
+        compiled_database.close()
+        database_cache.commit_and_close_database()
+    finally:
+        shutil.rmtree(temp_dir, True)
+
+
+if __name__ == '__main__':
+    main()
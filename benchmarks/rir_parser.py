@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+""" Measure how many lines per second the RIR delegated file parser
+    handles, compared to the dict-based parser of earlier versions, on a
+    synthetic delegated file.
+
+    Usage: python -m benchmarks.rir_parser [lines [jobs]] """
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from block_finder.blockfinder import (DownloaderParser, ipaddr,
+                                      parse_rir_lines)
+
+
+def write_delegated_file(path, line_count):
+    """ Write a delegated file with the given number of lines, mixing ASN,
+        IPv4, and IPv6 records like the real files do. """
+    rng = random.Random(0)
+    registries = ['afrinic', 'apnic', 'arin', 'lacnic', 'ripencc']
+    country_codes = ['AU', 'BR', 'CN', 'DE', 'JP', 'NL', 'US', 'ZA']
+    with open(path, 'w') as delegated_file:
+        delegated_file.write('2|ripencc|20240101|%d|19830705|20240101|'
+                             '+0100\n' % line_count)
+        for num_type in ('asn', 'ipv4', 'ipv6'):
+            delegated_file.write('ripencc|*|%s|*|%d|summary\n' %
+                                 (num_type, line_count // 3))
+        for i in range(line_count - 4):
+            registry = rng.choice(registries)
+            country_code = rng.choice(country_codes)
+            kind = rng.random()
+            if kind < 0.2:
+                record = 'asn|%d|1' % rng.randint(1, 400000)
+            elif kind < 0.8:
+                record = 'ipv4|%s|%d' % (
+                    ipaddr.IPv4Address(rng.getrandbits(24) << 8),
+                    256 << rng.randint(0, 8))
+            else:
+                record = 'ipv6|%s|%d' % (
+                    ipaddr.IPv6Address(rng.getrandbits(32) << 96), 32)
+            delegated_file.write('%s|%s|%s|20100101|allocated\n' %
+                                 (registry, country_code, record))
+
+
+def parse_with_dicts(path):
+    """ Parse a delegated file like blockfinder 4.0.1 did. """
+    keys = "registry country_code type start value date status".split()
+    rir_file = open(path, 'r')
+    for line in rir_file:
+        if line.startswith("#"):
+            continue
+        entry = dict((k, v) for k, v in zip(keys, line.strip().split("|")))
+        source_name = str(entry['registry'])
+        country_code = str(entry['country_code'])
+        if source_name.replace(".", "", 1).isdigit() or country_code == "*":
+            continue
+        num_type = entry['type']
+        if num_type == 'asn':
+            start_num = end_num = int(entry['start'])
+        elif num_type == 'ipv4':
+            start_num = int(ipaddr.IPv4Address(entry['start']))
+            end_num = start_num + int(entry['value']) - 1
+        elif num_type == 'ipv6':
+            network_ipaddr = ipaddr.IPv6Network(
+                entry['start'] + '/' + entry['value'])
+            start_num = int(network_ipaddr.network_address)
+            end_num = int(network_ipaddr.broadcast_address)
+        yield (start_num, end_num, num_type, country_code, source_name)
+    rir_file.close()
+
+
+def parse_with_bytes(path):
+    with open(path, 'rb') as rir_file:
+        for row in parse_rir_lines(rir_file):
+            yield row
+
+
+def parse_in_parallel(path, jobs):
+    downloader_parser = DownloaderParser(os.path.dirname(path), None, None,
+                                         jobs=jobs)
+    return downloader_parser._iter_rir_rows_in_parallel(
+        [os.path.basename(path)])
+
+
+def measure(name, parse, path, line_count):
+    start_time = time.time()
+    row_count = 0
+    for _ in parse(path):
+        row_count += 1
+    seconds = time.time() - start_time
+    print('%-8s %8d rows %7.2f s %10d lines/s' %
+          (name, row_count, seconds, line_count / seconds))
+
+
+def main():
+    line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, 'delegated-synthetic')
+        write_delegated_file(path, line_count)
+        measure('before', parse_with_dicts, path, line_count)
+        measure('after', parse_with_bytes, path, line_count)
+        measure('%d jobs' % jobs, lambda path: parse_in_parallel(path, jobs),
+                path, line_count)
+    finally:
+        shutil.rmtree(temp_dir, True)
+
+
+if __name__ == '__main__':
+    main()
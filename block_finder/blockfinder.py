@@ -5,32 +5,67 @@
 import os
 import time
 import optparse
+import functools
+import threading
 import sys
+import shutil
 import sqlite3
 import hashlib
 import gzip
 import zipfile
 import re
 import bz2
+import binascii
+import itertools
+import json
+import multiprocessing
+import heapq
+import mmap
+import struct
+import subprocess
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
 from math import log
 
 if sys.version_info[0] >= 3:
     from configparser import ConfigParser
     import ipaddress as ipaddr
-    from urllib.request import (urlopen, Request)
-    from urllib.error import URLError
+    from urllib.request import (urlopen, Request, pathname2url)
+    from urllib.error import URLError, HTTPError
+    from urllib.parse import urlparse
+    from http.client import HTTPException
     long = int
+
+    def _int_to_bytes(num, length):
+        return num.to_bytes(length, 'big')
+
+    def _bytes_to_int(data):
+        return int.from_bytes(data, 'big')
 else:
     from configparser import SafeConfigParser as ConfigParser
-    from urllib2 import (urlopen, Request, URLError)
+    from urllib2 import (urlopen, Request, URLError, HTTPError)
+    from urllib import pathname2url
+    from urlparse import urlparse
+    from httplib import HTTPException
     try:
         from embedded_ipaddr import ipaddr
         ipaddr.ip_address = ipaddr.IPAddress
+        ipaddr.ip_network = ipaddr.IPNetwork
     except:
         import ipaddress as ipaddr
 
+    def _int_to_bytes(num, length):
+        return sqlite3.Binary(binascii.unhexlify('%0*x' % (length * 2, num)))
+
+    def _bytes_to_int(data):
+        return int(binascii.hexlify(data), 16)
+
 is_win32 = (sys.platform == "win32")
 
+# Array type code for unsigned 32 bit numbers.
+_uint32 = 'I' if array('I').itemsize == 4 else 'L'
+
 __program__ = 'blockfinder'
 __url__ = 'https://github.com/ioerror/blockfinder/'
 __author__ = 'Jacob Appelbaum <jacob@appelbaum.net>, David <db@d1b.org>'
@@ -43,47 +78,371 @@ try:
 except ImportError:
     antigravity = None
 
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    from zlib_ng import gzip_ng
+except ImportError:
+    gzip_ng = None
+
+
+class _ConnectionState(object):
+    """ The connection and cursor that DatabaseCache methods use, and the
+        span classes cached for that connection. """
+
+    conn = None
+    cursor = None
+    span_classes_version = None
+    writing = False
+
+    def __init__(self):
+        self.span_classes = {}
+
+
+class _ThreadConnectionState(threading.local, _ConnectionState):
+    """ Like _ConnectionState, but separate for every thread. """
+
+
+def _serialized(method):
+    """ Make a DatabaseCache method that writes to the database cache run
+        on the single writer connection, one thread at a time, if
+        connections are pooled. """
+    @functools.wraps(method)
+    def run_on_writer(self, *args, **kwargs):
+        state = self._state
+        if not self.pooled or state.writing:
+            return method(self, *args, **kwargs)
+        with self._write_lock:
+            saved = (state.conn, state.cursor, state.span_classes,
+                     state.span_classes_version)
+            state.conn, state.cursor = self._writer
+            state.span_classes, state.span_classes_version = {}, None
+            state.writing = True
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                state.writing = False
+                (state.conn, state.cursor, state.span_classes,
+                 state.span_classes_version) = saved
+    return run_on_writer
+
 
 class DatabaseCache(object):
 
-    def __init__(self, cache_dir, verbose=False):
+    def __init__(self, cache_dir, verbose=False, read_only=False,
+                 busy_timeout=None, pooled=False):
+        """ Create a database cache in the given directory.  If pooled is
+            True, the database cache may be shared by many threads: every
+            thread reads through its own connection, which is opened on
+            first use, and all writes go through a single connection, one
+            thread at a time. """
         self.cache_dir = cache_dir
         self.verbose = verbose
-        self.cursor = None
-        self.conn = None
-        self.db_version = "0.0.4"
+        self.read_only = read_only
+        if busy_timeout is not None:
+            self.busy_timeout = busy_timeout
+        self.pooled = pooled
+        self._state = _ThreadConnectionState() if pooled \
+            else _ConnectionState()
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._pool_lock = threading.Lock()
+        self._pool_connections = []
+        self.db_version = "0.0.7"
         self.db_path = os.path.join(self.cache_dir + "sqlitedb")
+        self._saved_pragmas = None
+        self._saved_index_sql = None
+
+    # Number of rows that bulk loads sort and insert at a time.
+    bulk_batch_size = 100000
+
+    # PRAGMAs that favor throughput over durability while bulk loading.
+    # Checkpoints are deferred until the import is complete.
+    bulk_load_pragmas = (('synchronous', 'OFF'),
+                         ('cache_size', '-262144'),
+                         ('temp_store', 'MEMORY'),
+                         ('wal_autocheckpoint', '0'))
+
+    # Seconds to wait for locks held by other connections before failing
+    # with "database is locked".
+    busy_timeout = 30.0
+
+    # Journal mode of read-write connections.  In WAL mode, any number of
+    # readers keep reading a consistent snapshot while one import writes.
+    journal_mode = 'WAL'
+
+    # Checkpoint mode used to move imported pages from the write-ahead log
+    # into the database file once an import is complete.
+    checkpoint_mode = 'TRUNCATE'
+
+    # Number of prepared statements that every connection keeps for reuse.
+    cached_statements = 256
+
+    @property
+    def conn(self):
+        state = self._state
+        if state.conn is None and self._writer is not None:
+            self._open_thread_connection(state)
+        return state.conn
+
+    @conn.setter
+    def conn(self, conn):
+        self._state.conn = conn
+
+    @property
+    def cursor(self):
+        state = self._state
+        if state.cursor is None and self._writer is not None:
+            self._open_thread_connection(state)
+        return state.cursor
+
+    @cursor.setter
+    def cursor(self, cursor):
+        self._state.cursor = cursor
+
+    @property
+    def _span_classes(self):
+        return self._state.span_classes
+
+    @_span_classes.setter
+    def _span_classes(self, span_classes):
+        self._state.span_classes = span_classes
+
+    @property
+    def _span_classes_version(self):
+        return self._state.span_classes_version
+
+    @_span_classes_version.setter
+    def _span_classes_version(self, version):
+        self._state.span_classes_version = version
+
+    def _open_thread_connection(self, state):
+        """ Open the read connection of the current thread. """
+        conn = self._connect_read_only()
+        with self._pool_lock:
+            self._pool_connections.append(conn)
+        state.conn, state.cursor = conn, conn.cursor()
+
+    def _start_pool(self):
+        """ Keep the connection of connect_to_database as the writer
+            connection, so that every thread opens its own read connection
+            on first use. """
+        state = self._state
+        self._writer = (state.conn, state.cursor)
+        state.conn = state.cursor = None
+
+    def close_thread_connection(self):
+        """ Close the read connection of the current thread, e.g., before
+            the thread ends, if connections are pooled. """
+        state = self._state
+        if self.pooled and state.conn is not None and not state.writing:
+            with self._pool_lock:
+                self._pool_connections.remove(state.conn)
+            state.cursor.close()
+            state.conn.close()
+            state.conn = state.cursor = None
+            state.span_classes, state.span_classes_version = {}, None
 
     def erase_database(self):
-        """ Erase the database file. """
+        """ Erase the database file and the files derived from it, whose
+            generations would otherwise be mistaken for those of the next
+            database file, as well as the metadata of downloaded files,
+            which would otherwise claim they have been imported. """
         if os.path.exists(self.db_path):
             os.remove(self.db_path)
+        for file_name in (CompiledDatabase.file_name,
+                          ASNPrefixIndex.file_name,
+                          DownloadMetadata.file_name):
+            file_path = os.path.join(self.cache_dir, file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        shutil.rmtree(os.path.join(self.cache_dir, ResultCache.dir_name),
+                      True)
 
     def connect_to_database(self):
         """ Connect to the database cache, possibly after creating it if
             it doesn't exist yet, or after making sure an existing
             database cache has the correct version.  Return True if a
-            connection could be established, False otherwise. """
+            connection could be established, False otherwise.  Read-only
+            connections are made to existing database caches of the
+            expected version if requested, so that lookups never take
+            write locks. """
         if not os.path.exists(self.cache_dir):
             if self.verbose:
                 print("Initializing the cache directory...")
             os.mkdir(self.cache_dir)
+        cache_version = None
         if os.path.exists(self.db_path):
-            cache_version = self.get_db_version()
-            if not cache_version:
-                cache_version = "0.0.1"
-            if cache_version != self.db_version:
+            cache_version = self.get_db_version() or "0.0.1"
+            if self.read_only and cache_version == self.db_version:
+                self.conn = self._connect_read_only()
+                self.cursor = self.conn.cursor()
+                if self.pooled:
+                    self._start_pool()
+                return True
+        self.conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout,
+                                    cached_statements=self.cached_statements,
+                                    check_same_thread=not self.pooled)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('PRAGMA journal_mode = %s' % self.journal_mode)
+        if cache_version is not None:
+            cache_version = self.get_schema_version() or cache_version
+            steps = self.get_migration_steps(cache_version)
+            if steps is None:
                 print(("The existing database cache uses version %s, "
                        "not the expected %s." % (cache_version,
                                                  self.db_version)))
+                self.conn.close()
+                self.conn = self.cursor = None
                 return False
-        self.conn = sqlite3.connect(self.db_path)
-        self.cursor = self.conn.cursor()
+            if steps:
+                self.migrate(steps)
+            elif self.get_db_version() != self.db_version:
+                self.set_db_version()
         self.create_assignments_table()
         self.create_asn_description_table()
         self.create_asn_assignments_table()
+        self.create_generations_table()
+        self.create_country_cidrs_table()
+        self.create_import_checkpoints_table()
+        if not self.get_schema_version():
+            self._set_schema_version(self.db_version)
+            self.conn.commit()
+        if self.pooled:
+            self._start_pool()
         return True
 
+    def _connect_read_only(self):
+        """ Return a connection that can only read the database cache. """
+        uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(self.db_path))
+        options = {'timeout': self.busy_timeout,
+                   'cached_statements': self.cached_statements,
+                   'check_same_thread': not self.pooled}
+        try:
+            return sqlite3.connect(uri, uri=True, **options)
+        except TypeError:
+            # Python 2 can't open URIs, so fall back to read-write.
+            return sqlite3.connect(self.db_path, **options)
+
+    @_serialized
+    def checkpoint(self, mode=None):
+        """ Copy pages from the write-ahead log back into the database
+            file, using the given checkpoint mode or checkpoint_mode.
+            Return True unless readers kept the checkpoint from
+            completing. """
+        self.cursor.execute('PRAGMA wal_checkpoint(%s)' %
+                            (mode or self.checkpoint_mode))
+        row = self.cursor.fetchone()
+        return not row or row[0] == 0
+
+    # Steps that migrate database caches of older versions in place, in
+    # order, as (version, next version, method name) tuples.  Caches of
+    # versions without a step need to be erased and reloaded.
+    migrations = (("0.0.4", "0.0.5", "_migrate_span_bits"),
+                  ("0.0.5", "0.0.6", "_migrate_number_keys"),
+                  ("0.0.6", "0.0.7", "_migrate_country_cidrs"))
+
+    def get_migration_steps(self, cache_version):
+        """ Return the list of migration steps that lead from the given
+            version to the current one, which is empty if the given version
+            is the current one, or None if there is no such list. """
+        steps = []
+        while cache_version != self.db_version:
+            for step in self.migrations:
+                if step[0] == cache_version:
+                    steps.append(step)
+                    cache_version = step[1]
+                    break
+            else:
+                return None
+        return steps
+
+    def migrate(self, steps):
+        """ Run the given migration steps.  Every step runs in its own
+            transaction, which also records the version it produces in the
+            database file, so that a migration that is interrupted resumes
+            with the first step that did not complete.  The space freed by
+            the migration is reclaimed afterwards. """
+        self.conn.create_function('hex_to_key', 2, self._hex_to_key)
+        self.conn.create_function('hex_span_bits', 2, self._hex_span_bits)
+        for version, next_version, method_name in steps:
+            if self.verbose:
+                print(("Migrating the database cache from version %s to "
+                       "%s..." % (version, next_version)))
+            self.conn.commit()
+            self.cursor.execute('BEGIN IMMEDIATE')
+            try:
+                getattr(self, method_name)()
+                self._set_schema_version(next_version)
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+            self.set_db_version(version=next_version)
+        self.cursor.execute('VACUUM')
+
+    def _migrate_span_bits(self):
+        """ Add the bit length of each range size to assignments and ASN
+            assignments. """
+        for table in ('assignments', 'asn_assignments'):
+            self.cursor.execute('ALTER TABLE %s ADD COLUMN span_bits INT' %
+                                table)
+            self.cursor.execute('UPDATE %s SET span_bits = hex_span_bits('
+                                'start_hex, next_start_hex)' % table)
+
+    def _migrate_number_keys(self):
+        """ Convert assignments and ASN assignments stored as zero-padded
+            hex strings into integers and fixed-width blobs. """
+        tables = (('assignments', 'num_type, country_code, source_type, '
+                                  'source_name'),
+                  ('asn_assignments', 'num_type, as_num, source_type, '
+                                      'source_name'))
+        for table, _ in tables:
+            self._drop_secondary_indexes(table)
+            self.cursor.execute('ALTER TABLE %s RENAME TO %s_hex' %
+                                (table, table))
+        self.create_assignments_table(commit=False)
+        self.create_asn_assignments_table(commit=False)
+        for table, columns in tables:
+            sql = ('INSERT INTO %s (start_num, next_start_num, span_bits, '
+                   '%s) SELECT hex_to_key(start_hex, num_type), '
+                   'hex_to_key(next_start_hex, num_type), span_bits, %s '
+                   'FROM %s_hex ORDER BY num_type, start_hex' %
+                   (table, columns, columns, table))
+            self.cursor.execute(sql)
+            self.cursor.execute('DROP TABLE %s_hex' % table)
+
+    def _migrate_country_cidrs(self):
+        """ Summarize the assignments of every source type into country
+            CIDR blocks. """
+        self.create_country_cidrs_table(commit=False)
+        self.cursor.execute('SELECT DISTINCT source_type FROM assignments')
+        for (source_type, ) in self.cursor.fetchall():
+            self._summarize_country_cidrs(source_type)
+
+    def get_schema_version(self):
+        """ Return the version recorded in the database file, or None if
+            it was created before versions were recorded there. """
+        self.cursor.execute('PRAGMA user_version')
+        number = self.cursor.fetchone()[0]
+        if number:
+            return '%d.%d.%d' % (number // 1000000, number // 1000 % 1000,
+                                 number % 1000)
+
+    def _set_schema_version(self, version):
+        major, minor, patch = [int(part) for part in version.split('.')]
+        self.cursor.execute('PRAGMA user_version = %d' %
+                            (major * 1000000 + minor * 1000 + patch))
+
+    def _hex_to_key(self, hex_str, num_type):
+        return self._to_key(int(hex_str, 16), num_type)
+
+    def _hex_span_bits(self, start_hex, next_start_hex):
+        return (int(next_start_hex, 16) - int(start_hex, 16)).bit_length()
+
     def __get_default_config_file_obj(self):
         open_flags = 'r+'
         file_path = os.path.join(self.cache_dir, 'db.cfg')
@@ -105,14 +464,15 @@ class DatabaseCache(object):
         file_obj.close()
         return config
 
-    def set_db_version(self, file_obj=None):
-        """ Set the database version string in the config file. """
+    def set_db_version(self, file_obj=None, version=None):
+        """ Set the database version string in the config file to the
+            given or the current version. """
         if file_obj is None:
             file_obj = self.__get_default_config_file_obj()
         config = self._get_db_config()
         if not config.has_section('db'):
             config.add_section('db')
-        config.set('db', 'version', self.db_version)
+        config.set('db', 'version', version or self.db_version)
         config.write(file_obj)
         file_obj.close()
 
@@ -125,25 +485,52 @@ class DatabaseCache(object):
         return config.get('db', 'version')
 
     def commit_and_close_database(self):
+        if self.pooled and self._writer is not None:
+            with self._pool_lock:
+                connections, self._pool_connections = \
+                    self._pool_connections, []
+            for conn in connections:
+                conn.close()
+            state = self._state
+            state.conn, state.cursor = self._writer
+            self._writer = None
         self.conn.commit()
         self.cursor.close()
+        self.conn.close()
 
-    def create_assignments_table(self):
+    def create_assignments_table(self, commit=True):
         """ Create the assignments table that stores all assignments from
-            IPv4/IPv6/ASN to country code.  Blocks are stored as first hex
-            of and first hex after the assignment.  Numbers are stored
-            as hex strings, because SQLite's INTEGER type only holds up to
-            63 unsigned bits, which is not enough to store a /64 IPv6
-            block.  Hex strings have leading zeros, with IPv6 addresses
-            being 33 hex characters long and IPv4 addresses and ASN being
-            9 hex characters long.  The first number after an assignment
-            range is stored instead of the last number in the range to
-            facilitate comparisons with neighboring ranges. """
-        sql = ('CREATE TABLE IF NOT EXISTS assignments(start_hex TEXT, '
-               'next_start_hex TEXT, num_type TEXT, country_code TEXT, '
-               'source_type TEXT, source_name TEXT)')
+            IPv4/IPv6/ASN to country code.  Blocks are stored as first
+            number of and first number after the assignment.  IPv4
+            addresses and ASN are stored as plain integers.  IPv6 addresses
+            are stored as 17 byte big-endian blobs, because SQLite's
+            INTEGER type only holds up to 63 unsigned bits, which is not
+            enough to store a /64 IPv6 block, and because the first number
+            after ::/0 needs 129 bits.  Blobs of the same length compare
+            like the numbers they encode.  The first number after an
+            assignment range is stored instead of the last number in the
+            range to facilitate comparisons with neighboring ranges.  The
+            number of bits needed to hold the size of the range is stored
+            as span bits, so that point lookups only need to look at ranges
+            of one size class starting within a bounded window at a
+            time. """
+        sql = ('CREATE TABLE IF NOT EXISTS assignments(start_num BLOB, '
+               'next_start_num BLOB, num_type TEXT, country_code TEXT, '
+               'source_type TEXT, source_name TEXT, span_bits INT)')
         self.cursor.execute(sql)
-        self.conn.commit()
+        sql = ('CREATE INDEX IF NOT EXISTS AssignmentsBySpan ON '
+               'assignments ( source_type, num_type, span_bits, start_num, '
+               'next_start_num, country_code )')
+        self.cursor.execute(sql)
+        sql = ('CREATE INDEX IF NOT EXISTS AssignmentsByCountry ON '
+               'assignments ( country_code, num_type, start_num, '
+               'next_start_num )')
+        self.cursor.execute(sql)
+        sql = ('CREATE INDEX IF NOT EXISTS AssignmentsByStart ON '
+               'assignments ( num_type, start_num )')
+        self.cursor.execute(sql)
+        if commit:
+            self.conn.commit()
 
     def create_asn_description_table(self):
         """ Create the assignments table that stores all the descriptions
@@ -156,113 +543,717 @@ class DatabaseCache(object):
         self.cursor.execute(sql)
         self.conn.commit()
 
-    def create_asn_assignments_table(self):
+    def create_asn_assignments_table(self, commit=True):
         """ Create the assignments table that stores the assignments from
-            IPv4 to ASN """
-        # XXX: IPv6 not yet supported. (Not available from routeviews?)
-        sql = ('CREATE TABLE IF NOT EXISTS asn_assignments(start_hex TEXT, '
-               'next_start_hex TEXT, num_type TEXT, as_num INT, '
-               'source_type TEXT, source_name TEXT, PRIMARY KEY(start_hex, '
-               'next_start_hex))')
+            IPv4 and IPv6 networks to ASN, using the same number encoding
+            as the assignments table. """
+        sql = ('CREATE TABLE IF NOT EXISTS asn_assignments(start_num BLOB, '
+               'next_start_num BLOB, num_type TEXT, as_num INT, '
+               'source_type TEXT, source_name TEXT, span_bits INT, '
+               'PRIMARY KEY(start_num, next_start_num))')
         self.cursor.execute(sql)
-        sql = ('CREATE INDEX IF NOT EXISTS ASNEntriesByStartHex on '
-               'asn_assignments ( start_hex )')
+        sql = ('CREATE INDEX IF NOT EXISTS ASNEntriesBySpan ON '
+               'asn_assignments ( num_type, span_bits, start_num, '
+               'next_start_num, as_num )')
         self.cursor.execute(sql)
-        self.conn.commit()
+        sql = ('CREATE INDEX IF NOT EXISTS ASNEntriesByStart ON '
+               'asn_assignments ( num_type, start_num )')
+        self.cursor.execute(sql)
+        if commit:
+            self.conn.commit()
 
+    @_serialized
     def delete_assignments(self, source_type):
         """ Delete all assignments from the database cache matching a
             given source type ("rir", "lir", etc.). """
         sql = 'DELETE FROM assignments WHERE source_type = ?'
         self.cursor.execute(sql, (source_type, ))
-        self.conn.commit()
+        self._advance_generation(source_type)
+        self._summarize_country_cidrs(source_type)
+        self.commit_changes()
 
+    @_serialized
     def delete_asn_descriptions(self):
         """ Delete all asn descriptions from the database cache. """
         sql = 'DELETE FROM asn_descriptions'
         self.cursor.execute(sql)
-        self.conn.commit()
+        self._advance_generation('asn_descriptions')
+        self.commit_changes()
 
+    @_serialized
     def delete_asn_assignments(self):
         """ Delete all the bgp netblock to as entries """
         sql = 'DELETE FROM asn_assignments'
         self.cursor.execute(sql)
-        self.conn.commit()
+        self._advance_generation('asn_assignments')
+        self.commit_changes()
 
+    @_serialized
     def insert_assignment(self, start_num, end_num, num_type,
                           country_code, source_type, source_name):
         """ Insert an assignment into the database cache, without
-            committing after the insertion. """
-        sql = ('INSERT INTO assignments (start_hex, next_start_hex, '
-               'num_type, country_code, source_type, source_name) '
-               'VALUES (?, ?, ?, ?, ?, ?)')
-        if num_type == 'ipv6':
-            start_hex = '%033x' % start_num
-            next_start_hex = '%033x' % (end_num + 1)
-        else:
-            start_hex = '%09x' % start_num
-            next_start_hex = '%09x' % (end_num + 1)
+            committing after the insertion.  Unlike replace_assignments,
+            this leaves country CIDR blocks alone. """
+        sql = ('INSERT INTO assignments (start_num, next_start_num, '
+               'num_type, country_code, source_type, source_name, '
+               'span_bits) VALUES (?, ?, ?, ?, ?, ?, ?)')
+        span_bits = (end_num + 1 - start_num).bit_length()
+        next_start_num = self._to_key(end_num + 1, num_type)
+        start_num = self._to_key(start_num, num_type)
         country_code = normalize_country_code(country_code)
-        self.cursor.execute(sql, (start_hex, next_start_hex, num_type,
-                                  country_code, source_type, source_name))
+        self.cursor.execute(sql, (start_num, next_start_num, num_type,
+                                  country_code, source_type, source_name,
+                                  span_bits))
 
+    @_serialized
     def insert_asn_description(self, asn, source_name, description):
         sql = ('INSERT INTO asn_descriptions '
                '(as_num, source_name, description) '
                'VALUES (?, ?, ?)')
         self.cursor.execute(sql, (asn, source_name, str(description)))
 
+    @_serialized
     def insert_asn_assignment(self, start_num, end_num, num_type, asn,
                               source_type, source_name):
         # XXX: This is sqlite specific syntax
-        sql = ('INSERT OR IGNORE INTO asn_assignments (start_hex, '
-               'next_start_hex, num_type, as_num, source_type, source_name) '
-               'VALUES (?, ?, ?, ?, ?, ?)')
-        if num_type == 'ipv6':
-            start_hex = '%033x' % start_num
-            next_start_hex = '%033x' % (end_num + 1)
+        sql = ('INSERT OR IGNORE INTO asn_assignments (start_num, '
+               'next_start_num, num_type, as_num, source_type, source_name, '
+               'span_bits) VALUES (?, ?, ?, ?, ?, ?, ?)')
+        span_bits = (end_num + 1 - start_num).bit_length()
+        next_start_num = self._to_key(end_num + 1, num_type)
+        start_num = self._to_key(start_num, num_type)
+        self.cursor.execute(sql, (start_num, next_start_num, num_type, asn,
+                                  source_type, source_name, span_bits))
+
+    @_serialized
+    def bulk_insert_assignments(self, rows, source_type,
+                                table='assignments', checkpoint=False):
+        """ Insert many assignments into the given table and commit.  Rows
+            are (start_num, end_num, num_type, country_code, source_name)
+            tuples, which are sorted and inserted in large batches while
+            secondary indexes are dropped and the connection is tuned for
+            importing.  If checkpoint is True, every batch is committed
+            together with the import checkpoint of the table, see
+            _begin_staging_table.  If inserting fails, the rows inserted
+            since the last commit are rolled back, so that they are never
+            committed without the checkpoint that counts them. """
+        sql = ('INSERT INTO %s (start_num, next_start_num, '
+               'num_type, country_code, source_type, source_name, '
+               'span_bits) VALUES (?, ?, ?, ?, ?, ?, ?)' % table)
+        to_key = self._to_key
+        country_codes = {}
+        self._begin_bulk_load(table)
+        try:
+            for batch in self._sorted_batches(rows):
+                values = []
+                for (start_num, end_num, num_type, country_code,
+                        source_name) in batch:
+                    next_start_num = end_num + 1
+                    if country_code not in country_codes:
+                        country_codes[country_code] = \
+                            normalize_country_code(country_code)
+                    values.append((to_key(start_num, num_type),
+                                   to_key(next_start_num, num_type),
+                                   num_type, country_codes[country_code],
+                                   source_type, source_name,
+                                   (next_start_num - start_num).bit_length()))
+                self.cursor.executemany(sql, values)
+                if checkpoint:
+                    self._advance_import_checkpoint(table, len(batch))
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self._end_bulk_load()
+
+    @_serialized
+    def bulk_insert_asn_assignments(self, rows, source_type,
+                                    table='asn_assignments', checkpoint=False):
+        """ Insert many ASN assignments into the given table and commit.
+            Rows are (start_num, end_num, num_type, asn, source_name)
+            tuples, which are loaded like in bulk_insert_assignments. """
+        # XXX: This is sqlite specific syntax
+        sql = ('INSERT OR IGNORE INTO %s (start_num, '
+               'next_start_num, num_type, as_num, source_type, source_name, '
+               'span_bits) VALUES (?, ?, ?, ?, ?, ?, ?)' % table)
+        to_key = self._to_key
+        self._begin_bulk_load(table)
+        try:
+            for batch in self._sorted_batches(rows):
+                values = []
+                for (start_num, end_num, num_type, asn,
+                        source_name) in batch:
+                    next_start_num = end_num + 1
+                    values.append((to_key(start_num, num_type),
+                                   to_key(next_start_num, num_type),
+                                   num_type, asn, source_type, source_name,
+                                   (next_start_num - start_num).bit_length()))
+                self.cursor.executemany(sql, values)
+                if checkpoint:
+                    self._advance_import_checkpoint(table, len(batch))
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self._end_bulk_load()
+
+    @_serialized
+    def replace_assignments(self, rows, source_type, input_name=None,
+                            resume=False):
+        """ Replace all assignments of the given source type with the given
+            rows, see bulk_insert_assignments.  Rows are loaded into a
+            staging table first and swapped in with a single transaction,
+            so that readers see either the complete previous or the
+            complete new generation of the source type.  If an input name
+            is given, loading the staging table can be resumed after the
+            last committed batch, see _begin_staging_table. """
+        skip_rows = self._begin_staging_table('assignments', source_type,
+                                              input_name, resume)
+        self.bulk_insert_assignments(itertools.islice(rows, skip_rows, None),
+                                     source_type, 'assignments_staging',
+                                     checkpoint=input_name is not None)
+        self._swap_staging_table('assignments', source_type, source_type)
+
+    @_serialized
+    def update_assignments(self, rows, source_type):
+        """ Change the assignments of the given source type into the given
+            rows, see bulk_insert_assignments, by inserting, updating, and
+            deleting only those assignments that differ.  Rows are loaded
+            into a staging table, which is compared to the current
+            assignments in one pass over both sorted by range.  The changes
+            are applied, the generation of the source type is advanced, and
+            the country CIDR blocks of changed country codes are summarized
+            in a single transaction.  The generation is left alone if
+            nothing changed.  Return the numbers of inserted, updated, and
+            deleted assignments. """
+        self._create_staging_table('assignments')
+        self.bulk_insert_assignments(rows, source_type,
+                                     'assignments_staging')
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE')
+            inserts, updates, deletes = self._diff_staging_assignments(
+                source_type)
+            self.cursor.executemany(
+                'INSERT INTO assignments SELECT * FROM assignments_staging '
+                'WHERE rowid = ?', ((rowid, ) for rowid, _ in inserts))
+            self.cursor.executemany(
+                'UPDATE assignments SET country_code = ?, source_name = ? '
+                'WHERE rowid = ?', ((country_code, source_name, rowid)
+                                    for rowid, _, country_code, source_name
+                                    in updates))
+            self.cursor.executemany(
+                'DELETE FROM assignments WHERE rowid = ?',
+                ((rowid, ) for rowid, _ in deletes))
+            self.cursor.execute('DROP TABLE assignments_staging')
+            if inserts or updates or deletes:
+                country_codes = set(country_code for _, country_code
+                                    in inserts + deletes)
+                country_codes.update(country_code for _, old_country_code,
+                                     country_code, _ in updates)
+                country_codes.update(old_country_code for _,
+                                     old_country_code, _, _ in updates)
+                self._advance_generation(source_type)
+                self._summarize_country_cidrs(source_type, country_codes)
+            self.commit_changes()
+        except:
+            self.conn.rollback()
+            raise
+        self.checkpoint()
+        return len(inserts), len(updates), len(deletes)
+
+    def _diff_staging_assignments(self, source_type):
+        """ Compare the assignments of the given source type to those in
+            the staging table, both read sorted by number type and range,
+            and return lists of (rowid, country_code) tuples of staging rows
+            to insert, (rowid, old_country_code, country_code, source_name)
+            tuples of assignments to update, and (rowid, country_code)
+            tuples of assignments to delete.  Assignments of the same range
+            are matched with staging rows of the same range that have the
+            same country code and source name first. """
+        columns = ('num_type, start_num, next_start_num, country_code, '
+                   'source_name, rowid')
+        order = 'ORDER BY num_type, start_num, next_start_num, ' \
+            'country_code, source_name'
+        old_cursor = self.conn.cursor()
+        old_cursor.execute('SELECT %s FROM assignments WHERE source_type = '
+                           '? %s' % (columns, order), (source_type, ))
+        new_cursor = self.conn.cursor()
+        new_cursor.execute('SELECT %s FROM assignments_staging %s' %
+                           (columns, order))
+        inserts, updates, deletes = [], [], []
+
+        def next_range(groups):
+            for key, rows in groups:
+                return key, list(rows)
+            return None, None
+
+        old_groups = itertools.groupby(old_cursor, key=lambda row: row[:3])
+        new_groups = itertools.groupby(new_cursor, key=lambda row: row[:3])
+        old_key, old_rows = next_range(old_groups)
+        new_key, new_rows = next_range(new_groups)
+        while old_key is not None or new_key is not None:
+            if new_key is None or (old_key is not None and
+                                   old_key < new_key):
+                deletes.extend((row[5], row[3]) for row in old_rows)
+                old_key, old_rows = next_range(old_groups)
+                continue
+            if old_key is None or new_key < old_key:
+                inserts.extend((row[5], row[3]) for row in new_rows)
+                new_key, new_rows = next_range(new_groups)
+                continue
+            changed_rows = []
+            for old_row in old_rows:
+                for i, new_row in enumerate(new_rows):
+                    if new_row[3:5] == old_row[3:5]:
+                        del new_rows[i]
+                        break
+                else:
+                    changed_rows.append(old_row)
+            for old_row, new_row in zip(changed_rows, new_rows):
+                updates.append((old_row[5], old_row[3], new_row[3],
+                                new_row[4]))
+            deletes.extend((row[5], row[3])
+                           for row in changed_rows[len(new_rows):])
+            inserts.extend((row[5], row[3])
+                           for row in new_rows[len(changed_rows):])
+            old_key, old_rows = next_range(old_groups)
+            new_key, new_rows = next_range(new_groups)
+        old_cursor.close()
+        new_cursor.close()
+        return inserts, updates, deletes
+
+    @_serialized
+    def replace_asn_assignments(self, rows, source_type, input_name=None,
+                                resume=False):
+        """ Replace all ASN assignments with the given rows, see
+            bulk_insert_asn_assignments, in the same way as
+            replace_assignments. """
+        skip_rows = self._begin_staging_table('asn_assignments', source_type,
+                                              input_name, resume)
+        self.bulk_insert_asn_assignments(
+            itertools.islice(rows, skip_rows, None), source_type,
+            'asn_assignments_staging', checkpoint=input_name is not None)
+        self._swap_staging_table('asn_assignments', 'asn_assignments')
+
+    @_serialized
+    def replace_asn_descriptions(self, rows):
+        """ Replace all ASN descriptions with the given (asn, source_name,
+            description) rows in the same way as replace_assignments. """
+        self._create_staging_table('asn_descriptions')
+        sql = ('INSERT INTO asn_descriptions_staging '
+               '(as_num, source_name, description) VALUES (?, ?, ?)')
+        self.cursor.executemany(sql, rows)
+        self.conn.commit()
+        self._swap_staging_table('asn_descriptions', 'asn_descriptions')
+
+    def _create_staging_table(self, table):
+        """ Create an empty staging table without secondary indexes and
+            with the same columns and primary key as the given table,
+            replacing any staging table left behind by an earlier import
+            that did not complete. """
+        self.cursor.execute('DROP TABLE IF EXISTS %s_staging' % table)
+        self.cursor.execute("SELECT sql FROM sqlite_master WHERE "
+                            "type = 'table' AND name = ?", (table, ))
+        sql = self.cursor.fetchone()[0]
+        self.cursor.execute(sql.replace('CREATE TABLE %s(' % table,
+                                        'CREATE TABLE %s_staging(' % table,
+                                        1))
+        self.conn.commit()
+
+    def create_import_checkpoints_table(self):
+        """ Create the table that records how far the staging table of an
+            import has been loaded: the source type and input of the
+            import, and the number of rows and batches committed so far.
+            The input is a string that identifies the files being
+            imported. """
+        sql = ('CREATE TABLE IF NOT EXISTS import_checkpoints(table_name '
+               'TEXT PRIMARY KEY, source_type TEXT, input TEXT, row_count '
+               'INT, batch_count INT)')
+        self.cursor.execute(sql)
+        self.conn.commit()
+
+    def get_import_checkpoint(self, table):
+        """ Return the (source_type, input, row_count, batch_count) tuple of
+            the import into the given table that did not complete, or None
+            if there is none. """
+        self.cursor.execute('SELECT source_type, input, row_count, '
+                            'batch_count FROM import_checkpoints WHERE '
+                            'table_name = ?', (table, ))
+        return self.cursor.fetchone()
+
+    def _begin_staging_table(self, table, source_type, input_name, resume):
+        """ Prepare the staging table of the given table for loading rows
+            of the given source type, and return the number of rows to skip
+            because they are already loaded.  If resume is True and an
+            earlier import of the same source type and input did not
+            complete, its staging table is kept, so that loading continues
+            after its last committed batch.  Otherwise a new staging table
+            is created, together with a checkpoint if an input name is
+            given. """
+        checkpoint = self.get_import_checkpoint(table)
+        self.cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE "
+                            "type = 'table' AND name = ?",
+                            (table + '_staging', ))
+        if resume and input_name is not None and checkpoint is not None \
+                and checkpoint[:2] == (source_type, input_name) \
+                and self.cursor.fetchone()[0]:
+            if self.verbose:
+                print(("Resuming the import into %s after %d rows in %d "
+                       "batches..." % (table, checkpoint[2], checkpoint[3])))
+            return checkpoint[2]
+        self._create_staging_table(table)
+        self.cursor.execute('DELETE FROM import_checkpoints WHERE '
+                            'table_name = ?', (table, ))
+        if input_name is not None:
+            self.cursor.execute('INSERT INTO import_checkpoints (table_name, '
+                                'source_type, input, row_count, batch_count) '
+                                'VALUES (?, ?, ?, 0, 0)',
+                                (table, source_type, input_name))
+        self.conn.commit()
+        return 0
+
+    def _advance_import_checkpoint(self, staging_table, row_count):
+        """ Count a batch of the given number of rows loaded into the given
+            staging table and commit it. """
+        self.cursor.execute('UPDATE import_checkpoints SET row_count = '
+                            'row_count + ?, batch_count = batch_count + 1 '
+                            'WHERE table_name = ?',
+                            (row_count, staging_table[:-len('_staging')]))
+        self.conn.commit()
+
+    def _swap_staging_table(self, table, generation_name,
+                            source_type=None):
+        """ Replace the rows of the given table, or only those of the given
+            source type, with the rows of its staging table, drop the
+            staging table and its import checkpoint, advance the generation
+            of the replaced data, and summarize replaced assignments into
+            country CIDR blocks in a single transaction.  The secondary
+            indexes are only dropped and rebuilt when the whole table is
+            replaced.  Replacing one source type keeps them, so that the
+            cost of the swap follows the size of that source type rather
+            than of the whole table. """
+        self.conn.commit()
+        saved_pragmas = self._set_pragmas(self.bulk_load_pragmas)
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE')
+            if source_type is None:
+                index_sql = self._drop_secondary_indexes(table)
+                self.cursor.execute('DELETE FROM %s' % table)
+            else:
+                index_sql = []
+                self.cursor.execute('DELETE FROM %s WHERE source_type = ?' %
+                                    table, (source_type, ))
+            self.cursor.execute('INSERT OR IGNORE INTO %s SELECT * FROM '
+                                '%s_staging' % (table, table))
+            self.cursor.execute('DROP TABLE %s_staging' % table)
+            self.cursor.execute('DELETE FROM import_checkpoints WHERE '
+                                'table_name = ?', (table, ))
+            for sql in index_sql:
+                self.cursor.execute(sql)
+            self._advance_generation(generation_name)
+            if table == 'assignments':
+                self._summarize_country_cidrs(source_type)
+            self.commit_changes()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            self._set_pragmas(saved_pragmas)
+        self.checkpoint()
+
+    def create_generations_table(self):
+        """ Create the table that counts how often each source type of
+            assignments, the ASN assignments, and the ASN descriptions have
+            been replaced.  All of them share one counter, so that the
+            highest generation changes whenever any data changes. """
+        sql = ('CREATE TABLE IF NOT EXISTS generations(name TEXT PRIMARY '
+               'KEY, generation INT)')
+        self.cursor.execute(sql)
+        sql = ('CREATE INDEX IF NOT EXISTS GenerationsByNumber ON '
+               'generations ( generation )')
+        self.cursor.execute(sql)
+        self.conn.commit()
+
+    def get_generation(self, name=None):
+        """ Return the generation of the given source type, of
+            "asn_assignments", or of "asn_descriptions", or the highest
+            generation of all of them if no name is given.  Generations
+            start at 0 for data that has never been imported and only ever
+            increase, so they can be used to invalidate cached results. """
+        if name is None:
+            self.cursor.execute('SELECT MAX(generation) FROM generations')
+        else:
+            self.cursor.execute('SELECT generation FROM generations '
+                                'WHERE name = ?', (name, ))
+        row = self.cursor.fetchone()
+        if row and row[0] is not None:
+            return row[0]
+        return 0
+
+    def _advance_generation(self, name):
+        """ Set the generation of the given name to one more than the
+            highest generation so far, without committing. """
+        sql = ('INSERT OR REPLACE INTO generations (name, generation) '
+               'SELECT ?, IFNULL(MAX(generation), 0) + 1 FROM generations')
+        self.cursor.execute(sql, (name, ))
+
+    def create_country_cidrs_table(self, commit=True):
+        """ Create the table that stores the minimal list of blocks that
+            cover the assignments of each country code, number type, and
+            source type, so that listing the blocks of a country takes a
+            single indexed read.  Blocks are CIDR strings for IPv4 and IPv6
+            and first numbers of assignments for ASN, stored together with
+            their first number in the assignments encoding.  Blocks are
+            summarized whenever the generation of a source type advances,
+            in the same transaction. """
+        sql = ('CREATE TABLE IF NOT EXISTS country_cidrs(country_code TEXT, '
+               'num_type TEXT, source_type TEXT, start_num BLOB, cidr TEXT, '
+               'PRIMARY KEY(country_code, num_type, source_type, '
+               'start_num))')
+        self.cursor.execute(sql)
+        sql = ('CREATE INDEX IF NOT EXISTS CountryCidrsBySource ON '
+               'country_cidrs ( source_type )')
+        self.cursor.execute(sql)
+        if commit:
+            self.conn.commit()
+
+    def _summarize_country_cidrs(self, source_type, country_codes=None):
+        """ Replace the country CIDR blocks of the given source type, or
+            only those of the given country codes, with blocks summarized
+            from its current assignments, without committing. """
+        cursor = self.conn.cursor()
+        if country_codes is None:
+            self.cursor.execute('DELETE FROM country_cidrs WHERE '
+                                'source_type = ?', (source_type, ))
+            cursor.execute('SELECT country_code, num_type, start_num, '
+                           'next_start_num FROM assignments WHERE '
+                           'source_type = ? ORDER BY country_code, num_type, '
+                           'start_num', (source_type, ))
+            self._insert_country_cidrs(source_type, cursor)
         else:
-            start_hex = '%09x' % start_num
-            next_start_hex = '%09x' % (end_num + 1)
-        self.cursor.execute(sql, (start_hex, next_start_hex, num_type, asn,
-                                  source_type, source_name))
+            for country_code in country_codes:
+                self.cursor.execute('DELETE FROM country_cidrs WHERE '
+                                    'country_code IS ? AND source_type = ?',
+                                    (country_code, source_type))
+                cursor.execute('SELECT country_code, num_type, start_num, '
+                               'next_start_num FROM assignments WHERE '
+                               'country_code IS ? AND source_type = ? '
+                               'ORDER BY num_type, start_num',
+                               (country_code, source_type))
+                self._insert_country_cidrs(source_type, cursor)
+        cursor.close()
+
+    def _insert_country_cidrs(self, source_type, cursor):
+        """ Insert the country CIDR blocks of the assignments that the given
+            cursor yields as (country_code, num_type, start_num,
+            next_start_num) rows sorted in this order. """
+        sql = ('INSERT OR IGNORE INTO country_cidrs (country_code, num_type, '
+               'source_type, start_num, cidr) VALUES (?, ?, ?, ?, ?)')
+        from_key = self._from_key
+        for (country_code, num_type), rows in itertools.groupby(
+                cursor, key=lambda row: row[:2]):
+            ranges = ((from_key(row[2]), from_key(row[3]) - 1)
+                      for row in rows)
+            self.cursor.executemany(sql, (
+                (country_code, num_type, source_type,
+                 self._to_key(start_num, num_type), cidr)
+                for start_num, cidr in summarize_ranges(ranges, num_type)))
 
+    def _sorted_batches(self, rows):
+        """ Yield lists of up to bulk_batch_size rows, each sorted by number
+            type and range, so that inserts append to the B-trees in
+            order. """
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.bulk_batch_size))
+            if not batch:
+                return
+            batch.sort(key=lambda row: (row[2], row[0], row[1]))
+            yield batch
+
+    def _begin_bulk_load(self, table):
+        """ Commit, switch the connection to import-friendly PRAGMAs, and
+            drop the secondary indexes of the given table.  Committing
+            first keeps the dropped indexes out of the transaction that a
+            failed load rolls back. """
+        self.conn.commit()
+        self._saved_pragmas = self._set_pragmas(self.bulk_load_pragmas)
+        self._saved_index_sql = self._drop_secondary_indexes(table)
+
+    def _end_bulk_load(self):
+        """ Rebuild the secondary indexes dropped by _begin_bulk_load,
+            commit, and restore the PRAGMAs that were changed for bulk
+            loading. """
+        for sql in self._saved_index_sql:
+            self.cursor.execute(sql)
+        self.commit_changes()
+        self._set_pragmas(self._saved_pragmas)
+        self._saved_pragmas = self._saved_index_sql = None
+
+    def _set_pragmas(self, pragmas):
+        """ Set the given (pragma, value) pairs and return the previous
+            values in the same form. """
+        saved_pragmas = []
+        for pragma, value in pragmas:
+            self.cursor.execute('PRAGMA %s' % pragma)
+            saved_pragmas.append((pragma, self.cursor.fetchone()[0]))
+            self.cursor.execute('PRAGMA %s = %s' % (pragma, value))
+        return saved_pragmas
+
+    def _drop_secondary_indexes(self, table):
+        """ Drop all indexes of the given table that were created
+            explicitly, leaving primary key indexes in place, and return
+            the statements that recreate them. """
+        self.cursor.execute("SELECT name, sql FROM sqlite_master WHERE "
+                            "type = 'index' AND tbl_name = ? AND "
+                            "sql IS NOT NULL", (table, ))
+        indexes = self.cursor.fetchall()
+        for index_name, _ in indexes:
+            self.cursor.execute('DROP INDEX %s' % index_name)
+        return [sql for _, sql in indexes]
+
+    @_serialized
     def commit_changes(self):
         """ Commit changes, e.g., after inserting assignments into the
             database cache. """
         self.conn.commit()
+        self._span_classes = {}
+
+    def _to_key(self, num, num_type):
+        """ Return the key that is stored for the given number and number
+            type. """
+        if num_type == 'ipv6':
+            return _int_to_bytes(int(num), 17)
+        return int(num)
+
+    def _from_key(self, key):
+        """ Return the number that is encoded in the given stored key. """
+        if isinstance(key, (int, long)):
+            return key
+        return _bytes_to_int(key)
+
+    def _get_span_classes(self, num_type, source_type=None):
+        """ Return the sorted list of span bits found in assignments of the
+            given number type and source type, or in ASN assignments of the
+            given number type if no source type is given.  Each class is
+            found with a single index seek, and the result is remembered
+            until the next change to the database cache by this or any
+            other connection. """
+        self.cursor.execute('PRAGMA data_version')
+        data_version = self.cursor.fetchone()[0]
+        if data_version != self._span_classes_version:
+            self._span_classes = {}
+            self._span_classes_version = data_version
+        key = (num_type, source_type)
+        if key in self._span_classes:
+            return self._span_classes[key]
+        if source_type is None:
+            sql = ('SELECT MIN(span_bits) FROM asn_assignments '
+                   'WHERE num_type = ? AND span_bits > ?')
+            args = (num_type, )
+        else:
+            sql = ('SELECT MIN(span_bits) FROM assignments '
+                   'WHERE source_type = ? AND num_type = ? AND span_bits > ?')
+            args = (source_type, num_type)
+        span_classes = []
+        span_bits = -1
+        while True:
+            self.cursor.execute(sql, args + (span_bits, ))
+            span_bits = self.cursor.fetchone()[0]
+            if span_bits is None:
+                break
+            span_classes.append(span_bits)
+        self._span_classes[key] = span_classes
+        return span_classes
 
     def fetch_assignments(self, num_type, country_code):
         """ Fetch all assignments from the database cache matching the
             given number type ("asn", "ipv4", or "ipv6") and country code.
             The result is a sorted list of tuples containing (start_num,
             end_num). """
-        sql = ('SELECT start_hex, next_start_hex FROM assignments '
+        sql = ('SELECT start_num, next_start_num FROM assignments '
                'WHERE num_type = ? AND country_code = ? '
-               'ORDER BY start_hex')
+               'ORDER BY start_num')
         self.cursor.execute(sql, (num_type, country_code))
         result = []
         for row in self.cursor:
-            result.append((int(row[0], 16), int(row[1], 16) - 1))
+            result.append((self._from_key(row[0]),
+                           self._from_key(row[1]) - 1))
         return result
 
+    def fetch_country_cidrs(self, num_type, country_code):
+        """ Fetch the minimal list of blocks that cover the assignments of
+            the given number type and country code in each source type, see
+            create_country_cidrs_table, without duplicates and sorted by
+            first number. """
+        sql = ('SELECT cidr, MIN(start_num) AS first_num FROM country_cidrs '
+               'WHERE country_code = ? AND num_type = ? GROUP BY cidr '
+               'ORDER BY first_num, cidr')
+        self.cursor.execute(sql, (country_code, num_type))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def fetch_ranges(self, num_type, source_type):
+        """ Fetch all assignments from the database cache matching the
+            given number type and source type.  The result is an iterator
+            over (start_num, end_num, country_code, span_bits) tuples
+            sorted by start_num. """
+        sql = ('SELECT start_num, next_start_num, country_code, span_bits '
+               'FROM assignments WHERE source_type = ? AND num_type = ? '
+               'ORDER BY start_num')
+        cursor = self.conn.cursor()
+        cursor.execute(sql, (source_type, num_type))
+        from_key = self._from_key
+        for start_key, next_start_key, country_code, span_bits in cursor:
+            yield (from_key(start_key), from_key(next_start_key) - 1,
+                   country_code, span_bits)
+        cursor.close()
+
+    def fetch_asn_ranges(self, num_type):
+        """ Fetch all ASN assignments from the database cache matching the
+            given number type.  The result is an iterator over (start_num,
+            end_num, as_num, span_bits) tuples sorted by start_num. """
+        sql = ('SELECT start_num, next_start_num, as_num, span_bits '
+               'FROM asn_assignments WHERE num_type = ? ORDER BY start_num')
+        cursor = self.conn.cursor()
+        cursor.execute(sql, (num_type, ))
+        from_key = self._from_key
+        for start_key, next_start_key, as_num, span_bits in cursor:
+            yield (from_key(start_key), from_key(next_start_key) - 1,
+                   as_num, span_bits)
+        cursor.close()
+
+    def fetch_asn_description(self, as_num):
+        """ Fetch the description of the given AS number, or None. """
+        sql = 'SELECT description FROM asn_descriptions WHERE as_num = ?'
+        self.cursor.execute(sql, (as_num, ))
+        row = self.cursor.fetchone()
+        if row:
+            return row[0]
+
     def fetch_country_code(self, num_type, source_type, lookup_num):
         """ Fetch the country code from the database cache that is
             assigned to the given number (e.g., IPv4 address in decimal
             notation), number type (e.g., "ipv4"), and source type (e.g.,
-            "rir"). """
-        sql = ('SELECT country_code FROM assignments WHERE num_type = ? '
-               'AND source_type = ? AND start_hex <= ? '
-               'AND next_start_hex > ?')
-        if num_type == 'ipv6':
-            lookup_hex = '%033x' % int(lookup_num)
-        else:
-            lookup_hex = '%09x' % int(lookup_num)
-        self.cursor.execute(sql, (num_type, source_type, lookup_hex,
-                                  lookup_hex))
-        row = self.cursor.fetchone()
-        if row:
-            return row[0]
+            "rir").  If more than one assignment contains the number, the
+            country code of the most specific one is returned.  Size
+            classes are probed from smallest to largest, and an assignment
+            of a class with span bits b can only contain the number if it
+            starts less than 2**b before it, so every probe is a short
+            index range scan that stops at the first match. """
+        sql = ('SELECT country_code FROM assignments WHERE source_type = ? '
+               'AND num_type = ? AND span_bits = ? AND start_num >= ? '
+               'AND start_num <= ? AND next_start_num > ? '
+               'ORDER BY start_num DESC LIMIT 1')
+        lookup_num = int(lookup_num)
+        lookup_key = self._to_key(lookup_num, num_type)
+        for span_bits in self._get_span_classes(num_type, source_type):
+            lower_key = self._to_key(
+                max(0, lookup_num - (1 << span_bits) + 1), num_type)
+            self.cursor.execute(sql, (source_type, num_type, span_bits,
+                                      lower_key, lookup_key, lookup_key))
+            row = self.cursor.fetchone()
+            if row:
+                return row[0]
 
     def fetch_country_blocks_in_other_sources(self, first_country_code):
         """ Fetch all assignments matching the given country code, then look
@@ -271,57 +1262,118 @@ class DatabaseCache(object):
             type, (2) first and (3) last number of the assignment in the first
             source type, (4) second source type, (5) first and (6) last number
             of the assignment in the second source type, (7) country code in
-            the second source type, and (8) number type. """
-        sql = ('SELECT first.source_type, first.start_hex, '
-               'first.next_start_hex, second.source_type, '
-               'second.start_hex, second.next_start_hex, '
-               'second.country_code, first.num_type '
-               'FROM assignments AS first '
-               'JOIN assignments AS second '
-               'WHERE first.country_code = ? '
-               'AND first.start_hex <= second.next_start_hex '
-               'AND first.next_start_hex >= second.start_hex '
-               'AND first.num_type = second.num_type '
-               'ORDER BY first.source_type, first.start_hex, '
-               'second.source_type, second.start_hex')
+            the second source type, and (8) number type.  Second assignments
+            include neighboring ones and the first assignment itself.  The
+            result is an iterator, ordered by first source type, first
+            number, second source type, and second number, which sweeps once
+            over the assignments of each number type per first source
+            type. """
+        sql = ('SELECT DISTINCT source_type FROM assignments '
+               'WHERE country_code = ? ORDER BY source_type')
         self.cursor.execute(sql, (first_country_code, ))
-        result = []
-        for row in self.cursor:
-            result.append((str(row[0]), int(row[1], 16),
-                           int(row[2], 16) - 1, str(row[3]), int(row[4], 16),
-                           int(row[5], 16) - 1, str(row[6]), str(row[7])))
-        return result
+        first_source_types = [row[0] for row in self.cursor]
+        for first_source_type in first_source_types:
+            for order, row in heapq.merge(*[
+                    self._sweep_country_blocks(first_country_code,
+                                               first_source_type, num_type)
+                    for num_type in ('asn', 'ipv4', 'ipv6')]):
+                yield row
+
+    def _sweep_country_blocks(self, first_country_code, first_source_type,
+                              num_type):
+        """ Yield (order, row) tuples for fetch_country_blocks_in_other_sources
+            with all first assignments of the given source type and number
+            type, where order sorts rows across number types in the same
+            way as SQLite sorts integer and blob keys.  Assignments are read
+            in order of their first numbers.  Every assignment is paired with
+            the first assignments it reaches, either when it is read, for
+            first assignments read before it, or when a first assignment is
+            read, for assignments read before that.  Rows are held back
+            until all first assignments starting earlier are complete. """
+        sql = ('SELECT source_type, start_num, next_start_num, country_code '
+               'FROM assignments WHERE num_type = ? ORDER BY start_num')
+        cursor = self.conn.cursor()
+        cursor.execute(sql, (num_type, ))
+        from_key = self._from_key
+        blob_keys = num_type == 'ipv6'
+        active, open_firsts, pending = [], [], deque()
+
+        def rows(first):
+            first_start_num, first_end_num, seconds = first
+            seconds.sort()
+            for (second_source_type, second_start_num, second_end_num,
+                    second_country_code) in seconds:
+                yield ((blob_keys, first_start_num, num_type, first_end_num,
+                        second_source_type, second_start_num,
+                        second_end_num),
+                       (str(first_source_type), first_start_num,
+                        first_end_num, str(second_source_type),
+                        second_start_num, second_end_num,
+                        str(second_country_code), str(num_type)))
+
+        for source_type, start_key, next_start_key, country_code in cursor:
+            start_num = from_key(start_key)
+            end_num = from_key(next_start_key) - 1
+            while pending and pending[0][1] + 1 < start_num:
+                for row in rows(pending.popleft()):
+                    yield row
+            while active and active[0][0] + 1 < start_num:
+                heapq.heappop(active)
+            while open_firsts and open_firsts[0][0] + 1 < start_num:
+                heapq.heappop(open_firsts)
+            second = (source_type, start_num, end_num, country_code)
+            for first_end_num, first_start_num, seconds in open_firsts:
+                seconds.append(second)
+            heapq.heappush(active, (end_num, second))
+            if source_type == first_source_type and \
+                    country_code == first_country_code:
+                first = (start_num, end_num,
+                         [entry[1] for entry in active])
+                pending.append(first)
+                heapq.heappush(open_firsts, (end_num, start_num, first[2]))
+        cursor.close()
+        for first in pending:
+            for row in rows(first):
+                yield row
 
     def fetch_org_by_ip_address(self, lookup_str, num_type):
-        if num_type == 'ipv4':
-            lookup_hex = '%09x' % int(int(lookup_str))
-        else:
-            lookup_hex = '%033x' % int(int(lookup_str))
+        """ Fetch all announcements containing the given address, from the
+            most specific to the least specific one. """
+        lookup_num = int(lookup_str)
+        lookup_key = self._to_key(lookup_num, num_type)
         sql = ('SELECT asn_descriptions.as_num, asn_descriptions.description, '
-               'asn_assignments.start_hex, asn_assignments.next_start_hex '
-               'FROM asn_descriptions JOIN asn_assignments ON '
+               'asn_assignments.start_num, asn_assignments.next_start_num '
+               'FROM asn_assignments JOIN asn_descriptions ON '
                'asn_assignments.as_num = asn_descriptions.as_num '
-               'WHERE num_type = ? AND start_hex <= ? AND next_start_hex > ?')
-        self.cursor.execute(sql, (num_type, lookup_hex, lookup_hex))
-        row = self.cursor.fetchall()
+               'WHERE num_type = ? AND span_bits = ? AND start_num >= ? '
+               'AND start_num <= ? AND next_start_num > ?')
+        row = []
+        for span_bits in self._get_span_classes(num_type):
+            lower_key = self._to_key(
+                max(0, lookup_num - (1 << span_bits) + 1), num_type)
+            self.cursor.execute(sql, (num_type, span_bits, lower_key,
+                                      lookup_key, lookup_key))
+            row.extend((as_num, description, self._from_key(start_key),
+                        self._from_key(next_start_key))
+                       for (as_num, description, start_key, next_start_key)
+                       in self.cursor)
         if row:
             return row
 
     def fetch_org_by_ip_range(self, lookup_start, lookup_end, num_type):
-        if num_type == 'ipv4':
-            lookup_start_hex = '%09x' % int(int(lookup_start))
-            lookup_end_hex = '%09x' % int(int(lookup_end))
-        else:
-            lookup_start_hex = '%033x' % int(int(lookup_start))
-            lookup_end_hex = '%033x' % int(int(lookup_end))
+        lookup_start_key = self._to_key(lookup_start, num_type)
+        lookup_end_key = self._to_key(lookup_end, num_type)
 
         sql = ('SELECT asn_descriptions.as_num, asn_descriptions.description, '
-               'asn_assignments.start_hex, asn_assignments.next_start_hex '
+               'asn_assignments.start_num, asn_assignments.next_start_num '
                'FROM asn_descriptions JOIN asn_assignments ON '
                'asn_assignments.as_num = asn_descriptions.as_num '
-               'WHERE num_type = ? AND start_hex >= ? AND next_start_hex <= ?')
-        self.cursor.execute(sql, (num_type, lookup_start_hex, lookup_end_hex))
-        row = self.cursor.fetchall()
+               'WHERE num_type = ? AND start_num >= ? AND next_start_num <= ?')
+        self.cursor.execute(sql, (num_type, lookup_start_key, lookup_end_key))
+        row = [(as_num, description, self._from_key(start_key),
+                self._from_key(next_start_key))
+               for (as_num, description, start_key, next_start_key)
+               in self.cursor]
         if row:
             return row
 
@@ -330,11 +1382,12 @@ class DatabaseCache(object):
         netblocks = []
         for row in records:
             try:
-                start_hex, next_start_hex, record = \
-                    int(row[0], 16), int(row[1], 16), str(row[2])
-                nb = bits - int(log(next_start_hex - start_hex, 2))
+                start_num, next_start_num, record = \
+                    self._from_key(row[0]), self._from_key(row[1]), \
+                    str(row[2])
+                nb = bits - int(log(next_start_num - start_num, 2))
                 net = ipaddr.IPNetwork("%s/%d" %
-                                       (ipaddr.IPAddress(start_hex), nb))
+                                       (ipaddr.IPAddress(start_num), nb))
                 if callable(record_filter):
                     record = record_filter(record)
             except ValueError:
@@ -365,8 +1418,8 @@ class DatabaseCache(object):
         """ Export assignments to the CSV format used to build the
             geoip-database asn lookup
         """
-        sql = ('SELECT start_hex, next_start_hex, as_num '
-               'FROM asn_assignments WHERE num_type = ? ORDER BY start_hex')
+        sql = ('SELECT start_num, next_start_num, as_num '
+               'FROM asn_assignments WHERE num_type = ? ORDER BY start_num')
         self.cursor.execute(sql, (num_type,))
         try:
             f = open(filename, 'w')
@@ -392,12 +1445,54 @@ class DatabaseCache(object):
                                     bits=ip_bits)
         f.close()
 
+    def export_mmdb(self, filename, source_type):
+        """ Export the assignments of the given source type to a MaxMind
+            DB file with the country ISO code of each network, in the
+            layout of GeoLite2-Country databases. """
+        def encode_record(country_code):
+            return MMDBWriter.encode_map([
+                ('country', MMDBWriter.encode_map([
+                    ('iso_code', MMDBWriter.encode_string(country_code))]))])
+
+        def ranges(num_type):
+            return flatten_ranges(self.fetch_ranges(num_type, source_type))
+
+        writer = MMDBWriter('Blockfinder-Country', 'Blockfinder %s country '
+                            'assignments' % source_type, encode_record)
+        writer.write(filename, ranges)
+
+    def export_asn_mmdb(self, filename):
+        """ Export the ASN assignments to a MaxMind DB file with the AS
+            number and description of each network, in the layout of
+            GeoLite2-ASN databases.  Where announcements overlap, the most
+            specific one wins.  Announcements whose origin is not a single
+            AS number, which caches imported before parse_origin_as may
+            hold as text, are left out, so that the networks they cover
+            fall back to the less specific announcements. """
+        def encode_record(as_num):
+            fields = [('autonomous_system_number',
+                       MMDBWriter.encode_uint(as_num, MMDBWriter.UINT32))]
+            description = self.fetch_asn_description(as_num)
+            if description is not None:
+                fields.append(('autonomous_system_organization',
+                               MMDBWriter.encode_string(description)))
+            return MMDBWriter.encode_map(fields)
+
+        def ranges(num_type):
+            return flatten_ranges(
+                row for row in self.fetch_asn_ranges(num_type)
+                if isinstance(row[2], (int, long)))
+
+        writer = MMDBWriter('Blockfinder-ASN', 'Blockfinder ASN '
+                            'assignments', encode_record)
+        writer.write(filename, ranges)
+
     def export_geoip(self, lookup, filename, num_type):
         """ Export assignments to the CSV format used to build the
             geoip-database package """
 
-        sql = ('SELECT start_hex, next_start_hex, country_code '
-               'FROM assignments WHERE num_type = ? ORDER BY start_hex')
+        sql = ('SELECT start_num, next_start_num, country_code '
+               'FROM assignments WHERE num_type = ? ORDER BY start_num')
         self.cursor.execute(sql, (num_type,))
 
         try:
@@ -431,20 +1526,1172 @@ class DatabaseCache(object):
         f.close()
 
 
+class RangeTable(object):
+    """ Sorted, non-overlapping number ranges with a country code each,
+        stored in flat arrays and searched with bisect.  IPv4 and ASN
+        ranges take 10 bytes each, as 32 bit start and end numbers and a
+        16 bit index into the list of country codes.  IPv6 ranges take 34
+        bytes each, because start and end numbers are split into two 64 bit
+        halves. """
+
+    def __init__(self, num_type, ranges):
+        """ Build the table from (start_num, end_num, country_code,
+            span_bits) tuples sorted by start_num, as returned by
+            DatabaseCache.fetch_ranges.  Where assignments overlap, each
+            number keeps the country code that
+            DatabaseCache.fetch_country_code returns for it, and adjacent
+            ranges with the same country code are merged. """
+        self.num_type = num_type
+        self.codes = []
+        self.code_indexes = array('H')
+        if num_type == 'ipv6':
+            self.starts_hi, self.starts_lo = array('Q'), array('Q')
+            self.ends_hi, self.ends_lo = array('Q'), array('Q')
+        else:
+            self.starts, self.ends = array(_uint32), array(_uint32)
+        code_indexes = {}
+        for start_num, end_num, country_code in flatten_ranges(ranges):
+            if country_code not in code_indexes:
+                code_indexes[country_code] = len(self.codes)
+                self.codes.append(country_code)
+            self._append(start_num, end_num, code_indexes[country_code])
+
+    def _append(self, start_num, end_num, code_index):
+        if self.num_type == 'ipv6':
+            self.starts_hi.append(start_num >> 64)
+            self.starts_lo.append(start_num & 0xffffffffffffffff)
+            self.ends_hi.append(end_num >> 64)
+            self.ends_lo.append(end_num & 0xffffffffffffffff)
+        else:
+            self.starts.append(start_num)
+            self.ends.append(end_num)
+        self.code_indexes.append(code_index)
+
+    @classmethod
+    def from_columns(cls, num_type, codes, columns):
+        """ Create a table around existing columns, in the order returned
+            by columns(), without copying them.  Columns may be arrays or
+            anything else that supports len() and indexing, like
+            memoryviews of a memory-mapped file. """
+        table = cls.__new__(cls)
+        table.num_type = num_type
+        table.codes = codes
+        if num_type == 'ipv6':
+            (table.starts_hi, table.starts_lo, table.ends_hi, table.ends_lo,
+             table.code_indexes) = columns
+        else:
+            table.starts, table.ends, table.code_indexes = columns
+        return table
+
+    def columns(self):
+        """ Return the columns of this table, country code indexes last. """
+        if self.num_type == 'ipv6':
+            return [self.starts_hi, self.starts_lo, self.ends_hi,
+                    self.ends_lo, self.code_indexes]
+        return [self.starts, self.ends, self.code_indexes]
+
+    def __len__(self):
+        return len(self.code_indexes)
+
+    def memory_footprint(self):
+        """ Return the number of bytes taken by the arrays. """
+        return sum(len(column) * column.itemsize
+                   for column in self.columns())
+
+    def lookup(self, lookup_num):
+        """ Return the country code of the range containing the given
+            number, or None. """
+        if self.num_type == 'ipv6':
+            return self._lookup_ipv6(lookup_num)
+        i = bisect_right(self.starts, lookup_num) - 1
+        if i >= 0 and lookup_num <= self.ends[i]:
+            return self.codes[self.code_indexes[i]]
+
+    def _lookup_ipv6(self, lookup_num):
+        lookup_hi = lookup_num >> 64
+        lookup_lo = lookup_num & 0xffffffffffffffff
+        starts_hi = self.starts_hi
+        first = bisect_left(starts_hi, lookup_hi)
+        last = bisect_right(starts_hi, lookup_hi, first)
+        i = bisect_right(self.starts_lo, lookup_lo, first, last) - 1
+        if i < first:
+            i = first - 1
+        if i < 0:
+            return
+        end_hi = self.ends_hi[i]
+        if end_hi > lookup_hi or (end_hi == lookup_hi and
+                                  self.ends_lo[i] >= lookup_lo):
+            return self.codes[self.code_indexes[i]]
+
+
+class MemoryLookupEngine(object):
+    """ Answer country code lookups like DatabaseCache.fetch_country_code,
+        but from RangeTables held in memory instead of with SQL queries.
+        Each table is loaded from the database cache when it's first
+        needed. """
+
+    def __init__(self, database_cache):
+        self.database_cache = database_cache
+        self.tables = {}
+        self.generations = {}
+
+    def load(self, num_type, source_type):
+        """ Load all assignments of the given number type and source type
+            from the database cache and return the new table. """
+        generation = self.database_cache.get_generation(source_type)
+        table = RangeTable(num_type, self.database_cache.fetch_ranges(
+            num_type, source_type))
+        self.tables[(num_type, source_type)] = table
+        self.generations[(num_type, source_type)] = generation
+        return table
+
+    def refresh(self):
+        """ Reload the tables of all source types that have been reimported
+            since they were loaded.  Return True if any table was
+            reloaded. """
+        reloaded = False
+        for (num_type, source_type), generation in \
+                list(self.generations.items()):
+            if self.database_cache.get_generation(source_type) != generation:
+                self.load(num_type, source_type)
+                reloaded = True
+        return reloaded
+
+    def memory_footprint(self):
+        """ Return the number of bytes taken by the arrays of all loaded
+            tables. """
+        return sum(table.memory_footprint()
+                   for table in self.tables.values())
+
+    def fetch_country_code(self, num_type, source_type, lookup_num):
+        """ Return the country code that the database cache would return
+            for the given number, number type, and source type. """
+        table = self.tables.get((num_type, source_type))
+        if table is None:
+            table = self.load(num_type, source_type)
+        return table.lookup(int(lookup_num))
+
+
+class CompiledDatabase(object):
+    """ Answer country code lookups like MemoryLookupEngine, but from a
+        compiled database file that is memory-mapped and searched in
+        place, so that opening it takes no parsing and all processes on a
+        host share its pages.
+
+        The file starts with a header of magic, format version, number of
+        tables and the generation of the database cache it was compiled
+        from, followed by one directory entry per table.  Each table
+        consists of its country codes, separated by newlines with an empty
+        line for a missing code, and the little-endian columns of a
+        RangeTable, each aligned to 8 bytes. """
+
+    file_name = "blockfinder.compiled"
+    magic = b"BLKFNDR\x00"
+    format_version = 1
+    header = struct.Struct('<8sHHIQ')
+    table_entry = struct.Struct('<8s8sQQQQ')
+    num_types = ('ipv4', 'ipv6', 'asn')
+    source_types = ('maxmind', 'rir', 'lir')
+
+    def __init__(self, path):
+        """ Map the compiled database file at the given path.  Raise
+            ValueError if it isn't a compiled database file of the
+            supported format version. """
+        self.path = path
+        self.tables = {}
+        with open(path, 'rb') as compiled_file:
+            self.mmap = mmap.mmap(compiled_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        if len(self.mmap) < self.header.size:
+            self.close()
+            raise ValueError("%s is too short" % path)
+        magic, version, table_count, _, self.generation = \
+            self.header.unpack_from(self.mmap, 0)
+        if magic != self.magic or version != self.format_version:
+            self.close()
+            raise ValueError("%s is not a compiled database of format "
+                             "version %d" % (path, self.format_version))
+        for i in range(table_count):
+            (num_type, source_type, count, codes_offset, codes_length,
+             columns_offset) = self.table_entry.unpack_from(
+                self.mmap, self.header.size + i * self.table_entry.size)
+            num_type = num_type.rstrip(b'\x00').decode('ascii')
+            source_type = source_type.rstrip(b'\x00').decode('ascii')
+            codes = self.mmap[codes_offset:codes_offset + codes_length]
+            columns = []
+            offset = columns_offset
+            for typecode in self._column_typecodes(num_type):
+                columns.append(self._column(offset, typecode, count))
+                offset += _align(count * array(typecode).itemsize)
+            codes = [code or None
+                     for code in codes.decode('utf-8').split('\n')]
+            self.tables[(num_type, source_type)] = RangeTable.from_columns(
+                num_type, codes, columns)
+
+    @staticmethod
+    def _column_typecodes(num_type):
+        if num_type == 'ipv6':
+            return ['Q', 'Q', 'Q', 'Q', 'H']
+        return [_uint32, _uint32, 'H']
+
+    def _column(self, offset, typecode, count):
+        """ Return a view of count numbers at the given offset.  The view
+            is a zero-copy memoryview where possible and an array copy
+            otherwise. """
+        length = count * array(typecode).itemsize
+        if sys.version_info[0] >= 3 and sys.byteorder == 'little':
+            return memoryview(self.mmap)[offset:offset + length].cast(
+                typecode)
+        column = array(typecode)
+        if sys.version_info[0] < 3:
+            column.fromstring(self.mmap[offset:offset + length])
+        else:
+            column.frombytes(self.mmap[offset:offset + length])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        return column
+
+    @classmethod
+    def compile(cls, database_cache, path):
+        """ Write the resolved assignments of all number types and source
+            types in the database cache to a compiled database file at the
+            given path.  The file is written next to its final location
+            and then renamed, so that processes still mapping the previous
+            file keep their consistent view of it. """
+        generation = database_cache.get_generation()
+        tables = []
+        for num_type in cls.num_types:
+            for source_type in cls.source_types:
+                table = RangeTable(num_type, database_cache.fetch_ranges(
+                    num_type, source_type))
+                if len(table) > 0:
+                    tables.append((num_type, source_type, table))
+        offset = cls.header.size + len(tables) * cls.table_entry.size
+        entries, blocks = [], []
+        for num_type, source_type, table in tables:
+            codes = '\n'.join(code or '' for code in table.codes)
+            codes = codes.encode('utf-8')
+            columns_offset = _align(offset + len(codes))
+            entries.append(cls.table_entry.pack(
+                num_type.encode('ascii'), source_type.encode('ascii'),
+                len(table), offset, len(codes), columns_offset))
+            blocks.append(codes)
+            blocks.append(b'\x00' * (columns_offset - offset - len(codes)))
+            offset = columns_offset
+            for column in table.columns():
+                if sys.byteorder != 'little':
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                data = column.tostring() if sys.version_info[0] < 3 \
+                    else column.tobytes()
+                blocks.append(data)
+                blocks.append(b'\x00' * (_align(len(data)) - len(data)))
+                offset += _align(len(data))
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as compiled_file:
+            compiled_file.write(cls.header.pack(
+                cls.magic, cls.format_version, len(entries), 0, generation))
+            for block in entries + blocks:
+                compiled_file.write(block)
+        if is_win32 and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+        return path
+
+    def fetch_country_code(self, num_type, source_type, lookup_num):
+        """ Return the country code that the database cache returned for
+            the given number, number type, and source type when this file
+            was compiled. """
+        table = self.tables.get((num_type, source_type))
+        if table is not None:
+            return table.lookup(int(lookup_num))
+
+    def close(self):
+        """ Release the columns and unmap the file. """
+        for table in self.tables.values():
+            for column in table.columns():
+                if isinstance(column, memoryview):
+                    column.release()
+        self.tables = {}
+        self.mmap.close()
+
+
+class MMDBWriter(object):
+    """ Write MaxMind DB files, as read by libmaxminddb, from sorted and
+        non-overlapping (start_num, end_num, value) ranges.
+
+        The search tree is an IPv6 tree with IPv4 networks in ::/96 and an
+        alias from ::ffff:0:0/96 to them.  It is built in two passes over
+        the ranges, each of which holds only the current path through the
+        tree in memory: the first counts nodes and encodes every distinct
+        value once into the data section, and the second writes nodes in
+        post-order to a temporary file.  Nodes are numbered in reverse
+        post-order, so that the root is node 0 and the nodes can be copied
+        into the database file backwards. """
+
+    metadata_marker = b'\xab\xcd\xefMaxMind.com'
+    STRING, UINT16, UINT32, MAP, UINT64, ARRAY = 2, 5, 6, 7, 9, 11
+    ipv4_alias = 0xffff << 32
+    copy_nodes = 65536
+
+    def __init__(self, database_type, description, encode_record):
+        """ Create a writer for databases of the given type and English
+            description.  encode_record is called once for every distinct
+            value and returns its encoding for the data section. """
+        self.database_type = database_type
+        self.description = description
+        self.encode_record = encode_record
+        self.data = []
+        self.data_offsets = {}
+        self.data_size = 0
+
+    @staticmethod
+    def encode_control(type_number, size):
+        """ Return the control byte(s) of a field of the given type and
+            payload size. """
+        if type_number > 7:
+            control, extended = 0, struct.pack('B', type_number - 7)
+        else:
+            control, extended = type_number << 5, b''
+        if size < 29:
+            return struct.pack('B', control | size) + extended
+        if size < 285:
+            size_bytes = struct.pack('B', size - 29)
+            control |= 29
+        elif size < 65821:
+            size_bytes = struct.pack('>H', size - 285)
+            control |= 30
+        else:
+            size_bytes = struct.pack('>I', size - 65821)[1:]
+            control |= 31
+        return struct.pack('B', control) + extended + size_bytes
+
+    @classmethod
+    def encode_string(cls, value):
+        value = value.encode('utf-8')
+        return cls.encode_control(cls.STRING, len(value)) + value
+
+    @classmethod
+    def encode_uint(cls, value, type_number):
+        length = (value.bit_length() + 7) // 8
+        payload = binascii.unhexlify('%0*x' % (length * 2, value)) \
+            if length else b''
+        return cls.encode_control(type_number, length) + payload
+
+    @classmethod
+    def encode_map(cls, fields):
+        """ Encode a map from (key, encoded value) pairs. """
+        return cls.encode_control(cls.MAP, len(fields)) + b''.join(
+            cls.encode_string(key) + value for key, value in fields)
+
+    @classmethod
+    def encode_array(cls, items):
+        """ Encode an array of encoded items. """
+        return cls.encode_control(cls.ARRAY, len(items)) + b''.join(items)
+
+    def _blocks(self, ranges):
+        """ Yield (start_num, host_bits, record) tuples for the CIDR blocks
+            covering the given IPv4 and IPv6 ranges, in the order of the
+            IPv6 tree.  IPv6 ranges below ::1:0:0:0 are left out, because
+            they would overlap IPv4 networks or their alias. """
+        has_ipv4 = False
+        for num_type in ('ipv4', 'ipv6'):
+            if num_type == 'ipv6' and has_ipv4:
+                yield self.ipv4_alias, 32, 'ipv4'
+            for start_num, end_num, value in ranges(num_type):
+                if num_type == 'ipv6':
+                    if end_num < 1 << 48:
+                        continue
+                    start_num = max(start_num, 1 << 48)
+                else:
+                    has_ipv4 = True
+                record = ('data', self._data_offset(value))
+                while start_num <= end_num:
+                    host_bits = (start_num & -start_num).bit_length() - 1 \
+                        if start_num else 128
+                    host_bits = min(host_bits,
+                                    (end_num - start_num + 1).bit_length() - 1)
+                    yield start_num, host_bits, record
+                    start_num += 1 << host_bits
+
+    def _data_offset(self, value):
+        offset = self.data_offsets.get(value)
+        if offset is None:
+            data = self.encode_record(value)
+            offset = self.data_offsets[value] = self.data_size
+            self.data.append(data)
+            self.data_size += len(data)
+        return offset
+
+    def _build(self, ranges, emit_node):
+        """ Walk the search tree of the given ranges and call emit_node
+            with the records of each node in post-order. """
+        self._pending = self._blocks(ranges)
+        self._block = next(self._pending, None)
+        self._ipv4_record = None
+        self._emit_node = emit_node
+        self._nodes = 0
+        left = self._subtree(0, 127)
+        right = self._subtree(1 << 127, 127)
+        self._emit(left, right)
+        return self._nodes
+
+    def _subtree(self, base, host_bits):
+        """ Return the record for the network of the given base and size,
+            consuming all blocks inside it. """
+        block = self._block
+        if block is None or block[0] >= base + (1 << host_bits):
+            record = None
+        elif block[0] == base and block[1] == host_bits:
+            self._block = next(self._pending, None)
+            record = block[2]
+            if record == 'ipv4':
+                record = self._ipv4_record
+        else:
+            left = self._subtree(base, host_bits - 1)
+            right = self._subtree(base + (1 << (host_bits - 1)),
+                                  host_bits - 1)
+            record = ('node', self._emit(left, right))
+        if base == 0 and host_bits == 32:
+            self._ipv4_record = record
+        return record
+
+    def _emit(self, left, right):
+        self._emit_node(left, right)
+        self._nodes += 1
+        return self._nodes - 1
+
+    def write(self, filename, ranges, record_size=24):
+        """ Write a database file with the ranges returned by
+            ranges(num_type) for num_type "ipv4" and "ipv6".  ranges is
+            called twice per number type and must return the same ranges
+            both times.  Records are 24, 28, or 32 bits wide, whichever is
+            the smallest one that is at least record_size bits and large
+            enough for all records. """
+        node_count = self._build(ranges, lambda left, right: None)
+        largest_record = node_count + 16 + self.data_size
+        if record_size <= 24 and largest_record < 1 << 24:
+            record_size = 24
+        elif record_size <= 28 and largest_record < 1 << 28:
+            record_size = 28
+        else:
+            record_size = 32
+        node_size = record_size // 4
+
+        def record_value(record):
+            if record is None:
+                return node_count
+            if record[0] == 'node':
+                return node_count - 1 - record[1]
+            return node_count + 16 + record[1]
+
+        def pack_node(left, right):
+            left, right = record_value(left), record_value(right)
+            if record_size == 24:
+                return struct.pack('>I', left)[1:] + \
+                    struct.pack('>I', right)[1:]
+            if record_size == 28:
+                return struct.pack('>I', left & 0xffffff)[1:] + \
+                    struct.pack('B', (left >> 24) << 4 | right >> 24) + \
+                    struct.pack('>I', right & 0xffffff)[1:]
+            return struct.pack('>II', left, right)
+
+        temp_filename = filename + '.tmp'
+        nodes_filename = filename + '.nodes'
+        with open(nodes_filename, 'wb') as nodes_file:
+            self._build(ranges, lambda left, right:
+                        nodes_file.write(pack_node(left, right)))
+        metadata = self.encode_map([
+            ('binary_format_major_version',
+             self.encode_uint(2, self.UINT16)),
+            ('binary_format_minor_version',
+             self.encode_uint(0, self.UINT16)),
+            ('build_epoch', self.encode_uint(int(time.time()), self.UINT64)),
+            ('database_type', self.encode_string(self.database_type)),
+            ('description', self.encode_map([
+                ('en', self.encode_string(self.description))])),
+            ('ip_version', self.encode_uint(6, self.UINT16)),
+            ('languages', self.encode_array([self.encode_string('en')])),
+            ('node_count', self.encode_uint(node_count, self.UINT32)),
+            ('record_size', self.encode_uint(record_size, self.UINT16))])
+        with open(nodes_filename, 'rb') as nodes_file:
+            with open(temp_filename, 'wb') as mmdb_file:
+                position = node_count
+                while position > 0:
+                    count = min(position, self.copy_nodes)
+                    position -= count
+                    nodes_file.seek(position * node_size)
+                    chunk = nodes_file.read(count * node_size)
+                    mmdb_file.write(b''.join(
+                        chunk[i:i + node_size] for i in
+                        range(len(chunk) - node_size, -1, -node_size)))
+                mmdb_file.write(b'\x00' * 16)
+                for data in self.data:
+                    mmdb_file.write(data)
+                mmdb_file.write(self.metadata_marker)
+                mmdb_file.write(metadata)
+        os.remove(nodes_filename)
+        if is_win32 and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp_filename, filename)
+
+
+class PrefixTrie(object):
+    """ Path-compressed binary radix trie over the announced prefixes of
+        one address family, each with the AS number announcing it.  Nodes
+        are stored in flat arrays: the network and prefix length of each
+        node, its two children, and its AS number if a prefix ends there.
+        Node 0 is the root, so 0 also stands for a missing child. """
+
+    def __init__(self, num_type):
+        self.num_type = num_type
+        self.bits = 128 if num_type == 'ipv6' else 32
+        self.prefix_lens = array('B')
+        self.children = (array(_uint32), array(_uint32))
+        self.has_as_num = array('B')
+        self.as_nums = array(_uint32)
+        if num_type == 'ipv6':
+            self.nets_hi, self.nets_lo = array('Q'), array('Q')
+        else:
+            self.nets = array(_uint32)
+        self._add_node(0, 0)
+        self._path = [0]
+
+    def columns(self):
+        """ Return the columns of this trie in a fixed order. """
+        columns = [self.prefix_lens, self.children[0], self.children[1],
+                   self.has_as_num, self.as_nums]
+        if self.num_type == 'ipv6':
+            return columns + [self.nets_hi, self.nets_lo]
+        return columns + [self.nets]
+
+    def __len__(self):
+        return len(self.prefix_lens)
+
+    def _add_node(self, net, prefix_len):
+        self.prefix_lens.append(prefix_len)
+        self.children[0].append(0)
+        self.children[1].append(0)
+        self.has_as_num.append(0)
+        self.as_nums.append(0)
+        if self.num_type == 'ipv6':
+            self.nets_hi.append(net >> 64)
+            self.nets_lo.append(net & 0xffffffffffffffff)
+        else:
+            self.nets.append(net)
+        return len(self.prefix_lens) - 1
+
+    def _net(self, node):
+        if self.num_type == 'ipv6':
+            return self.nets_hi[node] << 64 | self.nets_lo[node]
+        return self.nets[node]
+
+    def _bit(self, num, position):
+        return num >> (self.bits - 1 - position) & 1
+
+    def insert(self, net, prefix_len, as_num):
+        """ Add the prefix of the given network and length, replacing the
+            AS number of a prefix that was added before.  The search
+            starts at the deepest node containing the prefix on the path
+            to the previously added prefix, so that adding prefixes in
+            order of their networks takes only a few steps each. """
+        path = self._path
+        while True:
+            node = path[-1]
+            node_prefix_len = self.prefix_lens[node]
+            if node_prefix_len <= prefix_len and not \
+                    (self._net(node) ^ net) >> (self.bits - node_prefix_len):
+                break
+            path.pop()
+        while True:
+            node_prefix_len = self.prefix_lens[node]
+            if node_prefix_len == prefix_len:
+                break
+            bit = self._bit(net, node_prefix_len)
+            child = self.children[bit][node]
+            if not child:
+                child = self._add_node(net, prefix_len)
+                self.children[bit][node] = child
+                node = child
+                path.append(node)
+                break
+            child_net = self._net(child)
+            child_prefix_len = self.prefix_lens[child]
+            common = min(self.bits - (child_net ^ net).bit_length(),
+                         child_prefix_len, prefix_len)
+            if common == child_prefix_len:
+                node = child
+                path.append(node)
+                continue
+            mask = ~((1 << (self.bits - common)) - 1)
+            parent = self._add_node(net & mask, common)
+            self.children[bit][node] = parent
+            self.children[self._bit(child_net, common)][parent] = child
+            path.append(parent)
+            if common == prefix_len:
+                node = parent
+                break
+            leaf = self._add_node(net, prefix_len)
+            self.children[self._bit(net, common)][parent] = leaf
+            node = leaf
+            path.append(node)
+            break
+        self.has_as_num[node] = 1
+        self.as_nums[node] = as_num
+
+    def covering(self, lookup_num):
+        """ Return (as_num, start_num, end_num) tuples of all prefixes
+            containing the given number, from the most specific to the
+            least specific one.  This follows a single path from the root,
+            so it takes at most one step per bit. """
+        result = []
+        node = 0
+        while True:
+            prefix_len = self.prefix_lens[node]
+            host_bits = self.bits - prefix_len
+            net = self._net(node)
+            if (net ^ lookup_num) >> host_bits:
+                break
+            if self.has_as_num[node]:
+                result.append((self.as_nums[node], net,
+                               net + (1 << host_bits) - 1))
+            if not host_bits:
+                break
+            node = self.children[self._bit(lookup_num, prefix_len)][node]
+            if not node:
+                break
+        result.reverse()
+        return result
+
+    def longest_match(self, lookup_num):
+        """ Return the (as_num, start_num, end_num) tuple of the most
+            specific prefix containing the given number, or None. """
+        result = self.covering(lookup_num)
+        if result:
+            return result[0]
+
+
+class ASNPrefixIndex(object):
+    """ Prefix tries over the ASN assignments in the database cache,
+        answering the same questions as
+        DatabaseCache.fetch_org_by_ip_address.  The tries are saved to a
+        file in the cache directory together with the generation of the
+        ASN assignments they were built from, and are only rebuilt after
+        the ASN assignments have been reimported. """
+
+    file_name = "asn_prefixes.trie"
+    magic = b"BLKFTRIE"
+    format_version = 1
+    header = struct.Struct('<8sHHIQ')
+    num_types = ('ipv4', 'ipv6')
+
+    def __init__(self, database_cache, path):
+        self.database_cache = database_cache
+        self.path = path
+        self.tries = None
+        self.generation = None
+
+    def load(self):
+        """ Load the tries from their file if it is up to date, or build
+            them from the database cache and save them otherwise. """
+        generation = self.database_cache.get_generation('asn_assignments')
+        if self.tries is not None and self.generation == generation:
+            return
+        if not self._read(generation):
+            self.tries = dict((num_type, self._build(num_type))
+                              for num_type in self.num_types)
+            self.generation = generation
+            try:
+                self._write()
+            except (IOError, OSError):
+                pass
+
+    def _build(self, num_type):
+        """ Build the trie of the given number type.  Announcements whose
+            origin is not a single AS number, which caches imported before
+            parse_origin_as may hold as text, are left out. """
+        trie = PrefixTrie(num_type)
+        for start_num, end_num, as_num, span_bits in \
+                self.database_cache.fetch_asn_ranges(num_type):
+            if not isinstance(as_num, (int, long)):
+                continue
+            while start_num <= end_num:
+                host_bits = (start_num & -start_num).bit_length() - 1 \
+                    if start_num else trie.bits
+                host_bits = min(host_bits,
+                                (end_num - start_num + 1).bit_length() - 1)
+                trie.insert(start_num, trie.bits - host_bits, as_num)
+                start_num += 1 << host_bits
+        return trie
+
+    def _read(self, generation):
+        """ Read the tries from their file and return True if it exists and
+            was built from the given generation of ASN assignments. """
+        try:
+            trie_file = open(self.path, 'rb')
+        except IOError:
+            return False
+        with trie_file:
+            header = trie_file.read(self.header.size)
+            if len(header) < self.header.size:
+                return False
+            magic, version, trie_count, _, file_generation = \
+                self.header.unpack(header)
+            if magic != self.magic or version != self.format_version or \
+                    file_generation != generation:
+                return False
+            tries = {}
+            try:
+                for num_type in self.num_types:
+                    node_count, = struct.unpack('<Q', trie_file.read(8))
+                    trie = PrefixTrie(num_type)
+                    for column in trie.columns():
+                        del column[:]
+                        column.fromfile(trie_file, node_count)
+                        if sys.byteorder != 'little':
+                            column.byteswap()
+                    tries[num_type] = trie
+            except (EOFError, ValueError, struct.error):
+                return False
+        self.tries = tries
+        self.generation = generation
+        return True
+
+    def _write(self):
+        """ Write the tries to a temporary file and rename it to their
+            file, so that other processes never read a partial file. """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as trie_file:
+            trie_file.write(self.header.pack(
+                self.magic, self.format_version, len(self.num_types), 0,
+                self.generation))
+            for num_type in self.num_types:
+                trie = self.tries[num_type]
+                trie_file.write(struct.pack('<Q', len(trie)))
+                for column in trie.columns():
+                    if sys.byteorder != 'little':
+                        column = array(column.typecode, column)
+                        column.byteswap()
+                    column.tofile(trie_file)
+        if is_win32 and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def fetch_org_by_ip_address(self, lookup_num, num_type):
+        """ Fetch all announcements containing the given address, from the
+            most specific to the least specific one, as (as_num,
+            description, start_num, next_start_num) tuples.  Like in
+            DatabaseCache.fetch_org_by_ip_address, announcements by AS
+            numbers without description are left out, and None is
+            returned if nothing is found. """
+        self.load()
+        row = []
+        for as_num, start_num, end_num in \
+                self.tries[num_type].covering(int(lookup_num)):
+            description = self.database_cache.fetch_asn_description(as_num)
+            if description is not None:
+                row.append((as_num, description, start_num, end_num + 1))
+        if row:
+            return row
+
+
+class DecompressionBackend(object):
+    """ A way of decompressing files whose names end with the given
+        suffix, either by running an external command that writes the
+        decompressed data to its standard output, or by calling a function
+        that opens the file like gzip.open. """
+
+    def __init__(self, name, suffix, command=None, open_function=None):
+        self.name = name
+        self.suffix = suffix
+        self.command = command
+        self.open_function = open_function
+
+    def available(self):
+        """ Return True if the command can be found on the PATH or the
+            open function could be imported. """
+        if self.command is None:
+            return self.open_function is not None
+        return self._find_command() is not None
+
+    def _find_command(self):
+        file_name = self.command[0] + ('.exe' if is_win32 else '')
+        for directory in os.environ.get('PATH', '').split(os.pathsep):
+            command_path = os.path.join(directory, file_name)
+            if os.path.isfile(command_path) and \
+                    os.access(command_path, os.X_OK):
+                return command_path
+
+    def open(self, path):
+        """ Open the given file for reading decompressed bytes. """
+        if self.command is None:
+            return self.open_function(path)
+        return CommandReader([self._find_command()] + self.command[1:] +
+                             [path])
+
+
+class CommandReader(object):
+    """ A file-like object that reads the standard output of a command,
+        raising IOError at the end of the output if the command failed. """
+
+    def __init__(self, command):
+        self.command = command
+        with open(os.devnull, 'wb') as devnull:
+            self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                            stderr=devnull)
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data or size is None or size < 0:
+            self._check_status()
+        return data
+
+    def __iter__(self):
+        for line in self.process.stdout:
+            yield line
+        self._check_status()
+
+    def _check_status(self):
+        if self.process.wait() != 0:
+            raise IOError('%s exited with status %d' %
+                          (' '.join(self.command), self.process.returncode))
+
+    def close(self):
+        """ Stop the command if it is still running. """
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Backends for reading compressed files, in order of preference.  Backends
+# that are not installed are skipped, and the standard library is the last
+# resort for every suffix.
+decompression_backends = [
+    DecompressionBackend('isal', '.gz', open_function=getattr(
+        igzip, 'open', None)),
+    DecompressionBackend('zlib-ng', '.gz', open_function=getattr(
+        gzip_ng, 'open', None)),
+    DecompressionBackend('pigz', '.gz', command=['pigz', '-dc']),
+    DecompressionBackend('gzip', '.gz', open_function=gzip.open),
+    DecompressionBackend('lbzip2', '.bz2', command=['lbzip2', '-dc']),
+    DecompressionBackend('bz2', '.bz2', open_function=bz2.BZ2File),
+    DecompressionBackend('zstd', '.zst', command=['zstd', '-dcq']),
+]
+
+
+def open_compressed(path, backend_name=None):
+    """ Open the given file for reading decompressed bytes, using the named
+        backend if it handles files like this one and is available, or else
+        the first available backend for the suffix of the file name.  Files
+        without a known suffix are opened as they are. """
+    backends = [backend for backend in decompression_backends
+                if path.endswith(backend.suffix) and backend.available()]
+    if backend_name is not None and backend_name not in \
+            [backend.name for backend in decompression_backends]:
+        raise ValueError('Unknown decompression backend %s' % backend_name)
+    for backend in backends:
+        if backend.name == backend_name:
+            return backend.open(path)
+    if backends:
+        return backends[0].open(path)
+    return open(path, 'rb')
+
+
+class ResultCache(object):
+    """ An on-disk cache of the results of expensive queries, which are
+        lists of strings.  Every result is stored in its own file in a
+        directory below the cache directory, together with the kind of
+        query, its parameters, and the generation of the database cache
+        it was computed from, so that results are recomputed as soon as
+        any importer replaces data.  Reading a result marks it as recently
+        used, and the least recently used results are evicted once all
+        files take up more than max_bytes.  A max_bytes of 0 disables the
+        cache. """
+
+    dir_name = "results"
+    max_bytes = 64 * 1024 * 1024
+
+    def __init__(self, database_cache, path, max_bytes=None):
+        self.database_cache = database_cache
+        self.path = path
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+    def _file_path(self, kind, params):
+        key = repr((kind, tuple(params))).encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def fetch(self, kind, params, compute):
+        """ Return an iterator over the result of the given kind of query
+            with the given parameters.  The result is read from its file if
+            it was stored for the current generation, or computed by
+            calling compute with the parameters otherwise, in which case it
+            is stored while it is being iterated over. """
+        if not self.max_bytes:
+            return iter(compute(*params))
+        header = {'kind': kind, 'params': list(params),
+                  'generation': self.database_cache.get_generation()}
+        file_path = self._file_path(kind, params)
+        result = self._read(file_path, header)
+        if result is not None:
+            return iter(result)
+        return self._store(file_path, header, compute(*params))
+
+    def _read(self, file_path, header):
+        """ Return the result stored in the given file if its header
+            matches the given one, and mark it as recently used. """
+        try:
+            with open(file_path, 'rb') as result_file:
+                if json.loads(result_file.readline().decode('utf-8')) != \
+                        header:
+                    return None
+                result = [json.loads(line.decode('utf-8'))
+                          for line in result_file]
+            os.utime(file_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return result
+
+    def _store(self, file_path, header, result):
+        """ Yield the given result while writing it to a temporary file,
+            and rename that to the given file once the result is complete,
+            so that other processes never read a partial result.  If the
+            file cannot be replaced, the result is simply not stored. """
+        temp_path = '%s.%d.tmp' % (file_path, os.getpid())
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            result_file = open(temp_path, 'wb')
+        except (IOError, OSError):
+            for item in result:
+                yield item
+            return
+        try:
+            with result_file:
+                result_file.write(json.dumps(header).encode('utf-8') + b'\n')
+                for item in result:
+                    result_file.write(json.dumps(item).encode('utf-8') +
+                                      b'\n')
+                    yield item
+            try:
+                if is_win32 and os.path.exists(file_path):
+                    os.remove(file_path)
+                os.rename(temp_path, file_path)
+            except OSError:
+                pass
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used results until all results take
+            up no more than max_bytes. """
+        try:
+            entries = []
+            for file_name in os.listdir(self.path):
+                if file_name.endswith('.tmp'):
+                    continue
+                stat = os.stat(os.path.join(self.path, file_name))
+                entries.append((stat.st_mtime, stat.st_size, file_name))
+            entries.sort()
+            total_bytes = sum(entry[1] for entry in entries)
+            for _, size, file_name in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                os.remove(os.path.join(self.path, file_name))
+                total_bytes -= size
+        except OSError:
+            pass
+
+
+class ProgressReporter(object):
+    """ A progress bar, or a counter if the total is unknown, that any
+        number of threads advance, and that is redrawn on one line of the
+        terminal at most redraws_per_second times per second.  The width
+        of the terminal is read once, and nothing is drawn unless the
+        stream is a terminal. """
+
+    redraws_per_second = 4
+
+    def __init__(self, unit='bytes', stream=None, columns=None):
+        self.unit = unit
+        self.stream = stream or sys.stdout
+        self.enabled = self.stream.isatty()
+        self.columns = columns or self._terminal_columns()
+        self.lock = threading.Lock()
+        self.expected = 0
+        self.done = 0
+        self.started = time.time()
+        self.drawn = None
+
+    @staticmethod
+    def _terminal_columns():
+        try:
+            return shutil.get_terminal_size().columns
+        except AttributeError:
+            # Python 2 has no get_terminal_size.
+            return int(os.environ.get('COLUMNS', 80))
+
+    def expect(self, count):
+        """ Add the given number to the total that is expected. """
+        with self.lock:
+            self.expected += count
+
+    def advance(self, count):
+        """ Add the given number to what has been done so far, and redraw
+            if it has not been drawn recently. """
+        with self.lock:
+            self.done += count
+            if not self.enabled:
+                return
+            now = time.time()
+            if self.drawn is None or \
+                    now - self.drawn >= 1.0 / self.redraws_per_second:
+                self._draw(now)
+
+    def finish(self):
+        """ Draw the final state and move to the next line, if anything
+            was drawn before. """
+        with self.lock:
+            if self.drawn is not None:
+                self._draw(time.time())
+                self.stream.write("\n")
+                self.stream.flush()
+
+    def _draw(self, now):
+        self.drawn = now
+        seconds_elapsed = now - self.started or 1
+        if self.unit == 'bytes':
+            caption = "%.2f K/s" % (self.done / 1024.0 / seconds_elapsed)
+        else:
+            caption = "%d %s, %d %s/s" % (self.done, self.unit,
+                                         self.done / seconds_elapsed,
+                                         self.unit)
+        if self.expected > 0:
+            width = self.columns - 4 - len(caption)
+            done_width = int(min(float(self.done) / self.expected, 1.0) *
+                             width)
+            line = "[%s>%s] %s" % ("=" * done_width,
+                                   "." * (width - done_width), caption)
+        else:
+            line = caption
+        self.stream.write(line + ("\r" if is_win32 else "\x1b[G"))
+        self.stream.flush()
+
+
+class DownloadMetadata(object):
+    """ What is known about the files that were downloaded to the cache
+        directory: the ETag and Last-Modified headers they were served
+        with, their size, modification time, and SHA-256 hash, the
+        published checksum they were verified against, if any, and whether
+        they have been imported since.  Metadata of all files is stored
+        in one JSON file in the cache directory, and metadata of files that
+        were changed or removed since they were downloaded is ignored. """
+
+    file_name = "downloads.json"
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, self.file_name)
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as metadata_file:
+                return json.loads(metadata_file.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, file_path, unchanged=True):
+        """ Return the metadata of the given file as a dictionary, or None
+            if there is none, or if the file was changed since and unchanged
+            is True. """
+        with self.lock:
+            metadata = self._load().get(os.path.basename(file_path))
+        if metadata is None or not unchanged:
+            return metadata
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        if metadata.get('size') != stat.st_size or \
+                metadata.get('mtime') != int(stat.st_mtime):
+            return None
+        return metadata
+
+    def update(self, file_path, **fields):
+        """ Update the metadata of the given file with the given fields and
+            its current size and modification time. """
+        stat = os.stat(file_path)
+        with self.lock:
+            all_metadata = self._load()
+            metadata = all_metadata.setdefault(os.path.basename(file_path),
+                                               {})
+            metadata.update(fields)
+            metadata.update(size=stat.st_size, mtime=int(stat.st_mtime))
+            self._store(all_metadata)
+
+    def remove(self, file_path):
+        """ Forget the metadata of the given file. """
+        with self.lock:
+            all_metadata = self._load()
+            if all_metadata.pop(os.path.basename(file_path), None):
+                self._store(all_metadata)
+
+    def _store(self, all_metadata):
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temp_path, 'wb') as metadata_file:
+            metadata_file.write(json.dumps(all_metadata, indent=1,
+                                           sort_keys=True).encode('utf-8'))
+        if is_win32 and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+
 class DownloaderParser(object):
 
     def __init__(self, cache_dir, database_cache, user_agent,
-                 verbose=False):
+                 verbose=False, jobs=1, decompression=None, resume=False):
+        """ Create a downloader and parser that stores files in the given
+            cache directory.  If jobs is more than 1, RIR and LIR files are
+            parsed by that many worker processes.  Compressed files are read
+            with the named decompression backend if given, see
+            open_compressed.  If resume is True, LIR and ASN assignment
+            imports of the same files that did not complete are resumed
+            after their last committed batch. """
         self.cache_dir = cache_dir
         self.database_cache = database_cache
         self.user_agent = user_agent
         self.verbose = verbose
+        self.jobs = jobs
+        self.decompression = decompression
+        self.resume = resume
+        self.download_metadata = DownloadMetadata(cache_dir)
+
+    # Number of bytes of an RIR file that worker processes parse at a time.
+    rir_chunk_size = 4 * 1024 * 1024
+
+    # Number of decompressed bytes of an LIR file that are parsed at a time.
+    lir_chunk_size = 4 * 1024 * 1024
 
     MAXMIND_URLS = """
         http://geolite.maxmind.com/download/geoip/database/GeoIPCountryCSV.zip
         http://geolite.maxmind.com/download/geoip/database/GeoIPv6.csv.gz
     """
 
+    # Suffixes of the checksum files that registries publish next to their
+    # delegation files, in order of preference.  Checksums are MD5 or
+    # SHA-256 digests, or any other that hashlib knows, and ".sha256" can
+    # be added for registries that publish SHA-256 checksums.
+    rir_checksum_suffixes = ('.md5', )
+
     RIR_URLS = """
         https://ftp.arin.net/pub/stats/arin/delegated-arin-extended-latest
         https://ftp.ripe.net/pub/stats/ripencc/delegated-ripencc-latest
@@ -469,22 +2716,43 @@ class DownloaderParser(object):
          'oix-full-snapshot-latest.dat.bz2'),
     ]
 
+    # Number of files that are downloaded at the same time, in total and
+    # from the same host.
+    download_threads = 8
+    downloads_per_host = 2
+
+    # Number of times a download is attempted, resuming where the previous
+    # attempt was interrupted.
+    download_attempts = 3
+
+    # Number of bytes that downloads read and write at a time.
+    download_buffer_size = 1024 * 1024
+
+    # Number of rows between updates of the progress of imports.
+    progress_rows = 10000
+
     def download_maxmind_files(self):
         """ Download all LIR delegation urls. """
-        for maxmind_url in self.MAXMIND_URLS.split():
-            self._download_to_cache_dir(maxmind_url)
+        return self.download_files(self.MAXMIND_URLS.split())
 
     def download_rir_files(self):
-        """ Download all RIR delegation files including md5 checksum. """
-        for rir_url in self.RIR_URLS.split():
-            rir_md5_url = rir_url + '.md5'
-            self._download_to_cache_dir(rir_url)
-            self._download_to_cache_dir(rir_md5_url)
+        """ Download the checksum files of all RIR delegation files first,
+            and then the RIR delegation files, which only replace the cached
+            files if their checksums match, see download_files. """
+        rir_urls = self.RIR_URLS.split()
+        downloaded_urls = self.download_files([
+            rir_url + suffix for rir_url in rir_urls
+            for suffix in self.rir_checksum_suffixes])
+        checksums = {}
+        for rir_url in rir_urls:
+            checksum = self._read_published_checksum(rir_url)
+            if checksum is not None:
+                checksums[rir_url] = checksum
+        return downloaded_urls + self.download_files(rir_urls, checksums)
 
     def download_lir_files(self):
         """ Download all LIR delegation urls. """
-        for lir_url in self.LIR_URLS.split():
-            self._download_to_cache_dir(lir_url)
+        return self.download_files(self.LIR_URLS.split())
 
     def download_country_code_file(self):
         """ Download and save the latest semicolon-separated open country
@@ -498,75 +2766,258 @@ class DownloaderParser(object):
 
     def download_asn_assignment_files(self):
         """ Download and save the latest routing snapshots. """
-        for assignment_url in self.ASN_ASSIGNMENT_URLS:
-            self._download_to_cache_dir(assignment_url)
+        return self.download_files(self.ASN_ASSIGNMENT_URLS)
+
+    def needs_import(self, urls):
+        """ Return True unless the locally cached files of all given urls
+            were imported since they were last downloaded, so that imports
+            can be skipped when no file changed. """
+        for url in urls:
+            file_path = os.path.join(self.cache_dir, url.split('/')[-1])
+            metadata = self.download_metadata.get(file_path)
+            if metadata is None or not metadata.get('imported'):
+                return True
+        return False
+
+    def _mark_imported(self, urls):
+        for url in urls:
+            file_path = os.path.join(self.cache_dir, url.split('/')[-1])
+            if self.download_metadata.get(file_path) is not None:
+                self.download_metadata.update(file_path, imported=True)
+
+    def download_files(self, urls, checksums=None):
+        """ Download the given urls to the local cache directory in up to
+            download_threads threads, with no more than downloads_per_host
+            of them fetching from the same host at a time, and show one
+            progress bar for all of them if standard output is a terminal.
+            Files whose url is a key of the given checksums dictionary are
+            only stored if they match the (algorithm, hex digest) tuple it
+            maps to.  Return the urls whose files were downloaded anew,
+            leaving out those that were not modified and those that
+            failed. """
+        checksums = checksums or {}
+        self._make_cache_dir()
+        pending = list(urls)
+        host_downloads = {}
+        downloaded_urls = []
+        progress = ProgressReporter()
+        condition = threading.Condition()
+
+        def next_url():
+            """ Remove and return the first pending url whose host is not
+                busy, waiting for one if necessary, or None if there are no
+                more pending urls. """
+            with condition:
+                while pending:
+                    for url in pending:
+                        host = urlparse(url).netloc
+                        if host_downloads.get(host, 0) < \
+                                self.downloads_per_host:
+                            pending.remove(url)
+                            host_downloads[host] = \
+                                host_downloads.get(host, 0) + 1
+                            return url
+                    condition.wait()
 
-    def _download_to_cache_dir(self, url):
-        """ Fetch a resource (with progress bar) and store contents to the
-            local cache directory under the file name given in the URL. """
+        def download():
+            while True:
+                url = next_url()
+                if url is None:
+                    return
+                try:
+                    if self._download_to_cache_dir(url, progress,
+                                                   checksums.get(url)):
+                        downloaded_urls.append(url)
+                except (IOError, OSError) as err:
+                    print(("An error occurred while downloading:\n\t%s\n\t%s"
+                           % (url, str(err))))
+                finally:
+                    with condition:
+                        host_downloads[urlparse(url).netloc] -= 1
+                        condition.notify_all()
+
+        threads = [threading.Thread(target=download) for _ in
+                   range(min(self.download_threads, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.25)
+        progress.finish()
+        return [url for url in urls if url in downloaded_urls]
+
+    def _make_cache_dir(self):
         if not os.path.exists(self.cache_dir):
             if self.verbose:
                 print("Initializing the cache directory...")
             os.mkdir(self.cache_dir)
+
+    def _download_to_cache_dir(self, url, progress=None, checksum=None):
+        """ Fetch a resource and store contents to the local cache directory
+            under the file name given in the URL, see _fetch_to_cache_dir.
+            Downloads that are interrupted are resumed up to
+            download_attempts times, and left in place to be resumed by the
+            next download of the same url if they still don't complete.
+            Return True if the resource was fetched, or False if it was not
+            modified or could not be fetched. """
+        self._make_cache_dir()
+        for attempt in range(self.download_attempts):
+            try:
+                return self._fetch_to_cache_dir(url, progress, checksum)
+            except (IOError, OSError, HTTPException) as err:
+                error = err
+        msg = "An error occurred while attempting to cache file from:"
+        print(("%s\n\t%s\n\t%s" % (msg, url, str(error))))
+        return False
+
+    def _fetch_to_cache_dir(self, url, progress=None, checksum=None):
+        """ Fetch a resource into a partial file next to its file in the
+            cache directory, hashing it on the way, and rename the partial
+            file once it is complete and matches the given (algorithm, hex
+            digest) checksum, if any.  Partial files that don't match are
+            removed.  If a partial file was left behind, only the rest of
+            the resource is requested, provided it has not changed since;
+            servers that don't support ranges send all of it again.  If the
+            file was downloaded before and has not changed since, the
+            server is asked to send it only if it was modified, see
+            DownloadMetadata.  Progress is added to the given
+            ProgressReporter, or shown in a progress bar of its own if
+            there is none.  Return True if the resource was fetched, or
+            False if it was not modified or could not be fetched, and raise
+            an exception if the download was interrupted. """
         filename = url.split('/')[-1]
+        file_path = os.path.join(self.cache_dir, filename)
+        part_path = file_path + '.part'
         if self.verbose:
             print(url)
         req = Request(url)
         if self.user_agent:
             req.add_header('User-Agent', self.user_agent)
+        metadata = self.download_metadata.get(file_path) or {}
+        if metadata.get('etag'):
+            req.add_header('If-None-Match', metadata['etag'])
+        if metadata.get('last_modified'):
+            req.add_header('If-Modified-Since', metadata['last_modified'])
+        part_bytes = 0
+        if os.path.exists(part_path):
+            part_metadata = self.download_metadata.get(part_path,
+                                                       unchanged=False)
+            validator = part_metadata and (part_metadata.get('etag') or
+                                           part_metadata.get('last_modified'))
+            if validator:
+                part_bytes = os.path.getsize(part_path)
+                req.add_header('Range', 'bytes=%d-' % part_bytes)
+                req.add_header('If-Range', validator)
         # TODO Allow use of a proxy.
         # req.set_proxy(host, type)
         try:
             fetcher = urlopen(req)
+        except HTTPError as err:
+            if err.code == 304:
+                if self.verbose:
+                    print(("%s has not been modified." % filename))
+                os.utime(file_path, None)
+                self.download_metadata.update(file_path)
+                if os.path.exists(part_path):
+                    # The partial file belongs to a download that is no
+                    # longer needed, so it must not be resumed later.
+                    os.remove(part_path)
+                    self.download_metadata.remove(part_path)
+                return False
+            if err.code == 416 and part_bytes:
+                # The partial file is no part of the current resource.
+                os.remove(part_path)
+                return self._fetch_to_cache_dir(url, progress, checksum)
+            msg = "An error occurred while attempting to cache file from:"
+            print(("%s\n\t%s\n\t%s" % (msg, url, str(err))))
+            return False
         except URLError as err:
             msg = "An error occurred while attempting to cache file from:"
             print(("%s\n\t%s\n\t%s" % (msg, url, str(err))))
-            return
+            return False
+        hashes = [hashlib.sha256()]
+        if checksum is not None and checksum[0] != 'sha256':
+            hashes.append(hashlib.new(checksum[0]))
+        if fetcher.getcode() == 206:
+            if not fetcher.headers.get('Content-Range', '').startswith(
+                    'bytes %d-' % part_bytes):
+                fetcher.close()
+                os.remove(part_path)
+                raise IOError("%s sent an unexpected range" % url)
+            with open(part_path, 'rb') as part_file:
+                for chunk in iter(lambda: part_file.read(
+                        self.download_buffer_size), b''):
+                    for file_hash in hashes:
+                        file_hash.update(chunk)
+            output_file = open(part_path, 'ab')
+        else:
+            part_bytes = 0
+            output_file = open(part_path, 'wb')
+        self.download_metadata.update(
+            part_path, etag=fetcher.headers.get('ETag'),
+            last_modified=fetcher.headers.get('Last-Modified'))
+        own_progress = progress is None
+        if own_progress:
+            progress = ProgressReporter()
         length_header = fetcher.headers.get("Content-Length")
         expected_bytes = -1
         if length_header:
             expected_bytes = int(length_header)
-            print(("Fetching %d kilobytes" %
-                   round(float(expected_bytes / 1024), 2)))
-        download_started = time.time()
-        output_file = open(os.path.join(self.cache_dir, filename), "wb")
-        received_bytes, seconds_elapsed = 0, 0
-        while True:
-            seconds_elapsed = time.time() - download_started
-            if expected_bytes >= 0:
-                self._update_progress_bar(received_bytes, expected_bytes,
-                                          seconds_elapsed)
-            chunk = fetcher.read(1024)
-            if len(chunk) == 0:
-                if expected_bytes >= 0 and received_bytes != expected_bytes:
-                    print(("Expected %s bytes, only received %s" %
-                           (expected_bytes, received_bytes)))
-                print("")
-                break
-            received_bytes += len(chunk)
-            output_file.write(chunk)
-        output_file.close()
-
-    def _update_progress_bar(self, received_bytes, expected_bytes,
-                             seconds_elapsed):
-        """ Write a progress bar to the console. """
-        if is_win32:
-            rows = 100  # use some WinCon function for these?
-            columns = 80  # but not really important.
-            EOL = "\r"
-        else:
-            rows, columns = list(map(int, os.popen('stty size', 'r'
-                                                   ).read().split()))
-            EOL = "\x1b[G"
-        if seconds_elapsed == 0:
-            seconds_elapsed = 1
-        percent_done = float(received_bytes) / float(expected_bytes)
-        caption = "%.2f K/s" % (received_bytes / 1024 / seconds_elapsed)
-        width = columns - 4 - len(caption)
-        sys.stdout.write("[%s>%s] %s%s" % (
-            "=" * int(percent_done * width),
-            "." * (width - int(percent_done * width)), caption, EOL))
-        sys.stdout.flush()
+            if own_progress:
+                print(("Fetching %d kilobytes" %
+                       round(float(expected_bytes / 1024), 2)))
+            progress.expect(expected_bytes)
+        received_bytes = 0
+        try:
+            while True:
+                chunk = fetcher.read(self.download_buffer_size)
+                if len(chunk) == 0:
+                    break
+                received_bytes += len(chunk)
+                progress.advance(len(chunk))
+                output_file.write(chunk)
+                for file_hash in hashes:
+                    file_hash.update(chunk)
+        finally:
+            output_file.close()
+            fetcher.close()
+            if own_progress:
+                progress.finish()
+        if expected_bytes >= 0 and received_bytes != expected_bytes:
+            raise IOError("Expected %s bytes from %s, only received %s" %
+                          (expected_bytes, url, received_bytes))
+        fields = {'etag': fetcher.headers.get('ETag'),
+                  'last_modified': fetcher.headers.get('Last-Modified'),
+                  'sha256': hashes[0].hexdigest(), 'imported': False}
+        if checksum is not None:
+            computed_checksum = hashes[-1].hexdigest()
+            if computed_checksum != checksum[1]:
+                os.remove(part_path)
+                self.download_metadata.remove(part_path)
+                raise IOError("The computed %s checksum of %s, %s, does "
+                              "*not* match the provided checksum %s!" %
+                              (checksum[0], url, computed_checksum,
+                               checksum[1]))
+            fields['checksum'] = '%s:%s' % checksum
+        if is_win32 and os.path.exists(file_path):
+            os.remove(file_path)
+        os.rename(part_path, file_path)
+        self.download_metadata.remove(part_path)
+        self.download_metadata.update(file_path, **fields)
+        return True
+
+    def _report_progress(self, rows):
+        """ Yield the given rows while showing how many have been imported
+            and how fast. """
+        progress = ProgressReporter('rows')
+        row_count = 0
+        for row_count, row in enumerate(rows, 1):
+            if not row_count % self.progress_rows:
+                progress.advance(self.progress_rows)
+            yield row
+        progress.advance(row_count % self.progress_rows)
+        progress.finish()
 
     def check_rir_file_mtimes(self):
         """ Return True if the mtime of any RIR file in our cache directory
@@ -583,44 +3034,54 @@ class DownloaderParser(object):
         return False
 
     def verify_rir_files(self):
-        """ Compute md5 checksums of all RIR files, compare them to the
-            provided .md5 files, and return True if the two checksums match,
-            or False otherwise. """
+        """ Compare the checksums of all RIR files to those in the checksum
+            files published next to them, and return True if all checksums
+            match, or False otherwise.  Files whose checksum was verified
+            while they were downloaded are not read again. """
+        verified = True
         for rir_url in self.RIR_URLS.split():
             rir_path = os.path.join(self.cache_dir,
                                     rir_url.split('/')[-1])
-            rir_md5_path = os.path.join(self.cache_dir,
-                                        rir_url.split('/')[-1] + '.md5')
-            if not os.path.exists(rir_md5_path) or \
-                    not os.path.exists(rir_path):
+            checksum = self._read_published_checksum(rir_url)
+            if checksum is None or not os.path.exists(rir_path):
                 continue
-            rir_md5_file = open(rir_md5_path, 'r')
-            expected_checksum = rir_md5_file.read()
-            rir_md5_file.close()
-            if "=" in expected_checksum:
-                expected_checksum = expected_checksum.split("=")[-1].strip()
-            elif expected_checksum == "":
-                if self.verbose:
-                    print("No checksum... skipping verification...")
+            metadata = self.download_metadata.get(rir_path) or {}
+            if metadata.get('checksum') == '%s:%s' % checksum:
                 continue
-            else:
-                regex = re.compile("[a-f0-9]{32}")
-                regres = regex.findall(expected_checksum)
-                if len(regres) > 1:
-                    print("Error: mutiple checksum found")
-                elif len(regres) < 1:
-                    print("Error: no checksum found")
-                else:
-                    expected_checksum = regres[0]
-            computed_checksum = ""
-            rir_file = open(rir_path, 'rb')
-            rir_data = rir_file.read()
-            rir_file.close()
-            computed_checksum = str(hashlib.md5(rir_data).hexdigest())
+            algorithm, expected_checksum = checksum
+            computed_hash = hashlib.new(algorithm)
+            with open(rir_path, 'rb') as rir_file:
+                for chunk in iter(lambda: rir_file.read(
+                        self.download_buffer_size), b''):
+                    computed_hash.update(chunk)
+            computed_checksum = computed_hash.hexdigest()
             if expected_checksum != computed_checksum:
-                print(("The computed md5 checksum of %s, %s, does *not* "
+                print(("The computed %s checksum of %s, %s, does *not* "
                        "match the provided checksum %s!" %
-                       (rir_path, computed_checksum, expected_checksum)))
+                       (algorithm, rir_path, computed_checksum,
+                        expected_checksum)))
+                verified = False
+        return verified
+
+    def _read_published_checksum(self, url):
+        """ Return the (algorithm, hex digest) tuple of the first locally
+            cached checksum file of the given url, see
+            rir_checksum_suffixes, or None if there is none. """
+        for suffix in self.rir_checksum_suffixes:
+            checksum_path = os.path.join(self.cache_dir,
+                                         url.split('/')[-1] + suffix)
+            if not os.path.exists(checksum_path):
+                continue
+            with open(checksum_path, 'rb') as checksum_file:
+                text = checksum_file.read().decode('utf-8', 'ignore')
+            checksum = parse_checksum(text)
+            if checksum is not None:
+                return checksum
+            if text.strip():
+                print(("Error: no single checksum found in %s" %
+                       checksum_path))
+            elif self.verbose:
+                print("No checksum... skipping verification...")
 
     def parse_maxmind_files(self, maxmind_urls=None):
         """ Parse locally cached MaxMind files and insert assignments to the
@@ -628,7 +3089,11 @@ class DownloaderParser(object):
             assignments. """
         if not maxmind_urls:
             maxmind_urls = self.MAXMIND_URLS.split()
-        self.database_cache.delete_assignments('maxmind')
+        self.database_cache.replace_assignments(
+            self._report_progress(self._iter_maxmind_rows(maxmind_urls)),
+            'maxmind')
+
+    def _iter_maxmind_rows(self, maxmind_urls):
         for maxmind_url in maxmind_urls:
             maxmind_path = os.path.join(self.cache_dir,
                                         maxmind_url.split('/')[-1])
@@ -639,27 +3104,30 @@ class DownloaderParser(object):
                 maxmind_zip_path = zipfile.ZipFile(maxmind_path)
                 for contained_filename in maxmind_zip_path.namelist():
                     content = maxmind_zip_path.read(contained_filename)
-                    self._parse_maxmind_content(content, 'maxmind',
-                                                'maxmind')
+                    for row in self._parse_maxmind_content(content,
+                                                           'maxmind'):
+                        yield row
                 maxmind_zip_path.close()
             elif maxmind_path.endswith('.gz'):
-                gzip_file = gzip.open(maxmind_path)
+                gzip_file = open_compressed(maxmind_path, self.decompression)
                 content = gzip_file.read()
-                self._parse_maxmind_content(content, 'maxmind', 'maxmind')
                 gzip_file.close()
-        self.database_cache.commit_changes()
+                for row in self._parse_maxmind_content(content, 'maxmind'):
+                    yield row
 
     def import_maxmind_file(self, maxmind_path):
-        self.database_cache.delete_assignments(maxmind_path)
         if not os.path.exists(maxmind_path):
             print(("Unable to find %s." % maxmind_path))
             return
-        with open(maxmind_path, 'r') as f:
+        with open(maxmind_path, 'rb') as f:
             content = f.read()
-        self._parse_maxmind_content(content, maxmind_path, maxmind_path)
-        self.database_cache.commit_changes()
+        self.database_cache.replace_assignments(
+            self._parse_maxmind_content(content, maxmind_path),
+            maxmind_path)
 
-    def _parse_maxmind_content(self, content, source_type, source_name):
+    def _parse_maxmind_content(self, content, source_name):
+        """ Yield (start_num, end_num, num_type, country_code, source_name)
+            rows from the content of a MaxMind GeoIP CSV file. """
         keys = ['start_str', 'end_str', 'start_num', 'end_num',
                 'country_code', 'country_name']
         for line in content.decode('utf-8').split('\n'):
@@ -671,123 +3139,158 @@ class DownloaderParser(object):
             start_num = int(entry['start_num'])
             end_num = int(entry['end_num'])
             country_code = str(entry['country_code'])
-            start_ipaddr = ipaddr.ip_address(entry['start_str'])
-            if isinstance(start_ipaddr, ipaddr.IPv4Address):
-                num_type = 'ipv4'
-            else:
+            if ':' in entry['start_str']:
                 num_type = 'ipv6'
-            self.database_cache.insert_assignment(
-                start_num, end_num,
-                num_type,
-                country_code,
-                source_type,
-                source_name)
+            else:
+                num_type = 'ipv4'
+            yield (start_num, end_num, num_type, country_code, source_name)
 
-    def parse_rir_files(self, rir_urls=None):
+    def parse_rir_files(self, rir_urls=None, incremental=False):
         """ Parse locally cached RIR files and insert assignments to the local
-            database cache, overwriting any existing RIR assignments. """
+            database cache, overwriting any existing RIR assignments.  If
+            incremental is True, only assignments that changed since the
+            last import are written, and the numbers of inserted, updated,
+            and deleted assignments are returned. """
         if not rir_urls:
             rir_urls = self.RIR_URLS.split()
-        self.database_cache.delete_assignments('rir')
-        keys = "registry country_code type start value date status"
+        if self.jobs > 1:
+            rows = self._iter_rir_rows_in_parallel(rir_urls)
+        else:
+            rows = self._iter_rir_rows(rir_urls)
+        rows = self._report_progress(rows)
+        if incremental:
+            changes = self.database_cache.update_assignments(rows, 'rir')
+        else:
+            self.database_cache.replace_assignments(rows, 'rir')
+            changes = None
+        self._mark_imported(rir_urls)
+        return changes
+
+    def _find_rir_paths(self, rir_urls):
+        rir_paths = []
         for rir_url in rir_urls:
             rir_path = os.path.join(self.cache_dir,
                                     rir_url.split('/')[-1])
             if not os.path.exists(rir_path):
                 print(("Unable to find %s." % rir_path))
                 continue
-            rir_file = open(rir_path, 'r')
-            for line in rir_file:
-                if line.startswith("#"):
-                    continue
-                entry = dict((k, v) for k, v in
-                             zip(keys.split(), line.strip().split("|")))
-                source_name = str(entry['registry'])
-                country_code = str(entry['country_code'])
-                if source_name.replace(
-                        ".", "", 1).isdigit() or country_code == "*":
-                    continue
-                num_type = entry['type']
-                if num_type == 'asn':
-                    start_num = end_num = int(entry['start'])
-                elif num_type == 'ipv4':
-                    start_num = int(ipaddr.IPv4Address(entry['start']))
-                    end_num = start_num + int(entry['value']) - 1
-                elif num_type == 'ipv6':
-                    network_str = entry['start'] + '/' + entry['value']
-                    network_ipaddr = ipaddr.IPv6Network(network_str)
-                    start_num = int(network_ipaddr.network_address)
-                    end_num = int(network_ipaddr.broadcast_address)
-                self.database_cache.insert_assignment(
-                    start_num,
-                    end_num,
-                    num_type,
-                    country_code,
-                    'rir',
-                    source_name)
+            rir_paths.append(rir_path)
+        return rir_paths
+
+    def _iter_rir_rows(self, rir_urls):
+        for rir_path in self._find_rir_paths(rir_urls):
+            rir_file = open(rir_path, 'rb')
+            for row in parse_rir_lines(rir_file):
+                yield row
             rir_file.close()
-        self.database_cache.commit_changes()
+
+    def _iter_rir_rows_in_parallel(self, rir_urls):
+        """ Split the RIR files into chunks of lines, parse them in jobs
+            worker processes, and yield the rows of all chunks in the same
+            order as _iter_rir_rows, no matter which chunks are parsed
+            first. """
+        chunks = []
+        for rir_path in self._find_rir_paths(rir_urls):
+            size = os.path.getsize(rir_path)
+            chunks.extend((rir_path, start, start + self.rir_chunk_size)
+                          for start in range(0, size, self.rir_chunk_size))
+        for rows in self._map_in_workers(_parse_rir_chunk, chunks):
+            for row in rows:
+                yield row
+
+    def _map_in_workers(self, function, tasks):
+        """ Call the given function on every task in jobs worker processes
+            and yield the results in the order of the tasks.  Tasks are read
+            from a separate thread while the results are consumed, but at
+            most twice as many as there are workers ahead of the results,
+            so that tasks can be read lazily from large files. """
+        window = threading.Semaphore(self.jobs * 2)
+        stopped = threading.Event()
+
+        def read_tasks():
+            for task in tasks:
+                window.acquire()
+                if stopped.is_set():
+                    return
+                yield task
+
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            for result in pool.imap(function, read_tasks()):
+                window.release()
+                yield result
+            pool.close()
+        finally:
+            stopped.set()
+            window.release()
+            pool.terminate()
+            pool.join()
 
     def parse_lir_files(self, lir_urls=None):
         """ Parse locally cached LIR files and insert assignments to the local
             database cache, overwriting any existing LIR assignments. """
         if not lir_urls:
             lir_urls = self.LIR_URLS.split()
-        self.database_cache.delete_assignments('lir')
+        self.database_cache.replace_assignments(
+            self._report_progress(self._iter_lir_rows(lir_urls)), 'lir',
+            self._describe_input_files(lir_urls), self.resume)
+        self._mark_imported(lir_urls)
+
+    def _describe_input_files(self, urls):
+        """ Return a string that identifies the locally cached files of the
+            given urls by name, size, and modification time, so that only
+            imports of unchanged files are resumed. """
+        descriptions = []
+        for url in urls:
+            file_name = url.split('/')[-1]
+            path = os.path.join(self.cache_dir, file_name)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                descriptions.append('%s %d %d' % (file_name, stat.st_size,
+                                                  int(stat.st_mtime)))
+        return '\n'.join(descriptions)
+
+    def _iter_lir_rows(self, lir_urls):
+        """ Decompress the LIR files into chunks of whole RPSL objects,
+            parse the chunks in jobs worker processes, or in this process
+            if there is only one job, and yield the rows of all chunks in
+            order. """
+        chunks = ((chunk, self.verbose)
+                  for chunk in self._iter_lir_chunks(lir_urls))
+        if self.jobs > 1:
+            results = self._map_in_workers(_parse_lir_chunk, chunks)
+        else:
+            results = (_parse_lir_chunk(chunk) for chunk in chunks)
+        for rows in results:
+            for row in rows:
+                yield row
+
+    def _iter_lir_chunks(self, lir_urls):
+        """ Yield the decompressed contents of the LIR files in chunks of
+            about lir_chunk_size bytes that are cut at blank lines, so that
+            every chunk holds whole RPSL objects. """
         for lir_url in lir_urls:
             lir_path = os.path.join(self.cache_dir,
                                     lir_url.split('/')[-1])
             if not os.path.exists(lir_path):
                 print(("Unable to find %s." % lir_path))
                 continue
-            if lir_path.endswith('.gz'):
-                lir_file = gzip.open(lir_path)
-            else:
-                lir_file = open(lir_path)
-            start_num = 0
-            end_num = 0
-            country_code = ""
-            entry = False
-            num_type = ""
-            for line in lir_file:
-                line = line.decode('utf-8', 'ignore').replace("\n", "")
-                if line == "":
-                    entry = False
-                    start_num, end_num, country_code, num_type = 0, 0, "", ""
-                elif not entry and "inetnum:" in line:
-                    try:
-                        line = line.replace("inetnum:", "").strip()
-                        start_str = line.split("-")[0].strip()
-                        end_str = line.split("-")[1].strip()
-                        start_num = int(ipaddr.IPv4Address(start_str))
-                        end_num = int(ipaddr.IPv4Address(end_str))
-                        entry = True
-                        num_type = 'ipv4'
-                    except Exception as e:
-                        if self.verbose:
-                            print((repr(e), line))
-                elif not entry and "inet6num:" in line:
-                    try:
-                        network_str = line.replace("inet6num:", "").strip()
-                        network_ipaddr = ipaddr.IPv6Network(network_str)
-                        start_num = int(network_ipaddr.network_address)
-                        end_num = int(network_ipaddr.broadcast_address)
-                        entry = True
-                        num_type = 'ipv6'
-                    except Exception as e:
-                        if self.verbose:
-                            print((repr(e), line))
-                elif entry and "country:" in line:
-                    country_code = line.replace("country:", "").strip()
-                    self.database_cache.insert_assignment(
-                        start_num,
-                        end_num,
-                        num_type,
-                        country_code,
-                        'lir',
-                        'ripencc')
+            lir_file = open_compressed(lir_path, self.decompression)
+            rest = b''
+            while True:
+                data = lir_file.read(self.lir_chunk_size)
+                if not data:
+                    break
+                data = rest + data
+                cut = data.rfind(b'\n\n')
+                if cut < 0:
+                    rest = data
+                    continue
+                yield data[:cut]
+                rest = data[cut + 2:]
+            if rest:
+                yield rest
             lir_file.close()
-        self.database_cache.commit_changes()
 
     def parse_asn_description_file(self, asn_description_url=None):
         """ Parse locally cached ASN to Description mappings and insert
@@ -795,27 +3298,36 @@ class DownloaderParser(object):
             to Name assignments. """
         if not asn_description_url:
             asn_description_url = self.ASN_DESCRIPTION_URL
-        self.database_cache.delete_asn_descriptions()
         asn_description_path = os.path.join(self.cache_dir,
                                             asn_description_url.split('/')[-1])
         asn_descriptions = open(asn_description_path)
+        self.database_cache.replace_asn_descriptions(self._report_progress(
+            self._iter_asn_description_rows(asn_descriptions)))
+        asn_descriptions.close()
+
+    def _iter_asn_description_rows(self, asn_descriptions):
         source_name = 'cidr_report'
         skiplen = len('<a href="/cgi-bin/as-report?as=AS')
         for line in asn_descriptions:
             try:
                 asn, _name = line[skiplen:].split('&view=2.0')
                 description = _name.split('</a>')[1].strip()
-                self.database_cache.insert_asn_description(asn, source_name,
-                                                           description)
+                yield (asn, source_name, str(description))
             except ValueError:
                 pass
-        self.database_cache.commit_changes()
-        asn_descriptions.close()
 
     def parse_asn_assignment_files(self, asn_assignment_urls=None):
         if not asn_assignment_urls:
             asn_assignment_urls = self.ASN_ASSIGNMENT_URLS
-        self.database_cache.delete_asn_assignments()
+        # XXX add support for other sources too
+        self.database_cache.replace_asn_assignments(
+            self._report_progress(
+                self._iter_asn_assignment_rows(asn_assignment_urls)),
+            'bgp_snapshot', self._describe_input_files(asn_assignment_urls),
+            self.resume)
+        self._mark_imported(asn_assignment_urls)
+
+    def _iter_asn_assignment_rows(self, asn_assignment_urls):
         for asn_assignment_url in asn_assignment_urls:
             asn_assignment_path = os.path.join(
                 self.cache_dir,
@@ -824,43 +3336,54 @@ class DownloaderParser(object):
                 print(("Unable to find %s." % asn_assignment_path))
                 continue
             if asn_assignment_path.endswith('.bz2'):
-                b = bz2.BZ2File(asn_assignment_path)
+                b = open_compressed(asn_assignment_path, self.decompression)
                 for line in b:
-                    line = str(line)
+                    line = line.decode('utf-8', 'ignore')
                     if line.startswith("*"):
                         l = line.split()
                         netblock, path = l[1], l[6:-1]
-                        nexthop, metric, locprf, weight = l[
-                            2], l[3], l[4], l[5]
-
-                        network = ipaddr.IPNetwork(netblock)
-                        # XXX add support for other sources too
-                        source_type = 'bgp_snapshot'
-                        source_name = 'routeviews'
-
-                        if isinstance(network, ipaddr.IPv4Network):
+                        if not path:
+                            continue
+                        as_num = parse_origin_as(path[-1])
+                        if as_num is None:
+                            continue
+                        network = ipaddr.ip_network(netblock)
+                        if network.version == 4:
                             num_type = "ipv4"
                         else:
-                            num_type = "ivp6"
-
-                        self.database_cache.insert_asn_assignment(
-                            int(network.network),
-                            int(network.broadcast),
-                            num_type,
-                            path[-1],
-                            source_type,
-                            source_name)
+                            num_type = "ipv6"
+                        yield (int(network.network_address),
+                               int(network.broadcast_address),
+                               num_type,
+                               as_num,
+                               'routeviews')
+                b.close()
 
 
 class Lookup(object):
 
-    def __init__(self, cache_dir, database_cache, verbose=False):
+    def __init__(self, cache_dir, database_cache, verbose=False,
+                 lookup_engine=None):
         self.cache_dir = cache_dir
         self.database_cache = database_cache
         self.verbose = verbose
+        self.lookup_engine = lookup_engine
+        self.asn_prefix_index = ASNPrefixIndex(
+            database_cache, os.path.join(cache_dir, ASNPrefixIndex.file_name))
+        self.result_cache = ResultCache(
+            database_cache, os.path.join(cache_dir, ResultCache.dir_name))
         self.map_co = None
         self.build_country_code_dictionary()
 
+    def fetch_country_code(self, num_type, source_type, lookup_num):
+        """ Return the country code for the given number from the lookup
+            engine if there is one, or else from the database cache. """
+        if self.lookup_engine is not None:
+            return self.lookup_engine.fetch_country_code(
+                num_type, source_type, lookup_num)
+        return self.database_cache.fetch_country_code(
+            num_type, source_type, lookup_num)
+
     def build_country_code_dictionary(self):
         """ Return a dictionary mapping country name to the country
             code. """
@@ -903,7 +3426,7 @@ class Lookup(object):
     def lookup_ipv6_address(self, lookup_ipaddr):
         print(("Reverse lookup for: " + str(lookup_ipaddr)))
         for source_type in ['maxmind', 'rir', 'lir']:
-            cc = self.database_cache.fetch_country_code(
+            cc = self.fetch_country_code(
                 'ipv6',
                 source_type,
                 int(lookup_ipaddr))
@@ -915,15 +3438,14 @@ class Lookup(object):
 
     def lookup_ipv4_address(self, lookup_ipaddr):
         print(("Reverse lookup for: " + str(lookup_ipaddr)))
-        maxmind_cc = self.database_cache.fetch_country_code('ipv4', 'maxmind',
-                                                            int(lookup_ipaddr))
+        maxmind_cc = self.fetch_country_code('ipv4', 'maxmind',
+                                             int(lookup_ipaddr))
         if maxmind_cc:
             print(('MaxMind country code:', maxmind_cc))
             maxmind_cn = self.get_name_from_country_code(maxmind_cc)
             if maxmind_cn:
                 print(('MaxMind country name:', maxmind_cn))
-        rir_cc = self.database_cache.fetch_country_code('ipv4', 'rir',
-                                                        int(lookup_ipaddr))
+        rir_cc = self.fetch_country_code('ipv4', 'rir', int(lookup_ipaddr))
         if rir_cc:
             print(('RIR country code:', rir_cc))
             rir_cn = self.get_name_from_country_code(rir_cc)
@@ -931,8 +3453,7 @@ class Lookup(object):
                 print(('RIR country name:', rir_cn))
         else:
             print('Not found in RIR db')
-        lir_cc = self.database_cache.fetch_country_code('ipv4', 'lir',
-                                                        int(lookup_ipaddr))
+        lir_cc = self.fetch_country_code('ipv4', 'lir', int(lookup_ipaddr))
         if lir_cc:
             print(('LIR country code:', lir_cc))
             lir_cn = self.get_name_from_country_code(lir_cc)
@@ -958,7 +3479,7 @@ class Lookup(object):
             print(("'%s' is not a valid IP address." % lookup_str))
 
     def asn_lookup(self, asn):
-        asn_cc = self.database_cache.fetch_country_code('asn', 'rir', asn)
+        asn_cc = self.fetch_country_code('asn', 'rir', asn)
         if asn_cc:
             print(("AS country code: %s" % asn_cc))
             asn_cn = self.get_name_from_country_code(asn_cc)
@@ -968,38 +3489,32 @@ class Lookup(object):
             print(("AS%s not found!" % asn))
 
     def fetch_rir_blocks_by_country(self, request, country):
-        if request == "asn":
-            return [str(start_num) for (start_num, end_num) in
-                    self.database_cache.fetch_assignments(request, country)]
-        if request != "ipv4" and request != "ipv6":
+        if request != "asn" and request != "ipv4" and request != "ipv6":
             return []
-        seen = set()
-        result = []
-        for (start_num, end_num) in \
-                self.database_cache.fetch_assignments(request, country):
-            start_ipaddr = ipaddr.ip_address(start_num)
-            end_ipaddr = ipaddr.ip_address(end_num)
-            for block in (str(x) for x in
-                          ipaddr.summarize_address_range(start_ipaddr,
-                                                         end_ipaddr)):
-                if block in seen:
-                    continue
-                seen.add(block)
-                result.append(block)
-        return result
+        return list(self.result_cache.fetch(
+            'blocks', (request, country),
+            self.database_cache.fetch_country_cidrs))
 
     def lookup_countries_in_different_source(self, first_country_code):
         """ Look up all assignments matching the given country code, then
             look up to which country code(s) the same number ranges are
             assigned in other source types.  Print out the result showing
             similarities and differences. """
-        print((("\nLegend:\n"
+        for line in self.result_cache.fetch(
+                'compare', (first_country_code, ),
+                self._compare_with_different_sources):
+            print(line)
+
+    def _compare_with_different_sources(self, first_country_code):
+        """ Yield the lines printed by
+            lookup_countries_in_different_source. """
+        yield (("\nLegend:\n"
                "  '<' = found assignment range with country code '%s'\n"
                "  '>' = overlapping assignment range with same country code\n"
                "  '*' = overlapping assignment range, first conflict\n"
                "  '#' = overlapping assignment range, second conflict and "
                "beyond\n  ' ' = neighboring assignment range") % (
-            first_country_code, )))
+            first_country_code, ))
         results = self.database_cache.fetch_country_blocks_in_other_sources(
             first_country_code)
         prev_first_source_type = ''
@@ -1009,11 +3524,11 @@ class Lookup(object):
                 second_source_type, second_start_num, second_end_num,
                 second_country_code, num_type) in results:
             if first_source_type != prev_first_source_type:
-                print(("\nAssignments in '%s':" % (first_source_type, )))
+                yield "\nAssignments in '%s':" % (first_source_type, )
             prev_first_source_type = first_source_type
             if first_start_num != prev_first_start_num:
                 cur_second_country_codes = []
-                print("")
+                yield ""
             prev_first_start_num = first_start_num
             marker = ''
             if second_end_num >= first_start_num and \
@@ -1040,18 +3555,18 @@ class Lookup(object):
                 second_range = "AS%d-%d" % (second_start_num, second_end_num)
             else:
                 second_range = "AS%d" % (second_start_num, )
-            print(("%1s %s %s %s" % (marker, second_country_code, second_range,
-                                    second_source_type, )))
+            yield "%1s %s %s %s" % (marker, second_country_code,
+                                     second_range, second_source_type, )
 
     def _get_network_string_from_range(self, end, start, bits=32):
-        start, end = int(start, 16), int(end, 16)
         netbits = bits - int(log(end - start, 2))
-        return ipaddr.IPNetwork("%s/%d" % (ipaddr.IPAddress(start), netbits))
+        return ipaddr.ip_network("%s/%d" % (ipaddr.ip_address(start),
+                                            netbits))
 
     def lookup_org_by_ip(self, lookup_str):
         """ Return the ASN and AS Description by IP """
         try:
-            lookup_ipaddr = ipaddr.IPAddress(lookup_str)
+            lookup_ipaddr = ipaddr.ip_address(lookup_str)
             if isinstance(lookup_ipaddr, ipaddr.IPv4Address):
                 num_type = 'ipv4'
                 len_bits = 32
@@ -1060,24 +3575,33 @@ class Lookup(object):
                 len_bits = 128
             else:
                 raise ValueError
-            rs = self.database_cache.fetch_org_by_ip_address(
-                lookup_ipaddr, num_type)
-            for r in rs:
-                network = self._get_network_string_from_range(
-                    r[3], r[2], bits=len_bits)
-                print(("%s in %s announced by AS%s - %s" %
-                      (lookup_str, network, r[0], r[1])))
         except ValueError:
             print(("'%s' is not a valid IP address." % lookup_str))
-        except TypeError:
+            return
+        rs = self.asn_prefix_index.fetch_org_by_ip_address(
+            lookup_ipaddr, num_type)
+        if rs is None:
             print(("Did not find any matching announcements containing %s." %
                   lookup_str))
+            return
+        for r in rs:
+            network = self._get_network_string_from_range(
+                r[3], r[2], bits=len_bits)
+            print(("%s in %s announced by AS%s - %s" %
+                  (lookup_str, network, r[0], r[1])))
 
     def lookup_org_by_range(self, start_range, end_range):
+        for line in self.result_cache.fetch(
+                'org_by_range', (start_range, end_range),
+                self._org_by_range_lines):
+            print(line)
+
+    def _org_by_range_lines(self, start_range, end_range):
+        """ Yield the lines printed by lookup_org_by_range. """
         output_str = "%s announced by AS%s - %s"
         try:
-            a = ipaddr.IPAddress(start_range)
-            b = ipaddr.IPAddress(end_range)
+            a = ipaddr.ip_address(start_range)
+            b = ipaddr.ip_address(end_range)
             if isinstance(a, ipaddr.IPv4Address) and isinstance(
                     b, ipaddr.IPv4Address):
                 num_type = 'ipv4'
@@ -1093,12 +3617,191 @@ class Lookup(object):
             for r in rs:
                 network = self._get_network_string_from_range(
                     r[3], r[2], bits=len_bits)
-                print((output_str % (network, r[0], r[1])))
+                yield output_str % (network, r[0], r[1])
         except ValueError:
-            print(("%s %s is not a valid IP range." % (start_range, end_range)))
+            yield "%s %s is not a valid IP range." % (start_range, end_range)
         except TypeError:
-            print(("Did not find any matching announcements in range %s %s." %
-                  (start_range, end_range)))
+            yield ("Did not find any matching announcements in range %s %s." %
+                   (start_range, end_range))
+
+
+def parse_origin_as(token):
+    """ Return the origin AS number of a route from the last token of its
+        AS path, or None if the route has no single origin.  Aggregated
+        routes may end in an AS set such as "{4788,38044}"; a set of one
+        AS is taken as that AS, and routes originated by a larger set are
+        left out, because none of its members originated the whole
+        route. """
+    if token.startswith('{') and token.endswith('}'):
+        token = token[1:-1]
+    if not token.isdigit():
+        return None
+    return int(token)
+
+
+def parse_rir_lines(lines):
+    """ Parse the lines of an RIR delegated file, given as bytes, and yield
+        (start_num, end_num, num_type, country_code, source_name) rows for
+        its assignments.  Comments, the version line, summary lines, and
+        lines of other record types are skipped without converting any of
+        their fields.  Addresses are converted with integer arithmetic,
+        and registries and country codes are decoded once per
+        distinct value.  Like in earlier versions, only the first number
+        of ASN ranges is kept. """
+    strings = {}
+    for line in lines:
+        fields = line.split(b'|', 5)
+        if len(fields) < 6:
+            continue
+        registry, country_code, num_type, start, value, _ = fields
+        if country_code == b'*' or registry[:1] == b'#':
+            continue
+        if num_type == b'ipv4':
+            num_type = 'ipv4'
+            a, b, c, d = start.split(b'.')
+            start_num = int(a) << 24 | int(b) << 16 | int(c) << 8 | int(d)
+            end_num = start_num + int(value) - 1
+        elif num_type == b'asn':
+            num_type = 'asn'
+            start_num = end_num = int(start)
+        elif num_type == b'ipv6':
+            num_type = 'ipv6'
+            host_bits = 128 - int(value)
+            start_num = _ipv6_bytes_to_int(start) >> host_bits << host_bits
+            end_num = start_num | ((1 << host_bits) - 1)
+        else:
+            continue
+        try:
+            source_name = strings[registry]
+        except KeyError:
+            source_name = strings[registry] = registry.decode('ascii')
+        try:
+            country_code = strings[country_code]
+        except KeyError:
+            strings[country_code] = country_code.decode('ascii')
+            country_code = strings[country_code]
+        yield (start_num, end_num, num_type, country_code, source_name)
+
+
+def _parse_rir_chunk(chunk):
+    """ Parse the lines of an RIR file that start within the given (path,
+        start, end) byte range and return the list of their rows, see
+        parse_rir_lines.  This runs in worker processes. """
+    rir_path, start, end = chunk
+    with open(rir_path, 'rb') as rir_file:
+        if start:
+            rir_file.seek(start - 1)
+            rir_file.readline()
+        position = rir_file.tell()
+        if position >= end:
+            return []
+        data = rir_file.read(end - position)
+        if not data.endswith(b'\n'):
+            data += rir_file.readline()
+    return list(parse_rir_lines(data.splitlines(True)))
+
+
+def _parse_lir_chunk(task):
+    """ Parse the RPSL objects in the given (chunk, verbose) task, where
+        chunk holds whole objects separated by blank lines, and return the
+        list of (start_num, end_num, num_type, country_code, source_name)
+        rows of their assignments.  Like in the line-by-line parser of
+        earlier versions, the first line of an object with a valid
+        "inetnum:" or "inet6num:" range starts an assignment, and every
+        later line of the object that contains "country:" adds a row.
+        Objects are searched for these keys as bytes, so that only the
+        lines containing them are ever decoded.  This runs in worker
+        processes. """
+    chunk, verbose = task
+    rows = []
+    for rpsl_object in chunk.split(b'\n\n'):
+        entry = _find_lir_range(rpsl_object, verbose)
+        if entry is None:
+            continue
+        start_num, end_num, num_type, position = entry
+        position = rpsl_object.find(b'country:', position)
+        while position >= 0:
+            line, position = _line_at(rpsl_object, position)
+            country_code = line.replace("country:", "").strip()
+            rows.append((start_num, end_num, num_type, country_code,
+                         'ripencc'))
+            position = rpsl_object.find(b'country:', position)
+    return rows
+
+
+def _find_lir_range(rpsl_object, verbose=False):
+    """ Return the (start_num, end_num, num_type, line_end) tuple of the
+        first line in the given RPSL object that holds a valid "inetnum:"
+        or "inet6num:" range, or None if there is no such line. """
+    position = 0
+    while True:
+        found = rpsl_object.find(b'inetnum:', position)
+        found6 = rpsl_object.find(b'inet6num:', position)
+        if found < 0 or 0 <= found6 < found:
+            found = found6
+        if found < 0:
+            return None
+        line, position = _line_at(rpsl_object, found)
+        try:
+            if "inetnum:" in line:
+                line = line.replace("inetnum:", "").strip()
+                start_str = line.split("-")[0].strip()
+                end_str = line.split("-")[1].strip()
+                return (_ipv4_str_to_int(start_str),
+                        _ipv4_str_to_int(end_str), 'ipv4', position)
+            network_str = line.replace("inet6num:", "").strip()
+            address, _, prefix = network_str.partition('/')
+            host_bits = 128 - int(prefix or 128)
+            start_num = _ipv6_bytes_to_int(address.encode('ascii'))
+            if host_bits < 0 or host_bits > 128 or start_num >> 128 or \
+                    start_num & ((1 << host_bits) - 1):
+                raise ValueError('%r is not an IPv6 network' % network_str)
+            return (start_num, start_num | ((1 << host_bits) - 1), 'ipv6',
+                    position)
+        except (ValueError, IndexError) as e:
+            if verbose:
+                print((repr(e), line))
+
+
+def _line_at(data, position):
+    """ Return the decoded line of the given bytes that contains the given
+        position, and the position of the end of that line. """
+    line_start = data.rfind(b'\n', 0, position) + 1
+    line_end = data.find(b'\n', position)
+    if line_end < 0:
+        line_end = len(data)
+    return data[line_start:line_end].decode('utf-8', 'ignore'), line_end
+
+
+def _ipv4_str_to_int(address):
+    """ Return the number of the given dotted-quad IPv4 address. """
+    a, b, c, d = address.split('.')
+    if a.isdigit() and b.isdigit() and c.isdigit() and d.isdigit():
+        a, b, c, d = int(a), int(b), int(c), int(d)
+        if a < 256 and b < 256 and c < 256 and d < 256:
+            return a << 24 | b << 16 | c << 8 | d
+    raise ValueError('%r is not an IPv4 address' % (address, ))
+
+
+def _ipv6_bytes_to_int(address):
+    """ Return the number of the given IPv6 address, given as bytes. """
+    if b'.' in address:
+        return int(ipaddr.IPv6Address(address.decode('ascii')))
+    head, double_colon, tail = address.partition(b'::')
+    num = 0
+    group_count = 0
+    if head:
+        for group in head.split(b':'):
+            num = num << 16 | int(group, 16)
+            group_count += 1
+    if double_colon:
+        tail = tail.split(b':') if tail else []
+        num <<= 16 * (8 - group_count - len(tail))
+        for group in tail:
+            num = num << 16 | int(group, 16)
+    elif group_count != 8:
+        raise ValueError('%r is not an IPv6 address' % (address, ))
+    return num
 
 
 def split_callback(option, opt, value, parser):
@@ -1108,6 +3811,24 @@ def split_callback(option, opt, value, parser):
         setattr(parser.values, 'type_filter', split_value[1])
 
 
+# Names of hash algorithms by the number of hex digits of their digests.
+_checksum_algorithms = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+def parse_checksum(text):
+    """ Return the (algorithm, hex digest) tuple of the checksum in the
+        given contents of a checksum file, like "MD5 (file) = digest" or
+        "digest  file", guessing the algorithm from the length of the
+        digest, or None if there is not exactly one checksum. """
+    digests = set(digest.lower() for digest in
+                  re.findall(r'\b[0-9a-fA-F]{32,128}\b', text)
+                  if len(digest) in _checksum_algorithms)
+    if len(digests) != 1:
+        return None
+    digest = digests.pop()
+    return _checksum_algorithms[len(digest)], digest
+
+
 def normalize_country_code(country_code):
     """ Normalize country codes a bit by making capitalization consistent and
         removing trailing comments (and other words). """
@@ -1117,6 +3838,93 @@ def normalize_country_code(country_code):
     return country_code.upper()
 
 
+def flatten_ranges(ranges):
+    """ Sweep over (start_num, end_num, value, span_bits) tuples sorted by
+        start_num and yield (start_num, end_num, value) tuples that don't
+        overlap, merging adjacent ranges with the same value.  Of all
+        ranges covering a number, the one with the fewest span bits wins,
+        then the one starting last, then the one ending last, and then the
+        one with the highest value, which is the order in which
+        DatabaseCache.fetch_country_code finds them. """
+    ranges = iter(ranges)
+    pending = next(ranges, None)
+    active, end_nums = [], []
+    position = merged = None
+    while active or pending is not None:
+        if not active:
+            position = pending[0]
+        while pending is not None and pending[0] <= position:
+            start_num, end_num, value, span_bits = pending
+            heapq.heappush(active, (span_bits, -start_num, -end_num,
+                                    _descending(value), end_num, value))
+            heapq.heappush(end_nums, end_num)
+            pending = next(ranges, None)
+        while active and active[0][4] < position:
+            heapq.heappop(active)
+        while end_nums and end_nums[0] < position:
+            heapq.heappop(end_nums)
+        if not active:
+            continue
+        boundary = end_nums[0] + 1
+        if pending is not None and pending[0] < boundary:
+            boundary = pending[0]
+        value = active[0][5]
+        if merged is not None and merged[2] == value and \
+                merged[1] + 1 == position:
+            merged = (merged[0], boundary - 1, value)
+        else:
+            if merged is not None:
+                yield merged
+            merged = (position, boundary - 1, value)
+        position = boundary
+    if merged is not None:
+        yield merged
+
+
+def summarize_ranges(ranges, num_type):
+    """ Yield (start_num, block) tuples for the minimal list of blocks that
+        cover the given (start_num, end_num) ranges sorted by start_num,
+        merging overlapping and adjacent ranges.  Blocks are CIDR strings
+        for IPv4 and IPv6.  ASN ranges are not merged, and their blocks
+        are their first numbers. """
+    if num_type == 'asn':
+        for start_num, end_num in ranges:
+            yield start_num, str(start_num)
+        return
+    if num_type == 'ipv4':
+        bits, address = 32, ipaddr.IPv4Address
+    else:
+        bits, address = 128, ipaddr.IPv6Address
+    merged = []
+    for start_num, end_num in ranges:
+        if merged and start_num <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end_num)
+        else:
+            merged.append([start_num, end_num])
+    for start_num, end_num in merged:
+        while start_num <= end_num:
+            alignment_bits = (start_num & -start_num).bit_length() \
+                if start_num else bits + 1
+            block_bits = min(alignment_bits,
+                             (end_num - start_num + 1).bit_length()) - 1
+            yield start_num, '%s/%d' % (address(start_num),
+                                        bits - block_bits)
+            start_num += 1 << block_bits
+
+
+def _descending(value):
+    """ Return a key that sorts country codes or numbers in descending
+        order. """
+    if isinstance(value, int):
+        return -value
+    return tuple(-ord(c) for c in value or '')
+
+
+def _align(length):
+    """ Round the given length up to a multiple of 8 bytes. """
+    return (length + 7) & ~7
+
+
 def main():
     """ Where the magic starts. """
     usage = ("Usage: %prog [options]\n\n"
@@ -1132,6 +3940,47 @@ def main():
                             'fetching delegation files [default: "%default"]'),
                       default=("Mozilla/5.0 (Windows NT 6.1; rv:17.0) "
                                "Gecko/20100101 Firefox/17.0"))
+    parser.add_option("--busy-timeout", action="store", dest="busy_timeout",
+                      type="float", metavar="SECONDS",
+                      help=("wait this long for other blockfinder processes "
+                            "to release the database cache [default: "
+                            "%default]"),
+                      default=DatabaseCache.busy_timeout)
+    parser.add_option("--jobs", action="store", dest="jobs", type="int",
+                      metavar="N",
+                      help=("parse RIR and LIR files in this many worker "
+                            "processes [default: %default]"),
+                      default=1)
+    parser.add_option("--decompression", action="store",
+                      dest="decompression", type="choice", metavar="BACKEND",
+                      choices=[backend.name for backend in
+                               decompression_backends],
+                      help=("read compressed files with this backend if it "
+                            "is installed, one of %s [default: the first "
+                            "installed one]" % ", ".join(
+                                backend.name for backend in
+                                decompression_backends)))
+    parser.add_option("--incremental", action="store_true",
+                      dest="incremental", default=False,
+                      help=("with -i or -d, only write the RIR assignments "
+                            "that changed since the last import"))
+    parser.add_option("--resume", action="store_true", dest="resume",
+                      default=False,
+                      help=("with -l, -z, -y, or -u, continue an import of "
+                            "the same files that did not complete after its "
+                            "last committed batch"))
+    parser.add_option("--memory-lookups", action="store_true",
+                      dest="memory_lookups", default=False,
+                      help=("answer country code lookups from sorted arrays "
+                            "loaded into memory instead of with SQL queries "
+                            "or the compiled database"))
+    parser.add_option("--result-cache-size", action="store",
+                      dest="result_cache_size", type="int", metavar="MB",
+                      help=("keep up to this many megabytes of results of "
+                            "-t, -n, --compare, and --lookup-org-by-range "
+                            "in the cache directory; 0 disables the result "
+                            "cache [default: %default]"),
+                      default=ResultCache.max_bytes // (1024 * 1024))
     parser.add_option("-x", "--hack-the-internet", action="store_true",
                       dest="hack_the_internet", help=optparse.SUPPRESS_HELP)
     group = optparse.OptionGroup(
@@ -1219,6 +4068,12 @@ def main():
         action="store_true",
         dest="reload_asn_assignments",
         help=("Use existing asn assignments to update database"))
+    group.add_option(
+        "--compile",
+        action="store_true",
+        dest="compile",
+        help=("compile the database cache into a memory-mapped file that "
+              "country code lookups use while it is up to date"))
     parser.add_option_group(group)
     group = optparse.OptionGroup(
         parser, "Lookup modes",
@@ -1276,8 +4131,7 @@ def main():
         metavar="CC",
         help=("compare assignments to the specified country code "
               "with overlapping assignments in other data "
-              "sources; can take some time and produce some "
-              "long output"))
+              "sources; can produce some long output"))
     group.add_option(
         "-w",
         "--what-country",
@@ -1336,6 +4190,35 @@ def main():
         action="store",
         dest="geoip_asn_filename",
         help=("The filename to write the IPv4 GeoIP ASNum dataset to"))
+    group.add_option(
+        "--export-mmdb",
+        action="store_true",
+        dest="export_mmdb",
+        help=("export country assignments and ASN assignments to MaxMind "
+              "DB files for use with libmaxminddb"))
+    group.add_option(
+        "--mmdb-source",
+        action="store",
+        dest="mmdb_source",
+        type="choice",
+        choices=["maxmind", "rir", "lir"],
+        default="rir",
+        help=("The source type of the country assignments to export "
+              "[default: %default]"))
+    group.add_option(
+        "--mmdb-country-file",
+        action="store",
+        dest="mmdb_country_filename",
+        default="Blockfinder-Country.mmdb",
+        help=("The filename to write the country database to "
+              "[default: %default]"))
+    group.add_option(
+        "--mmdb-asn-file",
+        action="store",
+        dest="mmdb_asn_filename",
+        default="Blockfinder-ASN.mmdb",
+        help=("The filename to write the ASN database to "
+              "[default: %default]"))
     parser.add_option_group(group)
 
     group = optparse.OptionGroup(parser, "Network modes")
@@ -1344,21 +4227,28 @@ def main():
         print("all your bases are belong to us!")
         sys.exit(0)
     options_dict = vars(options)
+    cache_modes = ["init_maxmind", "reload_maxmind", "import_maxmind",
+                   "init_del", "init_lir", "reload_del", "reload_lir",
+                   "download_cc", "erase_cache", "init_asn_descriptions",
+                   "reload_asn_descriptions", "init_asn_assignments",
+                   "reload_asn_assignments", "compile"]
+    lookup_modes = ["ipv4", "ipv6", "asn", "cc", "cn", "compare", "what_cc",
+                    "lookup_org_by_ip", "lookup_org_by_range", "export",
+                    "export_mmdb"]
     modes = 0
-    for mode in ["init_maxmind", "reload_maxmind", "import_maxmind",
-                 "init_del", "init_lir", "reload_del", "reload_lir",
-                 "download_cc", "erase_cache", "ipv4", "ipv6", "asn",
-                 "cc", "cn", "compare", "what_cc", "init_asn_descriptions",
-                 "reload_asn_descriptions", "init_asn_assignments",
-                 "reload_asn_assignments", "lookup_org_by_ip",
-                 "lookup_org_by_range", "export"]:
+    for mode in cache_modes + lookup_modes:
         if mode in options_dict and options_dict.get(mode):
             modes += 1
     if modes > 1:
         parser.error("only 1 cache or lookup mode allowed")
     elif modes == 0:
         parser.error("must provide 1 cache or lookup mode")
-    database_cache = DatabaseCache(options.dir, options.verbose)
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    read_only = not [mode for mode in cache_modes if options_dict.get(mode)]
+    database_cache = DatabaseCache(options.dir, options.verbose,
+                                   read_only=read_only,
+                                   busy_timeout=options.busy_timeout)
     if options.erase_cache:
         database_cache.erase_database()
         sys.exit(0)
@@ -1367,10 +4257,30 @@ def main():
         print("You may need to erase it using -e and then reload it "
               "using -d/-z.  Exiting.")
         sys.exit(1)
-    database_cache.set_db_version()
+    if database_cache.get_db_version() != database_cache.db_version:
+        database_cache.set_db_version()
     downloader_parser = DownloaderParser(options.dir, database_cache,
-                                         options.ua)
-    lookup = Lookup(options.dir, database_cache)
+                                         options.ua, jobs=options.jobs,
+                                         decompression=options.decompression,
+                                         resume=options.resume)
+    compiled_path = os.path.join(options.dir, CompiledDatabase.file_name)
+    compiled_database = lookup_engine = None
+    if read_only and options.memory_lookups:
+        lookup_engine = MemoryLookupEngine(database_cache)
+    elif read_only and os.path.exists(compiled_path):
+        try:
+            compiled_database = CompiledDatabase(compiled_path)
+        except ValueError:
+            pass
+        else:
+            if compiled_database.generation != \
+                    database_cache.get_generation():
+                compiled_database.close()
+                compiled_database = None
+        lookup_engine = compiled_database
+    lookup = Lookup(options.dir, database_cache,
+                    lookup_engine=lookup_engine)
+    lookup.result_cache.max_bytes = options.result_cache_size * 1024 * 1024
     if options.ipv4 or options.ipv6 or options.asn or options.cc \
             or options.cn or options.compare:
         if downloader_parser.check_rir_file_mtimes():
@@ -1441,14 +4351,26 @@ def main():
             downloader_parser.download_rir_files()
             print("Verifying RIR files...")
             downloader_parser.verify_rir_files()
-        print("Importing RIR files...")
-        downloader_parser.parse_rir_files()
+        if options.reload_del or downloader_parser.needs_import(
+                downloader_parser.RIR_URLS.split()):
+            print("Importing RIR files...")
+            changes = downloader_parser.parse_rir_files(
+                incremental=options.incremental)
+            if changes:
+                print("%d assignments inserted, %d updated, %d deleted." %
+                      changes)
+        else:
+            print("RIR files have not changed since the last import.")
     elif options.init_lir or options.reload_lir:
         if options.init_lir:
             print("Downloading LIR delegation files...")
             downloader_parser.download_lir_files()
-        print("Importing LIR files...")
-        downloader_parser.parse_lir_files()
+        if options.reload_lir or downloader_parser.needs_import(
+                downloader_parser.LIR_URLS.split()):
+            print("Importing LIR files...")
+            downloader_parser.parse_lir_files()
+        else:
+            print("LIR files have not changed since the last import.")
     elif options.download_cc:
         print("Downloading country code file...")
         downloader_parser.download_country_code_file()
@@ -1462,8 +4384,24 @@ def main():
         if options.init_asn_assignments:
             print("Downloading ASN Assignments...")
             downloader_parser.download_asn_assignment_files()
-        print("Importing ASN Assignments...")
-        downloader_parser.parse_asn_assignment_files()
+        if options.reload_asn_assignments or downloader_parser.needs_import(
+                downloader_parser.ASN_ASSIGNMENT_URLS):
+            print("Importing ASN Assignments...")
+            downloader_parser.parse_asn_assignment_files()
+        else:
+            print("ASN Assignments have not changed since the last import.")
+    elif options.export_mmdb:
+        print(("Exporting %s country assignments to %s"
+               % (options.mmdb_source.upper(),
+                  options.mmdb_country_filename)))
+        database_cache.export_mmdb(options.mmdb_country_filename,
+                                   options.mmdb_source)
+        print(("Exporting ASN assignments to %s"
+               % options.mmdb_asn_filename))
+        database_cache.export_asn_mmdb(options.mmdb_asn_filename)
+    elif options.compile:
+        print(("Compiling database cache to %s..." % compiled_path))
+        CompiledDatabase.compile(database_cache, compiled_path)
     elif options.export:
         print("Export needs to be refactored.")
         sys.exit(3)
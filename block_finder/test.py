@@ -1,14 +1,236 @@
 #!/usr/bin/python
 import unittest
+import binascii
+import bz2
+import gzip
+import hashlib
+import multiprocessing
 import os
+import random
 import shutil
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 
 from . import blockfinder
 from .blockfinder import ipaddr, normalize_country_code
 
 
+def read_while_importing(test_dir, ready, stop, results):
+    """ Look up addresses with a read-only connection until told to stop,
+        and report the number of lookups and any unexpected answers. """
+    database_cache = blockfinder.DatabaseCache(test_dir, read_only=True,
+                                               busy_timeout=1)
+    database_cache.connect_to_database()
+    pl = int(ipaddr.IPv4Address('193.9.25.1'))
+    it = int(ipaddr.IPv4Address('80.16.151.184'))
+    lookups, errors = 0, []
+    while not stop.is_set():
+        try:
+            answers = (database_cache.fetch_country_code('ipv4', 'rir', pl),
+                       database_cache.fetch_country_code('ipv4', 'lir', it))
+            if answers != ('PL', 'IT'):
+                errors.append(repr(answers))
+        except sqlite3.Error as e:
+            errors.append(repr(e))
+        lookups += 1
+        if lookups == 1:
+            ready.put(True)
+    database_cache.commit_and_close_database()
+    results.put((lookups, errors[:5]))
+
+
+class MMDBReader(object):
+    """ A minimal pure-Python MaxMind DB reader to verify exported
+        databases. """
+
+    def __init__(self, path):
+        with open(path, 'rb') as mmdb_file:
+            self.buf = bytearray(mmdb_file.read())
+        marker = b'\xab\xcd\xefMaxMind.com'
+        self.data_start = 0
+        self.metadata = self.decode(self.buf.rindex(marker) + len(marker))[0]
+        self.node_count = self.metadata['node_count']
+        self.record_size = self.metadata['record_size']
+        self.node_size = self.record_size // 4
+        self.data_start = self.node_count * self.node_size + 16
+
+    def read_int(self, offset, length):
+        value = 0
+        for byte in self.buf[offset:offset + length]:
+            value = value << 8 | byte
+        return value
+
+    def decode(self, offset):
+        """ Return the value at the given offset and the offset after
+            it. """
+        control = self.buf[offset]
+        offset += 1
+        type_number = control >> 5
+        if type_number == 1:
+            length = (control >> 3 & 3) + 1
+            pointer = self.read_int(offset, length)
+            if length < 4:
+                pointer |= (control & 7) << 8 * length
+            pointer += (0, 0, 2048, 526336, 0)[length]
+            return self.decode(self.data_start + pointer)[0], offset + length
+        if type_number == 0:
+            type_number = 7 + self.buf[offset]
+            offset += 1
+        size = control & 31
+        if size >= 29:
+            length = size - 28
+            size = self.read_int(offset, length) + (29, 285, 65821)[length - 1]
+            offset += length
+        if type_number == 2:
+            return (self.buf[offset:offset + size].decode('utf-8'),
+                    offset + size)
+        if type_number in (5, 6, 9, 10):
+            return self.read_int(offset, size), offset + size
+        if type_number == 7:
+            value = {}
+            for i in range(size):
+                key, offset = self.decode(offset)
+                value[key], offset = self.decode(offset)
+            return value, offset
+        if type_number == 11:
+            value = []
+            for i in range(size):
+                item, offset = self.decode(offset)
+                value.append(item)
+            return value, offset
+        raise ValueError('unsupported type %d' % type_number)
+
+    def read_record(self, node, index):
+        offset = node * self.node_size
+        if self.record_size == 28:
+            if index == 0:
+                return (self.buf[offset + 3] >> 4) << 24 | \
+                    self.read_int(offset, 3)
+            return (self.buf[offset + 3] & 15) << 24 | \
+                self.read_int(offset + 4, 3)
+        length = self.record_size // 8
+        return self.read_int(offset + index * length, length)
+
+    def lookup(self, lookup_num):
+        """ Return the record for the given IPv6 address, or IPv4 address
+            in ::/96, or None. """
+        record = 0
+        for bit in range(127, -1, -1):
+            record = self.read_record(record, lookup_num >> bit & 1)
+            if record >= self.node_count:
+                break
+        if record > self.node_count:
+            return self.decode(self.data_start + record -
+                               self.node_count - 16)[0]
+
+
+class ThrottledHTTPServer(ThreadingMixIn, HTTPServer):
+    """ A local HTTP server that serves the given files, keyed by path, in
+        pieces with a delay between them, and counts how many requests it
+        handled at the same time.  Files are served with an ETag and a
+        Last-Modified header if enabled, and with 304 Not Modified
+        responses to requests that match them.  Range requests are served
+        if enabled, and connections are dropped after as many bytes of the
+        response as the next number in drops. """
+
+    daemon_threads = True
+
+    def __init__(self, files, pieces=5, delay=0.05, etags=True,
+                 last_modified=True, ranges=True, drops=()):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ThrottledRequestHandler)
+        self.files = files
+        self.pieces = pieces
+        self.delay = delay
+        self.etags = etags
+        self.last_modified = last_modified
+        self.ranges = ranges
+        self.drops = list(drops)
+        self.lock = threading.Lock()
+        self.active_requests = 0
+        self.max_active_requests = 0
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ThrottledRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active_requests += 1
+            server.max_active_requests = max(server.max_active_requests,
+                                             server.active_requests)
+        try:
+            if self.path not in server.files:
+                server.requests.append((self.path, 404))
+                self.send_error(404)
+                return
+            data = server.files[self.path]
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            last_modified = 'Sat, 01 Jan 2000 00:00:%02d GMT' % (
+                len(data) % 60)
+            if server.etags and \
+                    self.headers.get('If-None-Match') == etag or \
+                    server.last_modified and \
+                    self.headers.get('If-Modified-Since') == last_modified:
+                server.requests.append((self.path, 304))
+                self.send_response(304)
+                self.end_headers()
+                return
+            range_header = self.headers.get('Range', '')
+            if server.ranges and range_header.startswith('bytes=') and \
+                    self.headers.get('If-Range') in (etag, last_modified):
+                first = int(range_header[6:].rstrip('-'))
+                server.requests.append((self.path, 206))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                    first, len(data) - 1, len(data)))
+                data = data[first:]
+            else:
+                server.requests.append((self.path, 200))
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            if server.etags:
+                self.send_header('ETag', etag)
+            if server.last_modified:
+                self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            with server.lock:
+                drop = server.drops.pop(0) if server.drops else None
+            if drop is not None:
+                data = data[:drop]
+                self.close_connection = True
+            piece_size = len(data) // server.pieces + 1
+            for start in range(0, len(data), piece_size):
+                time.sleep(server.delay)
+                self.wfile.write(data[start:start + piece_size])
+        finally:
+            with server.lock:
+                server.active_requests -= 1
+
+    def log_message(self, *args):
+        pass
+
+
 class BaseBlockfinderTest(unittest.TestCase):
 
     def setUp(self):
@@ -117,6 +339,2067 @@ class CheckBlockFinder(BaseBlockfinderTest):
         self.assertEqual(result, expected)
 
 
+class CheckQueryPlans(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.database_cache.insert_asn_assignment(
+            int(ipaddr.IPv4Address('175.45.176.0')),
+            int(ipaddr.IPv4Address('175.45.179.255')), 'ipv4', 131279,
+            'bgp_snapshot', 'routeviews')
+        self.database_cache.insert_asn_description(131279, 'cidr_report',
+                                                   'STAR-KP')
+        self.database_cache.commit_changes()
+
+    def _trace_statements(self, callback):
+        statements = []
+        self.database_cache.conn.set_trace_callback(statements.append)
+        try:
+            callback()
+        finally:
+            self.database_cache.conn.set_trace_callback(None)
+        return [sql for sql in statements if sql.split()[0].upper() in
+                ('SELECT', 'DELETE', 'UPDATE')]
+
+    def _run_all_queries(self):
+        db = self.database_cache
+        kp = int(ipaddr.IPv4Address('175.45.176.100'))
+        jp = int(ipaddr.IPv6Address('2001:200::1'))
+        db.fetch_country_code('ipv4', 'rir', kp)
+        db.fetch_country_code('ipv6', 'rir', jp)
+        db.fetch_country_code('asn', 'rir', 681)
+        db.fetch_assignments('ipv4', 'KP')
+        db.fetch_country_cidrs('ipv4', 'DE')
+        list(db.fetch_country_blocks_in_other_sources('DE'))
+        db.fetch_org_by_ip_address(kp, 'ipv4')
+        db.fetch_org_by_ip_range(kp - 100, kp + 10000, 'ipv4')
+        db.export_geoip(self.lookup, os.devnull, 'asn')
+        list(db.fetch_ranges('ipv4', 'rir'))
+        list(db.fetch_asn_ranges('ipv4'))
+        db.fetch_asn_description(131279)
+        db.export_asn(os.devnull, 'ipv6')
+        db.update_assignments(
+            iter([(kp, kp + 255, 'ipv4', 'KP', 'apnic')]), 'maxmind')
+        db.delete_assignments('maxmind')
+
+    def test_no_table_scans(self):
+        statements = self._trace_statements(self._run_all_queries)
+        self.assertTrue(len(statements) > 10)
+        # The staging table of update_assignments is dropped once it has
+        # been compared, so recreate it to explain the comparison.
+        self.database_cache._create_staging_table('assignments')
+        for sql in statements:
+            plan = self.database_cache.conn.execute(
+                'EXPLAIN QUERY PLAN ' + sql).fetchall()
+            details = [row[-1] for row in plan]
+            # Reading the catalog and every loaded staging row is expected.
+            self.assertFalse([d for d in details if d.startswith('SCAN') and
+                              d not in ('SCAN sqlite_master',
+                                        'SCAN assignments_staging')],
+                             '%s\n%s' % (sql, '\n'.join(details)))
+
+    def test_point_lookup_uses_covering_index(self):
+        kp = int(ipaddr.IPv4Address('175.45.176.100'))
+        statements = self._trace_statements(
+            lambda: self.database_cache.fetch_country_code('ipv4', 'lir', kp))
+        lookups = [sql for sql in statements if 'LIMIT 1' in sql]
+        self.assertTrue(lookups)
+        for sql in lookups:
+            plan = self.database_cache.conn.execute(
+                'EXPLAIN QUERY PLAN ' + sql).fetchall()
+            self.assertIn('COVERING INDEX AssignmentsBySpan', plan[0][-1])
+
+    def test_most_specific_assignment_wins(self):
+        db = self.database_cache
+        start = int(ipaddr.IPv4Address('10.0.0.0'))
+        db.insert_assignment(start, start + 2 ** 24 - 1, 'ipv4', 'EU',
+                             'lir', 'ripencc')
+        db.insert_assignment(start + 512, start + 767, 'ipv4', 'NL',
+                             'lir', 'ripencc')
+        db.insert_assignment(start + 600, start + 603, 'ipv4', 'BE',
+                             'lir', 'ripencc')
+        db.commit_changes()
+        self.assertEqual(db.fetch_country_code('ipv4', 'lir', start), 'EU')
+        self.assertEqual(
+            db.fetch_country_code('ipv4', 'lir', start + 520), 'NL')
+        self.assertEqual(
+            db.fetch_country_code('ipv4', 'lir', start + 601), 'BE')
+        self.assertEqual(
+            db.fetch_country_code('ipv4', 'lir', start + 768), 'EU')
+        self.assertEqual(
+            db.fetch_country_code('ipv4', 'lir', start + 2 ** 24), None)
+
+
+class CheckNumberEncoding(BaseBlockfinderTest):
+
+    def test_ipv6_keys_keep_order(self):
+        db = self.database_cache
+        numbers = [0, 1, 2 ** 64 - 1, 2 ** 64, 2 ** 127, 2 ** 128 - 1,
+                   2 ** 128]
+        keys = [db._to_key(num, 'ipv6') for num in numbers]
+        self.assertEqual(sorted(keys), keys)
+        self.assertEqual([db._from_key(key) for key in keys], numbers)
+
+    def test_whole_ipv6_space(self):
+        db = self.database_cache
+        db.insert_assignment(0, 2 ** 128 - 1, 'ipv6', 'EU', 'lir', 'ripencc')
+        db.commit_changes()
+        self.assertEqual(db.fetch_country_code('ipv6', 'lir', 2 ** 128 - 1),
+                         'EU')
+        self.assertEqual(db.fetch_assignments('ipv6', 'EU'),
+                         [(0, 2 ** 128 - 1)])
+
+    def test_ipv4_and_asn_stored_as_integers(self):
+        self.database_cache.cursor.execute(
+            "SELECT DISTINCT typeof(start_num), typeof(next_start_num) "
+            "FROM assignments WHERE num_type != 'ipv6'")
+        self.assertEqual(self.database_cache.cursor.fetchall(),
+                         [('integer', 'integer')])
+
+
+# Schemas of database caches written by earlier versions.
+FIXTURE_SCHEMAS = {
+    '0.0.4': [
+        'CREATE TABLE assignments(start_hex TEXT, next_start_hex TEXT, '
+        'num_type TEXT, country_code TEXT, source_type TEXT, '
+        'source_name TEXT)',
+        'CREATE TABLE asn_descriptions(as_num INT, source_name TEXT, '
+        'description TEXT)',
+        'CREATE INDEX DescriptionsByASN ON asn_descriptions ( as_num )',
+        'CREATE TABLE asn_assignments(start_hex TEXT, next_start_hex TEXT, '
+        'num_type TEXT, as_num INT, source_type TEXT, source_name TEXT, '
+        'PRIMARY KEY(start_hex, next_start_hex))',
+        'CREATE INDEX ASNEntriesByStartHex on asn_assignments ( start_hex )'],
+    '0.0.5': [
+        'CREATE TABLE assignments(start_hex TEXT, next_start_hex TEXT, '
+        'num_type TEXT, country_code TEXT, source_type TEXT, '
+        'source_name TEXT, span_bits INT)',
+        'CREATE INDEX AssignmentsBySpan ON assignments ( source_type, '
+        'num_type, span_bits, start_hex, next_start_hex, country_code )',
+        'CREATE INDEX AssignmentsByCountry ON assignments ( country_code, '
+        'num_type, start_hex, next_start_hex )',
+        'CREATE INDEX AssignmentsByStartHex ON assignments ( num_type, '
+        'start_hex )',
+        'CREATE TABLE asn_descriptions(as_num INT, source_name TEXT, '
+        'description TEXT)',
+        'CREATE INDEX DescriptionsByASN ON asn_descriptions ( as_num )',
+        'CREATE TABLE asn_assignments(start_hex TEXT, next_start_hex TEXT, '
+        'num_type TEXT, as_num INT, source_type TEXT, source_name TEXT, '
+        'span_bits INT, PRIMARY KEY(start_hex, next_start_hex))',
+        'CREATE INDEX ASNEntriesBySpan ON asn_assignments ( num_type, '
+        'span_bits, start_hex, next_start_hex, as_num )',
+        'CREATE INDEX ASNEntriesByStartHex ON asn_assignments ( num_type, '
+        'start_hex )'],
+    '0.0.6': [
+        'CREATE TABLE assignments(start_num BLOB, next_start_num BLOB, '
+        'num_type TEXT, country_code TEXT, source_type TEXT, '
+        'source_name TEXT, span_bits INT)',
+        'CREATE TABLE asn_descriptions(as_num INT, source_name TEXT, '
+        'description TEXT)',
+        'CREATE TABLE asn_assignments(start_num BLOB, next_start_num BLOB, '
+        'num_type TEXT, as_num INT, source_type TEXT, source_name TEXT, '
+        'span_bits INT, PRIMARY KEY(start_num, next_start_num))'],
+}
+
+
+def create_fixture(test_dir, version):
+    """ Create a database cache of the given version with an IPv4, an
+        IPv6 and an ASN assignment, and an ASN assignment of its IPv4
+        range. """
+    conn = sqlite3.connect(os.path.join(test_dir, 'sqlitedb'))
+    for sql in FIXTURE_SCHEMAS.get(version, FIXTURE_SCHEMAS['0.0.4']):
+        conn.execute(sql)
+    kp = int(ipaddr.IPv4Address('175.45.176.0'))
+    jp = int(ipaddr.IPv6Address('2001:200::'))
+    if version == '0.0.6':
+        keys = [kp, kp + 1024, sqlite3.Binary(
+            binascii.unhexlify('%034x' % jp)), sqlite3.Binary(
+            binascii.unhexlify('%034x' % (jp + 2 ** 93))), 681, 682]
+    else:
+        keys = ['%09x' % kp, '%09x' % (kp + 1024), '%033x' % jp,
+                '%033x' % (jp + 2 ** 93), '%09x' % 681, '%09x' % 682]
+    assignments = [(keys[0], keys[1], 'ipv4', 'KP', 'rir', 'apnic', 11),
+                   (keys[2], keys[3], 'ipv6', 'JP', 'rir', 'apnic', 94),
+                   (keys[4], keys[5], 'asn', 'NZ', 'rir', 'apnic', 1)]
+    asn_assignment = (keys[0], keys[1], 'ipv4', 131279, 'bgp_snapshot',
+                      'routeviews', 11)
+    if version not in ('0.0.5', '0.0.6'):
+        assignments = [row[:-1] for row in assignments]
+        asn_assignment = asn_assignment[:-1]
+    columns = ', '.join('?' * len(asn_assignment))
+    conn.executemany('INSERT INTO assignments VALUES (%s)' % columns,
+                     assignments)
+    conn.execute('INSERT INTO asn_assignments VALUES (%s)' % columns,
+                 asn_assignment)
+    conn.commit()
+    conn.close()
+    with open(os.path.join(test_dir, 'db.cfg'), 'w') as cfg:
+        cfg.write('[db]\nversion = %s\n' % version)
+
+
+class CheckMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.base_test_dir = tempfile.mkdtemp()
+        self.test_dir = self.base_test_dir + "/test/"
+        os.mkdir(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_test_dir, True)
+
+    def check_migrated(self, db):
+        self.assertEqual(db.get_db_version(), db.db_version)
+        self.assertEqual(db.get_schema_version(), db.db_version)
+        kp = int(ipaddr.IPv4Address('175.45.176.100'))
+        jp = int(ipaddr.IPv6Address('2001:200::1'))
+        self.assertEqual(db.fetch_country_code('ipv4', 'rir', kp), 'KP')
+        self.assertEqual(db.fetch_country_code('ipv6', 'rir', jp), 'JP')
+        self.assertEqual(db.fetch_country_code('asn', 'rir', 681), 'NZ')
+        self.assertEqual(db.fetch_assignments('ipv6', 'JP'),
+                         [(jp - 1, jp - 2 + 2 ** 93)])
+        self.assertEqual(db.fetch_org_by_ip_address(kp, 'ipv4'), None)
+        self.assertEqual(db.fetch_country_cidrs('ipv4', 'KP'),
+                         ['175.45.176.0/22'])
+        self.assertEqual(db.fetch_country_cidrs('ipv6', 'JP'),
+                         ['2001:200::/35'])
+        db.cursor.execute('SELECT as_num, span_bits FROM asn_assignments')
+        self.assertEqual(db.cursor.fetchall(), [(131279, 11)])
+        db.cursor.execute("SELECT name FROM sqlite_master "
+                          "WHERE name LIKE '%_hex' OR name LIKE '%Hex'")
+        self.assertEqual(db.cursor.fetchall(), [])
+
+    def test_every_version_is_migrated(self):
+        for version in sorted(FIXTURE_SCHEMAS):
+            shutil.rmtree(self.test_dir)
+            os.mkdir(self.test_dir)
+            create_fixture(self.test_dir, version)
+            db = blockfinder.DatabaseCache(self.test_dir)
+            self.assertTrue(db.connect_to_database(), version)
+            self.check_migrated(db)
+            db.commit_and_close_database()
+
+    def test_unknown_versions_are_refused(self):
+        for version in ('0.0.3', '0.1.0'):
+            create_fixture(self.test_dir, version)
+            db = blockfinder.DatabaseCache(self.test_dir)
+            self.assertFalse(db.connect_to_database())
+            self.assertEqual(db.get_db_version(), version)
+            os.remove(os.path.join(self.test_dir, 'sqlitedb'))
+
+    def test_interrupted_migration_resumes(self):
+        create_fixture(self.test_dir, '0.0.4')
+        db = blockfinder.DatabaseCache(self.test_dir)
+
+        def interrupted():
+            blockfinder.DatabaseCache._migrate_number_keys(db)
+            raise sqlite3.OperationalError('disk I/O error')
+        db._migrate_number_keys = interrupted
+        self.assertRaises(sqlite3.OperationalError, db.connect_to_database)
+        db.conn.close()
+        self.assertEqual(db.get_db_version(), '0.0.5')
+        conn = sqlite3.connect(os.path.join(self.test_dir, 'sqlitedb'))
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone(),
+                         (5, ))
+        self.assertEqual(conn.execute(
+            'SELECT span_bits FROM assignments ORDER BY span_bits'
+        ).fetchall(), [(1, ), (11, ), (94, )])
+        conn.close()
+        db.set_db_version(version='0.0.4')
+        db = blockfinder.DatabaseCache(self.test_dir)
+        self.assertTrue(db.connect_to_database())
+        self.check_migrated(db)
+
+
+class CheckBulkLoad(BaseBlockfinderTest):
+
+    def test_indexes_rebuilt_and_pragmas_restored(self):
+        cursor = self.database_cache.cursor
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = 'assignments'")
+        self.assertEqual(sorted(row[0] for row in cursor.fetchall()),
+                         ['AssignmentsByCountry', 'AssignmentsBySpan',
+                          'AssignmentsByStart'])
+        cursor.execute('PRAGMA synchronous')
+        self.assertEqual(cursor.fetchone()[0], 2)
+
+    def test_small_batches(self):
+        expected = self.database_cache.fetch_assignments('ipv6', 'JP')
+        self.database_cache.bulk_batch_size = 2
+        self.downloader_parser.parse_rir_files(['test_rir_data'])
+        self.assertEqual(self.database_cache.fetch_assignments('ipv6', 'JP'),
+                         expected)
+        self.assertEqual(self.database_cache.fetch_country_code(
+            'ipv4', 'rir', int(ipaddr.IPv4Address('193.9.25.1'))), 'PL')
+
+    def test_asn_assignment_import(self):
+        snapshot = bz2.BZ2File(self.test_dir + 'test_bgp_data.bz2', 'w')
+        snapshot.write(
+            b'   Network            Next Hop    Metric LocPrf Weight Path\n'
+            b'*  175.45.176.0/22    203.62.252.83   0   0   0 1221 131279 i\n'
+            b'*  175.45.176.0/24    203.62.252.83   0   0   0 1221 131279 i\n'
+            b'*  2001:200::/32      2001:db8::1     0   0   0 1221 2500 i\n')
+        snapshot.close()
+        self.downloader_parser.parse_asn_assignment_files(
+            ['test_bgp_data.bz2'])
+        for asn, description in ((131279, 'STAR-KP'), (2500, 'WIDE')):
+            self.database_cache.insert_asn_description(asn, 'cidr_report',
+                                                       description)
+        self.database_cache.commit_changes()
+        kp = int(ipaddr.IPv4Address('175.45.176.100'))
+        self.assertEqual(
+            [row[2:] for row in self.database_cache.fetch_org_by_ip_address(
+                kp, 'ipv4')],
+            [(kp - 100, kp + 156), (kp - 100, kp + 924)])
+        jp = int(ipaddr.IPv6Address('2001:200::1'))
+        self.assertEqual(
+            self.database_cache.fetch_org_by_ip_address(jp, 'ipv6')[0][:2],
+            (2500, 'WIDE'))
+
+    def test_as_set_origins(self):
+        snapshot = bz2.BZ2File(self.test_dir + 'test_bgp_data.bz2', 'w')
+        snapshot.write(
+            b'*  1.0.0.0/24         203.62.252.83   0   0   0 1221 13335 i\n'
+            b'*  1.0.0.0/16         203.62.252.83   0   0   0 1221 '
+            b'{4788,38044} i\n'
+            b'*  1.1.0.0/16         203.62.252.83   0   0   0 1221 '
+            b'{38044} i\n'
+            b'*  1.2.0.0/16         203.62.252.83   0   0   0 1221 '
+            b'[4788] i\n')
+        snapshot.close()
+        self.downloader_parser.parse_asn_assignment_files(
+            ['test_bgp_data.bz2'])
+        self.assertEqual(self.database_cache.conn.execute(
+            'SELECT as_num, typeof(as_num) FROM asn_assignments '
+            'ORDER BY start_num').fetchall(),
+            [(13335, 'integer'), (38044, 'integer')])
+        self.assertEqual(blockfinder.parse_origin_as('{4788,38044}'), None)
+        self.assertEqual(blockfinder.parse_origin_as('{4788}'), 4788)
+        self.assertEqual(blockfinder.parse_origin_as('4788'), 4788)
+
+
+class CheckAtomicReload(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.reader = blockfinder.DatabaseCache(self.test_dir)
+        self.reader.connect_to_database()
+        self.pl = int(ipaddr.IPv4Address('193.9.25.1'))
+
+    def tearDown(self):
+        self.reader.commit_and_close_database()
+        BaseBlockfinderTest.tearDown(self)
+
+    def test_generations(self):
+        db = self.database_cache
+        self.assertEqual(db.get_generation('rir'), 1)
+        self.assertEqual(db.get_generation('lir'), 2)
+        self.assertEqual(db.get_generation('maxmind'), 0)
+        self.assertEqual(db.get_generation(), 2)
+        self.downloader_parser.parse_rir_files(['test_rir_data'])
+        self.assertEqual(db.get_generation('rir'), 3)
+        self.assertEqual(self.reader.get_generation(), 3)
+
+    def test_readers_see_previous_generation_during_reload(self):
+        seen = []
+
+        def rows():
+            yield (self.pl - 1, self.pl + 254, 'ipv4', 'DE', 'ripencc')
+            seen.append((self.reader.fetch_country_code('ipv4', 'rir',
+                                                        self.pl),
+                         self.reader.fetch_assignments('ipv4', 'KP'),
+                         self.reader.get_generation('rir')))
+            yield (self.pl + 255, self.pl + 255, 'ipv4', 'FR', 'ripencc')
+
+        self.database_cache.replace_assignments(rows(), 'rir')
+        kp = int(ipaddr.IPv4Address('175.45.176.0'))
+        self.assertEqual(seen, [('PL', [(kp, kp + 1023)], 1)])
+        self.assertEqual(
+            self.reader.fetch_country_code('ipv4', 'rir', self.pl), 'DE')
+        self.assertEqual(self.reader.fetch_assignments('ipv4', 'KP'), [])
+        self.assertEqual(self.reader.get_generation('rir'), 3)
+        self.assertEqual(self.database_cache.fetch_country_code(
+            'ipv4', 'lir', int(ipaddr.IPv4Address('213.95.6.32'))), 'DE')
+
+    def test_readers_notice_new_size_classes(self):
+        self.assertEqual(
+            self.reader.fetch_country_code('ipv4', 'rir', 2 ** 31), None)
+        self.database_cache.replace_assignments(
+            [(2 ** 31, 2 ** 32 - 1, 'ipv4', 'ZZ', 'ripencc')], 'rir')
+        self.assertEqual(
+            self.reader.fetch_country_code('ipv4', 'rir', 2 ** 31), 'ZZ')
+
+    def test_failed_reload_keeps_previous_generation(self):
+        def rows():
+            yield (self.pl - 1, self.pl + 254, 'ipv4', 'DE', 'ripencc')
+            raise IOError('truncated delegation file')
+
+        self.assertRaises(IOError, self.database_cache.replace_assignments,
+                          rows(), 'rir')
+        self.assertEqual(
+            self.reader.fetch_country_code('ipv4', 'rir', self.pl), 'PL')
+        self.assertEqual(self.reader.get_generation('rir'), 1)
+        self.downloader_parser.parse_rir_files(['test_rir_data'])
+        self.assertEqual(
+            self.reader.fetch_country_code('ipv4', 'rir', self.pl), 'PL')
+
+    def test_indexes_kept_when_replacing_one_source_type(self):
+        db = self.database_cache
+        drop_secondary_indexes = db._drop_secondary_indexes
+        dropped = []
+
+        def record_dropped(table):
+            dropped.append(table)
+            return drop_secondary_indexes(table)
+        db._drop_secondary_indexes = record_dropped
+        try:
+            self.downloader_parser.parse_rir_files(['test_rir_data'])
+            self.assertEqual(dropped, ['assignments_staging'])
+            del dropped[:]
+            db.replace_asn_assignments(
+                [(self.pl, self.pl, 'ipv4', 2500, 'routeviews')],
+                'bgp_snapshot')
+            self.assertEqual(dropped, ['asn_assignments_staging',
+                                       'asn_assignments'])
+        finally:
+            del db._drop_secondary_indexes
+        self.assertEqual(db.conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND "
+            "tbl_name IN ('assignments', 'asn_assignments') AND "
+            "sql IS NOT NULL").fetchone()[0], 5)
+        self.assertEqual(
+            self.reader.fetch_country_code('ipv4', 'rir', self.pl), 'PL')
+
+
+class CheckConcurrentAccess(BaseBlockfinderTest):
+
+    readers = 4
+
+    def _write_large_lir_file(self):
+        lir_file = gzip.open(self.test_dir + 'large_lir_data.gz', 'wb')
+        lir_file.write(gzip.open('test_lir_data.gz').read())
+        for i in range(20000):
+            lir_file.write(('\ninetnum:        10.%d.%d.0 - 10.%d.%d.255\n'
+                            'netname:        TEST-NET\n'
+                            'country:        NL\n' %
+                            (i // 256, i % 256, i // 256, i % 256)
+                            ).encode('ascii'))
+        lir_file.close()
+
+    def test_journal_mode(self):
+        self.database_cache.cursor.execute('PRAGMA journal_mode')
+        self.assertEqual(self.database_cache.cursor.fetchone()[0], 'wal')
+
+    def test_read_only_connection(self):
+        reader = blockfinder.DatabaseCache(self.test_dir, read_only=True)
+        self.assertTrue(reader.connect_to_database())
+        self.assertEqual(reader.fetch_country_code(
+            'asn', 'rir', 681), 'NZ')
+        self.assertRaises(sqlite3.OperationalError, reader.delete_assignments,
+                          'rir')
+        reader.commit_and_close_database()
+
+    def test_parallel_readers_during_lir_import(self):
+        self._write_large_lir_file()
+        ready = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        processes = [multiprocessing.Process(
+            target=read_while_importing,
+            args=(self.test_dir, ready, stop, results))
+            for _ in range(self.readers)]
+        for process in processes:
+            process.start()
+        try:
+            for _ in processes:
+                ready.get(timeout=30)
+            for _ in range(2):
+                self.downloader_parser.parse_lir_files(
+                    ['large_lir_data.gz'])
+        finally:
+            stop.set()
+        outcomes = [results.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join()
+        for lookups, errors in outcomes:
+            self.assertTrue(lookups > 0)
+            self.assertEqual(errors, [])
+        self.assertEqual(self.database_cache.fetch_country_code(
+            'ipv4', 'lir', int(ipaddr.IPv4Address('10.50.32.1'))), 'NL')
+
+
+class CheckMemoryLookupEngine(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.engine = blockfinder.MemoryLookupEngine(self.database_cache)
+
+    def probe_numbers(self, num_type, source_type):
+        for start_num, end_num, cc, span_bits in \
+                self.database_cache.fetch_ranges(num_type, source_type):
+            for num in (start_num - 1, start_num, start_num + 1,
+                        end_num - 1, end_num, end_num + 1):
+                if num >= 0:
+                    yield num
+
+    def test_same_answers_as_database(self):
+        self.database_cache.replace_assignments([
+            (2 ** 24, 2 ** 25 - 1, 'ipv4', 'AA', 'x'),
+            (2 ** 24 + 256, 2 ** 24 + 511, 'ipv4', 'BB', 'x'),
+            (2 ** 24 + 300, 2 ** 24 + 301, 'ipv4', 'CC', 'x'),
+            (2 ** 24 + 1024, 2 ** 24 + 1024, 'ipv4', 'DD', 'x'),
+            (2 ** 96, 2 ** 128 - 1, 'ipv6', 'EE', 'x'),
+            (2 ** 96 + 2 ** 64, 2 ** 96 + 2 ** 65 - 1, 'ipv6', 'FF', 'x'),
+        ], 'maxmind')
+        probes = 0
+        for source_type in ('rir', 'lir', 'maxmind'):
+            for num_type in ('ipv4', 'ipv6', 'asn'):
+                for num in self.probe_numbers(num_type, source_type):
+                    self.assertEqual(
+                        self.engine.fetch_country_code(num_type, source_type,
+                                                       num),
+                        self.database_cache.fetch_country_code(
+                            num_type, source_type, num))
+                    probes += 1
+        self.assertTrue(probes > 100)
+
+    def test_merges_adjacent_ranges(self):
+        table = blockfinder.RangeTable('ipv4', [
+            (0, 9, 'AA', 4), (10, 19, 'AA', 4), (20, 29, 'BB', 4)])
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.memory_footprint(), 20)
+        self.assertEqual(table.lookup(15), 'AA')
+        self.assertEqual(table.lookup(30), None)
+
+    def test_refresh_after_reimport(self):
+        pl = int(ipaddr.IPv4Address('193.9.25.1'))
+        self.assertEqual(self.engine.fetch_country_code('ipv4', 'rir', pl),
+                         'PL')
+        self.assertFalse(self.engine.refresh())
+        self.database_cache.replace_assignments(
+            [(pl, pl, 'ipv4', 'DE', 'ripencc')], 'rir')
+        self.assertEqual(self.engine.fetch_country_code('ipv4', 'rir', pl),
+                         'PL')
+        self.assertTrue(self.engine.refresh())
+        self.assertEqual(self.engine.fetch_country_code('ipv4', 'rir', pl),
+                         'DE')
+
+    def test_lookup_uses_engine(self):
+        lookup = blockfinder.Lookup(self.test_dir, self.database_cache,
+                                    lookup_engine=self.engine)
+        self.assertEqual(lookup.fetch_country_code('asn', 'rir', 681), 'NZ')
+        self.assertTrue(('asn', 'rir') in self.engine.tables)
+        self.assertTrue(self.engine.memory_footprint() > 0)
+
+
+class CheckCompiledDatabase(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.compiled_path = os.path.join(
+            self.test_dir, blockfinder.CompiledDatabase.file_name)
+        blockfinder.CompiledDatabase.compile(self.database_cache,
+                                             self.compiled_path)
+        self.compiled_database = blockfinder.CompiledDatabase(
+            self.compiled_path)
+
+    def tearDown(self):
+        self.compiled_database.close()
+        BaseBlockfinderTest.tearDown(self)
+
+    def test_same_answers_as_database(self):
+        self.assertEqual(sorted(self.compiled_database.tables), [
+            ('asn', 'rir'), ('ipv4', 'lir'), ('ipv4', 'rir'),
+            ('ipv6', 'lir'), ('ipv6', 'rir')])
+        for (num_type, source_type), table in \
+                self.compiled_database.tables.items():
+            for i in range(len(table)):
+                if num_type == 'ipv6':
+                    start_num = table.starts_hi[i] << 64 | table.starts_lo[i]
+                    end_num = table.ends_hi[i] << 64 | table.ends_lo[i]
+                else:
+                    start_num, end_num = table.starts[i], table.ends[i]
+                for num in (start_num - 1, start_num, end_num, end_num + 1):
+                    self.assertEqual(
+                        self.compiled_database.fetch_country_code(
+                            num_type, source_type, num),
+                        self.database_cache.fetch_country_code(
+                            num_type, source_type, num))
+        self.assertEqual(self.compiled_database.fetch_country_code(
+            'ipv4', 'maxmind', 1), None)
+        self.assertEqual(self.compiled_database.generation,
+                         self.database_cache.get_generation())
+
+    def test_missing_country_codes(self):
+        pl = int(ipaddr.IPv4Address('193.9.0.0'))
+        self.database_cache.replace_assignments(
+            [(pl, pl + 2 ** 16 - 1, 'ipv4', 'PL', 'ripencc'),
+             (pl + 2 ** 8, pl + 2 ** 9 - 1, 'ipv4', None, 'ripencc')],
+            'rir')
+        blockfinder.CompiledDatabase.compile(self.database_cache,
+                                             self.compiled_path)
+        compiled_database = blockfinder.CompiledDatabase(self.compiled_path)
+        try:
+            for num, expected in ((pl, 'PL'), (pl + 2 ** 8, None),
+                                  (pl + 2 ** 9, 'PL')):
+                self.assertEqual(self.database_cache.fetch_country_code(
+                    'ipv4', 'rir', num), expected)
+                self.assertEqual(compiled_database.fetch_country_code(
+                    'ipv4', 'rir', num), expected)
+        finally:
+            compiled_database.close()
+
+    def test_recompile_leaves_open_file_intact(self):
+        pl = int(ipaddr.IPv4Address('193.9.25.1'))
+        self.database_cache.replace_assignments(
+            [(pl, pl, 'ipv4', 'DE', 'ripencc')], 'rir')
+        blockfinder.CompiledDatabase.compile(self.database_cache,
+                                             self.compiled_path)
+        self.assertEqual(self.compiled_database.fetch_country_code(
+            'ipv4', 'rir', pl), 'PL')
+        recompiled_database = blockfinder.CompiledDatabase(
+            self.compiled_path)
+        self.assertEqual(recompiled_database.fetch_country_code(
+            'ipv4', 'rir', pl), 'DE')
+        self.assertEqual(recompiled_database.generation, 3)
+        recompiled_database.close()
+
+    def test_rejects_other_files(self):
+        self.assertRaises(ValueError, blockfinder.CompiledDatabase,
+                          self.test_dir + 'test_rir_data')
+        short_path = self.test_dir + 'short'
+        with open(short_path, 'wb') as short_file:
+            short_file.write(b'BLK')
+        self.assertRaises(ValueError, blockfinder.CompiledDatabase,
+                          short_path)
+
+
+class CheckMMDBExport(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.mmdb_path = self.test_dir + 'test.mmdb'
+
+    def check_country_database(self, source_type):
+        self.database_cache.export_mmdb(self.mmdb_path, source_type)
+        reader = MMDBReader(self.mmdb_path)
+        self.assertEqual(reader.metadata['ip_version'], 6)
+        self.assertEqual(reader.metadata['database_type'],
+                         'Blockfinder-Country')
+        self.assertEqual(reader.metadata['languages'], ['en'])
+        self.assertEqual(reader.metadata['binary_format_major_version'], 2)
+        for num_type in ('ipv4', 'ipv6'):
+            for start_num, end_num, cc, span_bits in \
+                    self.database_cache.fetch_ranges(num_type, source_type):
+                for num in (start_num - 1, start_num, end_num, end_num + 1):
+                    expected = self.database_cache.fetch_country_code(
+                        num_type, source_type, num)
+                    if expected is not None:
+                        expected = {'country': {'iso_code': expected}}
+                    self.assertEqual(reader.lookup(num), expected)
+                    if num_type == 'ipv4':
+                        self.assertEqual(reader.lookup(0xffff << 32 | num),
+                                         expected)
+
+    def test_rir_country_database(self):
+        self.check_country_database('rir')
+
+    def test_nested_lir_country_database(self):
+        self.check_country_database('lir')
+
+    def test_asn_database(self):
+        net10 = int(ipaddr.IPv4Address('10.0.0.0'))
+        doc = int(ipaddr.IPv6Address('2001:db8::'))
+        self.database_cache.replace_asn_assignments([
+            (net10, net10 + 2 ** 24 - 1, 'ipv4', 1, 'routeviews'),
+            (net10 + 2 ** 16, net10 + 2 ** 17 - 1, 'ipv4', 2, 'routeviews'),
+            (doc, doc + 2 ** 96 - 1, 'ipv6', 3, 'routeviews')],
+            'bgp_snapshot')
+        self.database_cache.replace_asn_descriptions([
+            (1, 'cidr_report', 'ONE ' + 'x' * 300),
+            (2, 'cidr_report', 'TWO ' + 'y' * 70000)])
+        self.database_cache.export_asn_mmdb(self.mmdb_path)
+        reader = MMDBReader(self.mmdb_path)
+        self.assertEqual(reader.metadata['database_type'], 'Blockfinder-ASN')
+        self.assertEqual(reader.lookup(net10 + 2 ** 16 + 5), {
+            'autonomous_system_number': 2,
+            'autonomous_system_organization': 'TWO ' + 'y' * 70000})
+        for num in (net10, net10 + 2 ** 17, net10 + 2 ** 24 - 1):
+            self.assertEqual(reader.lookup(num), {
+                'autonomous_system_number': 1,
+                'autonomous_system_organization': 'ONE ' + 'x' * 300})
+        self.assertEqual(reader.lookup(doc + 1),
+                         {'autonomous_system_number': 3})
+        self.assertEqual(reader.lookup(net10 - 1), None)
+        self.assertEqual(reader.lookup(net10 + 2 ** 24), None)
+
+    def test_asn_database_skips_as_set_origins(self):
+        net10 = int(ipaddr.IPv4Address('10.0.0.0'))
+        # Caches imported before origins were parsed hold AS sets as text.
+        self.database_cache.replace_asn_assignments([
+            (net10, net10 + 2 ** 24 - 1, 'ipv4', 1, 'routeviews'),
+            (net10, net10 + 2 ** 16 - 1, 'ipv4', '{4788,38044}',
+             'routeviews')], 'bgp_snapshot')
+        self.database_cache.export_asn_mmdb(self.mmdb_path)
+        reader = MMDBReader(self.mmdb_path)
+        for num in (net10, net10 + 2 ** 16 - 1, net10 + 2 ** 16):
+            self.assertEqual(reader.lookup(num),
+                             {'autonomous_system_number': 1})
+
+    def test_record_sizes(self):
+        ranges = {'ipv4': [(16, 31, 'AA'), (32, 32, 'BB')],
+                  'ipv6': [(2 ** 64, 2 ** 65 - 1, 'CC')]}
+        for record_size in (24, 28, 32):
+            writer = blockfinder.MMDBWriter(
+                'Test', 'Test', blockfinder.MMDBWriter.encode_string)
+            writer.write(self.mmdb_path, lambda num_type: ranges[num_type],
+                         record_size)
+            reader = MMDBReader(self.mmdb_path)
+            self.assertEqual(reader.record_size, record_size)
+            self.assertEqual([reader.lookup(num) for num in
+                              (15, 16, 31, 32, 33, 2 ** 64, 2 ** 65)],
+                             [None, 'AA', 'AA', 'BB', None, 'CC', None])
+
+
+class CheckPrefixTrie(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        snapshot = bz2.BZ2File(self.test_dir + 'test_bgp_data.bz2', 'w')
+        snapshot.write(
+            b'   Network            Next Hop    Metric LocPrf Weight Path\n'
+            b'*  175.45.176.0/22    203.62.252.83   0   0   0 1221 131279 i\n'
+            b'*  175.45.176.0/24    203.62.252.83   0   0   0 1221 131279 i\n'
+            b'*  175.45.176.128/25  203.62.252.83   0   0   0 1221 4134 i\n'
+            b'*  175.0.0.0/8        203.62.252.83   0   0   0 1221 4134 i\n'
+            b'*  2001:200::/32      2001:db8::1     0   0   0 1221 2500 i\n'
+            b'*  2001::/16          2001:db8::1     0   0   0 1221 2500 i\n')
+        snapshot.close()
+        self.downloader_parser.parse_asn_assignment_files(
+            ['test_bgp_data.bz2'])
+        self.database_cache.replace_asn_descriptions([
+            (131279, 'cidr_report', 'STAR-KP'),
+            (4134, 'cidr_report', 'CHINANET'),
+            (2500, 'cidr_report', 'WIDE')])
+        self.trie_path = os.path.join(self.test_dir,
+                                      blockfinder.ASNPrefixIndex.file_name)
+        self.index = blockfinder.ASNPrefixIndex(self.database_cache,
+                                                self.trie_path)
+
+    def test_same_announcements_as_database(self):
+        for num_type, addresses in (
+                ('ipv4', ('175.45.176.100', '175.45.176.200',
+                          '175.45.179.255', '175.1.2.3', '176.0.0.0')),
+                ('ipv6', ('2001:200::1', '2001:201::', '2002::'))):
+            for address in addresses:
+                lookup_num = int(ipaddr.ip_address(address))
+                self.assertEqual(
+                    self.index.fetch_org_by_ip_address(lookup_num, num_type),
+                    self.database_cache.fetch_org_by_ip_address(lookup_num,
+                                                                num_type))
+        kp = int(ipaddr.IPv4Address('175.45.176.200'))
+        self.assertEqual(
+            [row[0] for row in self.index.fetch_org_by_ip_address(
+                kp, 'ipv4')], [4134, 131279, 131279, 4134])
+
+    def test_longest_and_all_covering_prefixes(self):
+        trie = blockfinder.PrefixTrie('ipv4')
+        prefixes = {}
+        random.seed(1)
+        for as_num in range(2000):
+            prefix_len = random.choice((0, 8, 12, 16, 20, 23, 24, 32))
+            net = random.getrandbits(32) >> (32 - prefix_len) \
+                << (32 - prefix_len) if prefix_len else 0
+            trie.insert(net, prefix_len, as_num)
+            prefixes[(net, prefix_len)] = as_num
+        for i in range(500):
+            lookup_num = random.getrandbits(32)
+            expected = []
+            for prefix_len in range(32, -1, -1):
+                host_bits = 32 - prefix_len
+                net = lookup_num >> host_bits << host_bits
+                if (net, prefix_len) in prefixes:
+                    expected.append((prefixes[(net, prefix_len)], net,
+                                     net + (1 << host_bits) - 1))
+            self.assertEqual(trie.covering(lookup_num), expected)
+            self.assertEqual(trie.longest_match(lookup_num), expected[0])
+
+    def test_saved_and_rebuilt_by_generation(self):
+        kp = int(ipaddr.IPv4Address('175.45.176.100'))
+        self.index.load()
+        self.assertTrue(os.path.exists(self.trie_path))
+        index = blockfinder.ASNPrefixIndex(self.database_cache,
+                                           self.trie_path)
+
+        def fail(num_type):
+            raise AssertionError('rebuilt an up-to-date trie')
+        index._build = fail
+        self.assertEqual(index.fetch_org_by_ip_address(kp, 'ipv4'),
+                         self.index.fetch_org_by_ip_address(kp, 'ipv4'))
+        self.database_cache.replace_asn_assignments(
+            [(kp, kp, 'ipv4', 2500, 'routeviews')], 'bgp_snapshot')
+        del index._build
+        self.assertEqual(index.fetch_org_by_ip_address(kp, 'ipv4'),
+                         [(2500, 'WIDE', kp, kp + 1)])
+        with open(self.trie_path, 'r+b') as trie_file:
+            trie_file.truncate(100)
+        index = blockfinder.ASNPrefixIndex(self.database_cache,
+                                           self.trie_path)
+        self.assertEqual(index.fetch_org_by_ip_address(kp, 'ipv4'),
+                         [(2500, 'WIDE', kp, kp + 1)])
+
+    def test_lookup_org_by_ip(self):
+        output = []
+
+        class Output(object):
+            def write(self, text):
+                output.append(text)
+
+        stdout, sys.stdout = sys.stdout, Output()
+        try:
+            self.lookup.lookup_org_by_ip('175.45.176.100')
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(''.join(output).splitlines(), [
+            '175.45.176.100 in 175.45.176.0/24 announced by AS131279 - '
+            'STAR-KP',
+            '175.45.176.100 in 175.45.176.0/22 announced by AS131279 - '
+            'STAR-KP',
+            '175.45.176.100 in 175.0.0.0/8 announced by AS4134 - CHINANET'])
+
+    def test_as_set_origins(self):
+        snapshot = bz2.BZ2File(self.test_dir + 'test_bgp_data.bz2', 'w')
+        snapshot.write(
+            b'*  1.0.0.0/24         203.62.252.83   0   0   0 1221 13335 i\n'
+            b'*  1.0.0.0/16         203.62.252.83   0   0   0 1221 '
+            b'{4788,38044} i\n')
+        snapshot.close()
+        self.downloader_parser.parse_asn_assignment_files(
+            ['test_bgp_data.bz2'])
+        self.database_cache.replace_asn_descriptions([
+            (13335, 'cidr_report', 'Cloudflare'),
+            (4788, 'cidr_report', 'TMNET')])
+        cloudflare = int(ipaddr.IPv4Address('1.0.0.1'))
+        expected = [(13335, 'Cloudflare', cloudflare - 1, cloudflare + 255)]
+        self.assertEqual(
+            self.index.fetch_org_by_ip_address(cloudflare, 'ipv4'), expected)
+        # Caches imported before origins were parsed hold AS sets as text.
+        self.database_cache.replace_asn_assignments([
+            (cloudflare - 1, cloudflare + 254, 'ipv4', 13335, 'routeviews'),
+            (cloudflare - 1, cloudflare + 65534, 'ipv4', '{4788,38044}',
+             'routeviews')], 'bgp_snapshot')
+        self.assertEqual(
+            self.index.fetch_org_by_ip_address(cloudflare, 'ipv4'), expected)
+        self.assertEqual(
+            self.database_cache.fetch_org_by_ip_address(cloudflare, 'ipv4'),
+            expected)
+
+
+class CheckRIRParser(unittest.TestCase):
+
+    def parse_with_dicts(self, lines):
+        """ Parse delegated file lines like _iter_rir_rows did before it
+            used parse_rir_lines. """
+        keys = "registry country_code type start value date status".split()
+        for line in lines:
+            line = line.decode('ascii')
+            if line.startswith("#"):
+                continue
+            entry = dict((k, v) for k, v in
+                         zip(keys, line.strip().split("|")))
+            source_name = str(entry['registry'])
+            country_code = str(entry['country_code'])
+            if source_name.replace(
+                    ".", "", 1).isdigit() or country_code == "*":
+                continue
+            num_type = entry['type']
+            if num_type == 'asn':
+                start_num = end_num = int(entry['start'])
+            elif num_type == 'ipv4':
+                start_num = int(ipaddr.IPv4Address(entry['start']))
+                end_num = start_num + int(entry['value']) - 1
+            elif num_type == 'ipv6':
+                network_ipaddr = ipaddr.IPv6Network(
+                    entry['start'] + '/' + entry['value'])
+                start_num = int(network_ipaddr.network_address)
+                end_num = int(network_ipaddr.broadcast_address)
+            yield (start_num, end_num, num_type, country_code, source_name)
+
+    def test_same_rows_as_dict_parser(self):
+        with open('test_rir_data', 'rb') as rir_file:
+            lines = rir_file.readlines()
+        lines.extend([
+            b'# a comment|with|pipes|in|it|and|more\n',
+            b'2.3|arin|1312400255942|23486|19700101|20110803|-0400\n',
+            b'arin|US|ipv6|::|8|20100101|allocated\n',
+            b'arin|US|ipv6|2001:db8::1:0:0:0|80|20100101|allocated\n',
+            b'arin|US|ipv6|2001:db8:0:0:0:0:0:0|128|20100101|allocated\n',
+            b'arin|US|ipv6|::ffff:10.0.0.0|120|20100101|allocated\n',
+            b'arin|US|ipv6|fe80::|10|20100101|allocated|e-stats\n',
+            b'lacnic|BR|ipv4|0.0.0.0|4294967296|20100101|allocated\n',
+            b'afrinic|ZA|asn|37000|16|20100101|allocated\r\n'])
+        rows = list(blockfinder.parse_rir_lines(lines))
+        self.assertEqual(rows, list(self.parse_with_dicts(lines)))
+        self.assertEqual(len(rows), 18)
+
+    def test_malformed_lines(self):
+        lines = [b'\n', b'apnic|JP|ipv4\n',
+                 b'apnic|JP|opaque|1|1|20100101|allocated\n']
+        self.assertEqual(list(blockfinder.parse_rir_lines(lines)), [])
+        for line in (b'apnic|JP|ipv4|1.2.3|256|20100101|allocated\n',
+                     b'apnic|JP|ipv6|2001:db8|32|20100101|allocated\n',
+                     b'apnic|JP|asn|AS1|1|20100101|allocated\n'):
+            self.assertRaises(ValueError, list,
+                              blockfinder.parse_rir_lines([line]))
+
+
+class CheckParallelImport(BaseBlockfinderTest):
+
+    def write_rir_file(self, file_name, seed):
+        rng = random.Random(seed)
+        with open(self.test_dir + file_name, 'w') as rir_file:
+            rir_file.write('2|%s|20240101|3000|19830705|20240101|+0100\n'
+                           '%s|*|ipv4|*|3000|summary\n' %
+                           (file_name, file_name))
+            for i in range(3000):
+                rir_file.write('%s|%s|ipv4|%s|%d|20100101|allocated\n' % (
+                    file_name, rng.choice(['DE', 'NL', 'US']),
+                    ipaddr.IPv4Address(rng.getrandbits(24) << 8),
+                    256 << rng.randint(0, 4)))
+
+    def dump_assignments(self):
+        return self.database_cache.conn.execute(
+            'SELECT * FROM assignments ORDER BY rowid').fetchall() + \
+            self.database_cache.conn.execute(
+                'SELECT * FROM country_cidrs ORDER BY rowid').fetchall()
+
+    def test_chunks_cover_every_line_once(self):
+        with open('test_rir_data', 'rb') as rir_file:
+            expected = list(blockfinder.parse_rir_lines(rir_file))
+        size = os.path.getsize('test_rir_data')
+        for chunk_size in (1, 2, 7, 48, 49, 50, 1000, size):
+            rows = []
+            for start in range(0, size, chunk_size):
+                rows.extend(blockfinder._parse_rir_chunk(
+                    ('test_rir_data', start, start + chunk_size)))
+            self.assertEqual(rows, expected, chunk_size)
+
+    def test_same_end_state_as_serial_import(self):
+        rir_urls = ['test_rir_data']
+        for i in range(3):
+            self.write_rir_file('synthetic_%d' % i, i)
+            rir_urls.append('synthetic_%d' % i)
+        self.downloader_parser.parse_rir_files(rir_urls)
+        serial = self.dump_assignments()
+        self.assertTrue(len(serial) > 9000)
+        self.downloader_parser.jobs = 4
+        self.downloader_parser.rir_chunk_size = 4096
+        self.downloader_parser.parse_rir_files(rir_urls)
+        self.assertEqual(self.dump_assignments(), serial)
+        self.assertEqual(self.database_cache.fetch_country_code(
+            'ipv4', 'rir', int(ipaddr.IPv4Address('193.9.25.1'))), 'PL')
+
+
+class CheckIncrementalImport(BaseBlockfinderTest):
+
+    write_rir_file = CheckParallelImport.write_rir_file
+
+    def change_rir_file(self, file_name, seed):
+        """ Change the country codes of some lines of an RIR file, drop
+            some lines, and add some, like a day of changes in a delegated
+            file. """
+        rng = random.Random(seed)
+        with open(self.test_dir + file_name) as rir_file:
+            lines = rir_file.readlines()
+        changed_lines = lines[:2]
+        for line in lines[2:]:
+            fields = line.split('|')
+            choice = rng.random()
+            if choice < 0.02:
+                continue
+            if choice < 0.04:
+                fields[1] = rng.choice(['FR', 'GB', 'NL'])
+            elif choice < 0.05:
+                changed_lines.append('%s|IT|ipv4|%s|256|20240101|'
+                                     'allocated\n' % (fields[0], ipaddr.
+                                     IPv4Address(rng.getrandbits(24) << 8)))
+            changed_lines.append('|'.join(fields))
+        with open(self.test_dir + file_name, 'w') as rir_file:
+            rir_file.writelines(changed_lines)
+
+    def full_reimport(self, rir_urls):
+        database_cache = blockfinder.DatabaseCache(self.test_dir +
+                                                   'reimport/')
+        database_cache.connect_to_database()
+        downloader_parser = blockfinder.DownloaderParser(
+            self.test_dir, database_cache, "Mozilla")
+        downloader_parser.parse_rir_files(rir_urls)
+        dump = self.dump_sorted(database_cache)
+        database_cache.commit_and_close_database()
+        return dump
+
+    def dump_sorted(self, database_cache):
+        return sorted(database_cache.conn.execute(
+            "SELECT * FROM assignments WHERE source_type = 'rir'"
+            ).fetchall(), key=repr) + sorted(database_cache.conn.execute(
+                "SELECT * FROM country_cidrs WHERE source_type = 'rir'"
+                ).fetchall(), key=repr)
+
+    def test_same_end_state_as_full_reimport(self):
+        rir_urls = ['test_rir_data']
+        for i in range(3):
+            self.write_rir_file('synthetic_%d' % i, i)
+            rir_urls.append('synthetic_%d' % i)
+        self.assertEqual(self.downloader_parser.parse_rir_files(
+            rir_urls, incremental=True)[1:], (0, 0))
+        self.assertEqual(self.dump_sorted(self.database_cache),
+                         self.full_reimport(rir_urls))
+        for i in range(3):
+            self.change_rir_file('synthetic_%d' % i, i)
+        inserted, updated, deleted = self.downloader_parser.parse_rir_files(
+            rir_urls, incremental=True)
+        self.assertTrue(inserted > 0 and updated > 0 and deleted > 0)
+        self.assertTrue(inserted + updated + deleted < 1000)
+        self.assertEqual(self.dump_sorted(self.database_cache),
+                         self.full_reimport(rir_urls))
+
+    def test_no_changes(self):
+        generation = self.database_cache.get_generation('rir')
+        self.assertEqual(self.downloader_parser.parse_rir_files(
+            ['test_rir_data'], incremental=True), (0, 0, 0))
+        self.assertEqual(self.database_cache.get_generation('rir'),
+                         generation)
+        self.assertEqual(self.database_cache.conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = "
+            "'assignments_staging'").fetchone()[0], 0)
+
+    def test_duplicate_ranges(self):
+        rows = [(10, 19, 'ipv4', 'DE', 'test'),
+                (10, 19, 'ipv4', 'NL', 'test'),
+                (10, 19, 'ipv4', 'NL', 'test'),
+                (20, 29, 'ipv4', 'FR', 'test')]
+        self.database_cache.update_assignments(rows, 'test')
+        changed_rows = [(10, 19, 'ipv4', 'NL', 'test'),
+                        (10, 19, 'ipv4', 'BE', 'test'),
+                        (20, 29, 'ipv4', 'FR', 'test'),
+                        (20, 29, 'ipv4', 'FR', 'test')]
+        self.assertEqual(self.database_cache.update_assignments(
+            changed_rows, 'test'), (1, 1, 1))
+        self.assertEqual(sorted(self.database_cache.conn.execute(
+            "SELECT start_num, country_code FROM assignments WHERE "
+            "source_type = 'test'").fetchall()),
+            [(10, 'BE'), (10, 'NL'), (20, 'FR'), (20, 'FR')])
+        self.assertEqual(self.database_cache.update_assignments(
+            changed_rows[1:2], 'test'), (0, 0, 3))
+        self.assertEqual(self.database_cache.fetch_country_cidrs(
+            'ipv4', 'BE'), ['0.0.0.10/31', '0.0.0.12/30', '0.0.0.16/30'])
+        self.assertEqual(self.database_cache.fetch_country_cidrs(
+            'ipv4', 'FR'), [])
+
+
+class CheckLIRParser(BaseBlockfinderTest):
+
+    def parse_line_by_line(self, lir_path):
+        """ Parse an LIR file like _iter_lir_rows did before it parsed
+            chunks of whole objects. """
+        lir_file = gzip.open(lir_path)
+        entry = False
+        for line in lir_file:
+            line = line.decode('utf-8', 'ignore').replace("\n", "")
+            if line == "":
+                entry = False
+            elif not entry and "inetnum:" in line:
+                try:
+                    line = line.replace("inetnum:", "").strip()
+                    start_num = int(ipaddr.IPv4Address(
+                        line.split("-")[0].strip()))
+                    end_num = int(ipaddr.IPv4Address(
+                        line.split("-")[1].strip()))
+                    entry = True
+                    num_type = 'ipv4'
+                except Exception:
+                    pass
+            elif not entry and "inet6num:" in line:
+                try:
+                    network_ipaddr = ipaddr.IPv6Network(
+                        line.replace("inet6num:", "").strip())
+                    start_num = int(network_ipaddr.network_address)
+                    end_num = int(network_ipaddr.broadcast_address)
+                    entry = True
+                    num_type = 'ipv6'
+                except Exception:
+                    pass
+            elif entry and "country:" in line:
+                yield (start_num, end_num, num_type,
+                       line.replace("country:", "").strip(), 'ripencc')
+        lir_file.close()
+
+    def write_lir_file(self):
+        lir_file = gzip.open(self.test_dir + 'edge_lir_data.gz', 'wb')
+        lir_file.write(gzip.open('test_lir_data.gz').read())
+        lir_file.write(
+            b'\n\n\ninetnum:        10.0.0.0 - 10.0.0.999\n'
+            b'remarks:        inetnum: 10.1.0.0 - 10.1.0.255\n'
+            b'country:        NL\n'
+            b'country:        BE # and more\n\n'
+            b'country:        FR\n'
+            b'inet6num:       2001:db8::1/32\n'
+            b'inet6num:       2001:db8::/32\n'
+            b'descr:          Caf\xc3\xa9\n'
+            b'country:        DE\n\n'
+            b'inet6num:       2001:db8::1\n'
+            b'country:        AT\n\n'
+            b'inetnum:        10.2.0.0\n'
+            b'country:        CH\n\n'
+            b'inet6num:       2001:db8:1::/48\n'
+            b'remarks:        country: LU')
+        for i in range(300):
+            lir_file.write(('\n\ninetnum:        10.3.%d.0 - 10.3.%d.255\n'
+                            'netname:        TEST-NET\n'
+                            'country:        NL\n' % (i, i)
+                            ).encode('ascii'))
+        lir_file.close()
+
+    def test_same_rows_as_line_by_line_parser(self):
+        self.write_lir_file()
+        expected = list(self.parse_line_by_line(
+            self.test_dir + 'edge_lir_data.gz'))
+        self.assertEqual(len(expected), 268)
+        for chunk_size, jobs in ((1, 1), (100, 1), (4096, 1), (1000, 3),
+                                 (2 ** 20, 2)):
+            self.downloader_parser.lir_chunk_size = chunk_size
+            self.downloader_parser.jobs = jobs
+            self.assertEqual(list(self.downloader_parser._iter_lir_rows(
+                ['edge_lir_data.gz'])), expected, (chunk_size, jobs))
+
+    def test_same_end_state_in_parallel(self):
+        serial = self.database_cache.conn.execute(
+            "SELECT * FROM assignments WHERE source_type = 'lir' "
+            "ORDER BY rowid").fetchall()
+        self.downloader_parser.jobs = 2
+        self.downloader_parser.lir_chunk_size = 512
+        self.downloader_parser.parse_lir_files(['test_lir_data.gz'])
+        self.assertEqual(self.database_cache.conn.execute(
+            "SELECT * FROM assignments WHERE source_type = 'lir' "
+            "ORDER BY rowid").fetchall(), serial)
+
+    def test_truncated_file_fails_import(self):
+        with open('test_lir_data.gz', 'rb') as lir_file:
+            data = lir_file.read()
+        with open(self.test_dir + 'truncated_lir_data.gz', 'wb') as lir_file:
+            lir_file.write(data[:len(data) // 2])
+        self.downloader_parser.jobs = 2
+        self.downloader_parser.lir_chunk_size = 512
+        self.assertRaises(EOFError, self.downloader_parser.parse_lir_files,
+                          ['truncated_lir_data.gz'])
+        self.assertEqual(self.database_cache.fetch_country_code(
+            'ipv4', 'lir', int(ipaddr.IPv4Address('80.16.151.184'))), 'IT')
+
+
+class CheckDecompression(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.gzip_command = blockfinder.DecompressionBackend(
+            'gzip-command', '.gz', command=['gzip', '-dc'])
+        if not self.gzip_command.available():
+            self.skipTest('gzip command not found')
+        blockfinder.decompression_backends.insert(0, self.gzip_command)
+        self.addCleanup(blockfinder.decompression_backends.remove,
+                        self.gzip_command)
+        with gzip.open('test_lir_data.gz') as lir_file:
+            self.data = lir_file.read()
+
+    def test_command_backend(self):
+        reader = blockfinder.open_compressed('test_lir_data.gz')
+        self.assertTrue(isinstance(reader, blockfinder.CommandReader))
+        self.assertEqual(reader.read(), self.data)
+        reader.close()
+        with blockfinder.open_compressed('test_lir_data.gz') as reader:
+            self.assertEqual(b''.join(reader), self.data)
+        with blockfinder.open_compressed('test_lir_data.gz') as reader:
+            chunks = iter(lambda: reader.read(1000), b'')
+            self.assertEqual(b''.join(chunks), self.data)
+
+    def test_named_backend(self):
+        reader = blockfinder.open_compressed('test_lir_data.gz', 'gzip')
+        self.assertFalse(isinstance(reader, blockfinder.CommandReader))
+        self.assertEqual(reader.read(), self.data)
+        reader.close()
+        self.assertRaises(ValueError, blockfinder.open_compressed,
+                          'test_lir_data.gz', 'no-such-backend')
+
+    def test_fallback_for_other_suffixes(self):
+        bz2_path = self.test_dir + 'test_lir_data.bz2'
+        with bz2.BZ2File(bz2_path, 'wb') as bz2_file:
+            bz2_file.write(self.data)
+        reader = blockfinder.open_compressed(bz2_path, 'gzip-command')
+        self.assertEqual(reader.read(), self.data)
+        reader.close()
+        plain_path = self.test_dir + 'test_lir_data'
+        with open(plain_path, 'wb') as plain_file:
+            plain_file.write(self.data)
+        with blockfinder.open_compressed(plain_path) as reader:
+            self.assertEqual(reader.read(), self.data)
+
+    def test_zstd_backend(self):
+        zstd = blockfinder.DecompressionBackend('zstd', '.zst',
+                                                command=['zstd', '-dcq'])
+        if not zstd.available():
+            self.skipTest('zstd command not found')
+        zst_path = self.test_dir + 'test_lir_data.zst'
+        with open(zst_path, 'wb') as zst_file:
+            zst_file.write(blockfinder.subprocess.Popen(
+                ['zstd', '-cq'], stdin=blockfinder.subprocess.PIPE,
+                stdout=blockfinder.subprocess.PIPE).communicate(self.data)[0])
+        with blockfinder.open_compressed(zst_path) as reader:
+            self.assertEqual(reader.read(), self.data)
+
+    def test_truncated_file(self):
+        with open('test_lir_data.gz', 'rb') as lir_file:
+            data = lir_file.read()
+        with open(self.test_dir + 'truncated_lir_data.gz', 'wb') as lir_file:
+            lir_file.write(data[:len(data) // 2])
+        reader = blockfinder.open_compressed(
+            self.test_dir + 'truncated_lir_data.gz')
+        self.assertRaises(IOError, reader.read)
+        reader.close()
+
+    def test_close_before_end(self):
+        reader = blockfinder.open_compressed('test_lir_data.gz')
+        self.assertEqual(reader.read(10), self.data[:10])
+        reader.close()
+        self.assertNotEqual(reader.process.returncode, None)
+
+    def test_same_rows_through_command(self):
+        expected = list(self.downloader_parser._iter_lir_rows(
+            ['test_lir_data.gz']))
+        self.downloader_parser.decompression = 'gzip-command'
+        self.downloader_parser.jobs = 2
+        self.assertEqual(list(self.downloader_parser._iter_lir_rows(
+            ['test_lir_data.gz'])), expected)
+
+
+class ImportInterrupted(Exception):
+    pass
+
+
+class CheckResumableImport(BaseBlockfinderTest):
+
+    write_lir_file = CheckLIRParser.write_lir_file
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.write_lir_file()
+        self.database_cache.bulk_batch_size = 50
+        self.downloader_parser.parse_lir_files(['edge_lir_data.gz'])
+        self.lir_rows = self.dump_table('assignments', 'lir')
+
+    def interrupt_import(self, method_name, row_count, *args):
+        """ Run an import whose rows stop with an exception after the given
+            number of rows, as if the process had been killed. """
+        iter_rows = getattr(self.downloader_parser, method_name)
+
+        def interrupted_rows(urls):
+            for i, row in enumerate(iter_rows(urls)):
+                if i == row_count:
+                    raise ImportInterrupted()
+                yield row
+        setattr(self.downloader_parser, method_name, interrupted_rows)
+        try:
+            self.assertRaises(ImportInterrupted, *args)
+        finally:
+            delattr(self.downloader_parser, method_name)
+
+    def dump_table(self, table, source_type):
+        return self.database_cache.conn.execute(
+            'SELECT * FROM %s WHERE source_type = ? ORDER BY rowid' % table,
+            (source_type, )).fetchall()
+
+    def mark_staging_row(self, table):
+        self.database_cache.conn.execute(
+            "UPDATE %s_staging SET source_name = 'marked' WHERE rowid = 1" %
+            table)
+        self.database_cache.conn.commit()
+
+    def test_resume_lir_import(self):
+        self.interrupt_import('_iter_lir_rows', 175,
+                              self.downloader_parser.parse_lir_files,
+                              ['edge_lir_data.gz'])
+        self.assertEqual(self.dump_table('assignments', 'lir'),
+                         self.lir_rows)
+        checkpoint = self.database_cache.get_import_checkpoint(
+            'assignments')
+        self.assertEqual(checkpoint[0], 'lir')
+        self.assertEqual(checkpoint[2:], (150, 3))
+        self.assertEqual(self.database_cache.conn.execute(
+            'SELECT COUNT(*) FROM assignments_staging').fetchone()[0], 150)
+        self.mark_staging_row('assignments')
+        self.downloader_parser.resume = True
+        self.downloader_parser.parse_lir_files(['edge_lir_data.gz'])
+        resumed_rows = self.dump_table('assignments', 'lir')
+        self.assertEqual(len(resumed_rows), len(self.lir_rows))
+        self.assertEqual([row for row in resumed_rows
+                          if row[5] == 'marked'], [resumed_rows[0]])
+        self.assertEqual(resumed_rows[1:], self.lir_rows[1:])
+        self.assertEqual(self.database_cache.get_import_checkpoint(
+            'assignments'), None)
+        self.assertEqual(self.database_cache.conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = "
+            "'assignments_staging'").fetchone()[0], 0)
+
+    def test_resume_after_failure_inside_batch(self):
+        advance_import_checkpoint = \
+            self.database_cache._advance_import_checkpoint
+        batches = []
+
+        def fail_second_batch(staging_table, row_count):
+            batches.append(row_count)
+            if len(batches) == 2:
+                raise ImportInterrupted()
+            advance_import_checkpoint(staging_table, row_count)
+        self.database_cache._advance_import_checkpoint = fail_second_batch
+        try:
+            self.assertRaises(ImportInterrupted,
+                              self.downloader_parser.parse_lir_files,
+                              ['edge_lir_data.gz'])
+        finally:
+            del self.database_cache._advance_import_checkpoint
+        self.assertEqual(self.database_cache.get_import_checkpoint(
+            'assignments')[2:], (50, 1))
+        self.assertEqual(self.database_cache.conn.execute(
+            'SELECT COUNT(*) FROM assignments_staging').fetchone()[0], 50)
+        self.downloader_parser.resume = True
+        self.downloader_parser.parse_lir_files(['edge_lir_data.gz'])
+        self.assertEqual(self.dump_table('assignments', 'lir'),
+                         self.lir_rows)
+
+    def test_start_over_without_resume(self):
+        self.interrupt_import('_iter_lir_rows', 175,
+                              self.downloader_parser.parse_lir_files,
+                              ['edge_lir_data.gz'])
+        self.mark_staging_row('assignments')
+        self.downloader_parser.parse_lir_files(['edge_lir_data.gz'])
+        self.assertEqual(self.dump_table('assignments', 'lir'),
+                         self.lir_rows)
+
+    def test_start_over_after_input_changes(self):
+        self.interrupt_import('_iter_lir_rows', 175,
+                              self.downloader_parser.parse_lir_files,
+                              ['edge_lir_data.gz'])
+        self.mark_staging_row('assignments')
+        lir_path = self.test_dir + 'edge_lir_data.gz'
+        os.utime(lir_path, (0, 0))
+        self.downloader_parser.resume = True
+        self.downloader_parser.parse_lir_files(['edge_lir_data.gz'])
+        self.assertEqual(self.dump_table('assignments', 'lir'),
+                         self.lir_rows)
+
+    def test_resume_asn_assignment_import(self):
+        snapshot = bz2.BZ2File(self.test_dir + 'test_bgp_data.bz2', 'w')
+        for i in range(200):
+            snapshot.write(('*  10.%d.0.0/16    203.62.252.83   0   0   0 '
+                            '1221 %d i\n' % (i, 64512 + i)).encode('ascii'))
+        snapshot.close()
+        self.downloader_parser.parse_asn_assignment_files(
+            ['test_bgp_data.bz2'])
+        asn_rows = self.dump_table('asn_assignments', 'bgp_snapshot')
+        self.assertEqual(len(asn_rows), 200)
+        self.database_cache.delete_asn_assignments()
+        self.interrupt_import('_iter_asn_assignment_rows', 120,
+                              self.downloader_parser.
+                              parse_asn_assignment_files,
+                              ['test_bgp_data.bz2'])
+        self.assertEqual(self.database_cache.get_import_checkpoint(
+            'asn_assignments')[2:], (100, 2))
+        self.assertEqual(self.dump_table('asn_assignments', 'bgp_snapshot'),
+                         [])
+        self.downloader_parser.resume = True
+        self.downloader_parser.parse_asn_assignment_files(
+            ['test_bgp_data.bz2'])
+        self.assertEqual(self.dump_table('asn_assignments', 'bgp_snapshot'),
+                         asn_rows)
+
+
+class CheckConcurrentDownloads(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.servers = []
+        for i in range(2):
+            files = dict(('/pub/file_%d_%d' % (i, j),
+                          os.urandom(10000 + j)) for j in range(4))
+            self.servers.append(ThrottledHTTPServer(files))
+        self.urls = [server.url(path) for server in self.servers
+                     for path in sorted(server.files)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        BaseBlockfinderTest.tearDown(self)
+
+    def test_download_files(self):
+        self.assertEqual(self.downloader_parser.download_files(self.urls),
+                         self.urls)
+        for server in self.servers:
+            for path, data in server.files.items():
+                with open(self.test_dir + path.split('/')[-1], 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            self.assertEqual(server.max_active_requests,
+                             self.downloader_parser.downloads_per_host)
+
+    def test_thread_limit(self):
+        self.downloader_parser.download_threads = 1
+        self.downloader_parser.downloads_per_host = 4
+        self.assertEqual(self.downloader_parser.download_files(self.urls),
+                         self.urls)
+        for server in self.servers:
+            self.assertEqual(server.max_active_requests, 1)
+
+    def test_failed_downloads(self):
+        urls = [self.servers[0].url('/missing'), self.urls[0],
+                self.servers[1].url('/also/missing')]
+        self.assertEqual(self.downloader_parser.download_files(urls),
+                         [urls[1]])
+        self.assertTrue(os.path.exists(self.test_dir + 'file_0_0'))
+        self.assertFalse(os.path.exists(self.test_dir + 'missing'))
+
+
+class CheckConditionalDownloads(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        with open('test_lir_data.gz', 'rb') as lir_file:
+            self.lir_data = lir_file.read()
+        self.server = ThrottledHTTPServer(
+            {'/ripe/test_lir_data.gz': self.lir_data,
+             '/ripe/other_file': b'other'}, pieces=1, delay=0)
+        self.urls = [self.server.url('/ripe/test_lir_data.gz'),
+                     self.server.url('/ripe/other_file')]
+        os.remove(self.test_dir + 'test_lir_data.gz')
+
+    def tearDown(self):
+        self.server.stop()
+        BaseBlockfinderTest.tearDown(self)
+
+    def test_not_modified(self):
+        self.assertEqual(self.downloader_parser.download_files(self.urls),
+                         self.urls)
+        metadata = self.downloader_parser.download_metadata.get(
+            self.test_dir + 'test_lir_data.gz')
+        self.assertEqual(metadata['sha256'],
+                         hashlib.sha256(self.lir_data).hexdigest())
+        self.assertEqual(metadata['size'], len(self.lir_data))
+        self.assertEqual(self.downloader_parser.download_files(self.urls),
+                         [])
+        self.assertEqual(sorted(self.server.requests[2:]),
+                         [('/ripe/other_file', 304),
+                          ('/ripe/test_lir_data.gz', 304)])
+        with open(self.test_dir + 'test_lir_data.gz', 'rb') as lir_file:
+            self.assertEqual(lir_file.read(), self.lir_data)
+        self.server.files['/ripe/other_file'] = b'changed'
+        self.assertEqual(self.downloader_parser.download_files(self.urls),
+                         self.urls[1:])
+        with open(self.test_dir + 'other_file', 'rb') as other_file:
+            self.assertEqual(other_file.read(), b'changed')
+
+    def test_last_modified(self):
+        self.server.etags = False
+        self.downloader_parser.download_files(self.urls)
+        self.assertEqual(self.downloader_parser.download_files(self.urls),
+                         [])
+        self.server.last_modified = False
+        self.assertEqual(self.downloader_parser.download_files(self.urls),
+                         self.urls)
+
+    def test_changed_local_file(self):
+        self.downloader_parser.download_files(self.urls)
+        with open(self.test_dir + 'other_file', 'wb') as other_file:
+            other_file.write(b'local changes')
+        os.remove(self.test_dir + 'test_lir_data.gz')
+        self.assertEqual(self.downloader_parser.download_files(self.urls),
+                         self.urls)
+        with open(self.test_dir + 'other_file', 'rb') as other_file:
+            self.assertEqual(other_file.read(), b'other')
+
+    def test_skip_unchanged_import(self):
+        lir_urls = self.urls[:1]
+        self.assertTrue(self.downloader_parser.needs_import(lir_urls))
+        self.downloader_parser.download_files(lir_urls)
+        self.assertTrue(self.downloader_parser.needs_import(lir_urls))
+        self.downloader_parser.parse_lir_files(lir_urls)
+        self.assertFalse(self.downloader_parser.needs_import(lir_urls))
+        self.downloader_parser.download_files(lir_urls)
+        self.assertFalse(self.downloader_parser.needs_import(lir_urls))
+        self.server.files['/ripe/test_lir_data.gz'] = self.lir_data * 2
+        self.downloader_parser.download_files(lir_urls)
+        self.assertTrue(self.downloader_parser.needs_import(lir_urls))
+        self.downloader_parser.parse_lir_files(lir_urls)
+        self.database_cache.erase_database()
+        self.assertTrue(self.downloader_parser.needs_import(lir_urls))
+
+
+class CheckResumedDownloads(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.data = os.urandom(10000)
+        self.server = ThrottledHTTPServer({'/dump.bz2': self.data},
+                                          pieces=1, delay=0)
+        self.url = self.server.url('/dump.bz2')
+        self.file_path = self.test_dir + 'dump.bz2'
+
+    def tearDown(self):
+        self.server.stop()
+        BaseBlockfinderTest.tearDown(self)
+
+    def check_downloaded(self, data):
+        with open(self.file_path, 'rb') as dump_file:
+            self.assertEqual(dump_file.read(), data)
+        self.assertFalse(os.path.exists(self.file_path + '.part'))
+        self.assertEqual(self.downloader_parser.download_metadata.get(
+            self.file_path + '.part', unchanged=False), None)
+        self.assertEqual(self.downloader_parser.download_metadata.get(
+            self.file_path)['sha256'], hashlib.sha256(data).hexdigest())
+
+    def test_resume_after_dropped_connections(self):
+        self.server.drops = [3000, 4000]
+        self.assertEqual(self.downloader_parser.download_files([self.url]),
+                         [self.url])
+        self.assertEqual([status for _, status in self.server.requests],
+                         [200, 206, 206])
+        self.check_downloaded(self.data)
+
+    def test_resume_in_next_download(self):
+        with open(self.file_path, 'wb') as dump_file:
+            dump_file.write(b'previous dump')
+        self.downloader_parser.download_attempts = 1
+        self.server.drops = [3000]
+        self.assertEqual(self.downloader_parser.download_files([self.url]),
+                         [])
+        with open(self.file_path, 'rb') as dump_file:
+            self.assertEqual(dump_file.read(), b'previous dump')
+        self.assertEqual(os.path.getsize(self.file_path + '.part'), 3000)
+        self.assertEqual(self.downloader_parser.download_files([self.url]),
+                         [self.url])
+        self.assertEqual([status for _, status in self.server.requests],
+                         [200, 206])
+        self.check_downloaded(self.data)
+
+    def test_server_without_ranges(self):
+        self.server.ranges = False
+        self.server.drops = [3000, 6000]
+        self.assertEqual(self.downloader_parser.download_files([self.url]),
+                         [self.url])
+        self.assertEqual([status for _, status in self.server.requests],
+                         [200, 200, 200])
+        self.check_downloaded(self.data)
+
+    def test_changed_resource(self):
+        self.downloader_parser.download_attempts = 1
+        self.server.drops = [3000]
+        self.downloader_parser.download_files([self.url])
+        data = os.urandom(5000)
+        self.server.files['/dump.bz2'] = data
+        self.assertEqual(self.downloader_parser.download_files([self.url]),
+                         [self.url])
+        self.assertEqual([status for _, status in self.server.requests],
+                         [200, 200])
+        self.check_downloaded(data)
+
+    def test_partial_file_removed_when_not_modified(self):
+        self.downloader_parser.download_files([self.url])
+        part_path = self.file_path + '.part'
+        with open(part_path, 'wb') as part_file:
+            part_file.write(b'stale partial dump')
+        self.downloader_parser.download_metadata.update(
+            part_path, etag=self.downloader_parser.download_metadata.get(
+                self.file_path)['etag'])
+        self.assertEqual(self.downloader_parser.download_files([self.url]),
+                         [])
+        self.assertEqual([status for _, status in self.server.requests],
+                         [200, 304])
+        self.check_downloaded(self.data)
+
+
+class FakeTerminal(object):
+
+    def __init__(self, tty=True):
+        self.tty = tty
+        self.writes = []
+
+    def isatty(self):
+        return self.tty
+
+    def write(self, text):
+        self.writes.append(text)
+
+    def flush(self):
+        pass
+
+
+class CheckProgressReporter(unittest.TestCase):
+
+    def test_redraws_are_limited(self):
+        terminal = FakeTerminal()
+        progress = blockfinder.ProgressReporter(stream=terminal, columns=60)
+        progress.expect(1000 * 1024)
+        for _ in range(1000):
+            progress.advance(1024)
+        progress.finish()
+        self.assertEqual(len(terminal.writes), 3)
+        self.assertEqual(terminal.writes[-1], '\n')
+        line = terminal.writes[-2]
+        self.assertTrue(line.startswith('[' + '=' * 40))
+        self.assertEqual(len(line.split('\x1b')[0]), 60)
+
+    def test_counter_without_total(self):
+        terminal = FakeTerminal()
+        progress = blockfinder.ProgressReporter('rows', stream=terminal)
+        progress.advance(10000)
+        progress.advance(5000)
+        progress.finish()
+        self.assertTrue(terminal.writes[-2].startswith('15000 rows, '))
+
+    def test_disabled_without_terminal(self):
+        terminal = FakeTerminal(tty=False)
+        progress = blockfinder.ProgressReporter(stream=terminal)
+        progress.expect(10)
+        progress.advance(10)
+        progress.finish()
+        self.assertEqual(terminal.writes, [])
+        self.assertEqual(progress.done, 10)
+
+    def test_progress_of_imports(self):
+        reported = []
+
+        class Reporter(blockfinder.ProgressReporter):
+            def finish(self):
+                reported.append(self.done)
+
+        downloader_parser = blockfinder.DownloaderParser('unused/', None,
+                                                         None)
+        downloader_parser.progress_rows = 3
+        original_reporter = blockfinder.ProgressReporter
+        blockfinder.ProgressReporter = Reporter
+        try:
+            rows = list(downloader_parser._report_progress(iter(range(10))))
+        finally:
+            blockfinder.ProgressReporter = original_reporter
+        self.assertEqual(rows, list(range(10)))
+        self.assertEqual(reported, [10])
+
+
+class CheckVerifiedDownloads(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        with open('test_rir_data', 'rb') as rir_file:
+            self.data = rir_file.read()
+        name = 'delegated-test-latest'
+        self.server = ThrottledHTTPServer({
+            '/stats/' + name: self.data,
+            '/stats/%s.md5' % name: ('MD5 (%s) = %s\n' % (
+                name, hashlib.md5(self.data).hexdigest())).encode('ascii'),
+        }, pieces=1, delay=0)
+        self.downloader_parser.RIR_URLS = self.server.url('/stats/' + name)
+        self.rir_path = self.test_dir + name
+        with open(self.rir_path, 'wb') as rir_file:
+            rir_file.write(b'previous file')
+
+    def tearDown(self):
+        self.server.stop()
+        BaseBlockfinderTest.tearDown(self)
+
+    def check_rir_file(self, data):
+        with open(self.rir_path, 'rb') as rir_file:
+            self.assertEqual(rir_file.read(), data)
+        self.assertFalse(os.path.exists(self.rir_path + '.part'))
+
+    def test_matching_checksum(self):
+        self.assertEqual(len(self.downloader_parser.download_rir_files()), 2)
+        self.check_rir_file(self.data)
+        self.assertEqual(self.downloader_parser.download_metadata.get(
+            self.rir_path)['checksum'],
+            'md5:' + hashlib.md5(self.data).hexdigest())
+        self.assertTrue(self.downloader_parser.verify_rir_files())
+
+    def test_mismatching_checksum(self):
+        self.server.files['/stats/delegated-test-latest'] = \
+            self.data + b'corrupt'
+        self.assertEqual(self.downloader_parser.download_rir_files(),
+                         [self.downloader_parser.RIR_URLS + '.md5'])
+        self.check_rir_file(b'previous file')
+        self.assertEqual([request for request in self.server.requests
+                          if request[0] == '/stats/delegated-test-latest'],
+                         [('/stats/delegated-test-latest', 200)] *
+                         self.downloader_parser.download_attempts)
+        self.assertFalse(self.downloader_parser.verify_rir_files())
+
+    def test_sha256_checksum(self):
+        self.downloader_parser.rir_checksum_suffixes = ('.sha256', '.md5')
+        self.server.files['/stats/delegated-test-latest.sha256'] = (
+            '%s  delegated-test-latest\n' %
+            hashlib.sha256(self.data).hexdigest()).encode('ascii')
+        self.server.files['/stats/delegated-test-latest.md5'] = b'garbage'
+        self.downloader_parser.download_rir_files()
+        self.check_rir_file(self.data)
+        self.assertEqual(self.downloader_parser.download_metadata.get(
+            self.rir_path)['checksum'],
+            'sha256:' + hashlib.sha256(self.data).hexdigest())
+
+    def test_verify_local_files(self):
+        with open(self.rir_path + '.md5', 'w') as md5_file:
+            md5_file.write(hashlib.md5(b'previous file').hexdigest())
+        self.assertTrue(self.downloader_parser.verify_rir_files())
+        with open(self.rir_path, 'ab') as rir_file:
+            rir_file.write(b'changed')
+        self.assertFalse(self.downloader_parser.verify_rir_files())
+
+    def test_parse_checksum(self):
+        md5 = hashlib.md5(b'').hexdigest()
+        sha256 = hashlib.sha256(b'').hexdigest()
+        for text, checksum in (
+                ('MD5 (delegated-arin-extended-latest) = %s\n' % md5,
+                 ('md5', md5)),
+                ('%s  delegated-apnic-latest\n' % md5.upper(),
+                 ('md5', md5)),
+                ('SHA256 (delegated-ripencc-latest) = %s' % sha256,
+                 ('sha256', sha256)),
+                ('', None),
+                ('%s\n%s\n' % (md5, sha256), None),
+                ('%s %s' % (md5, md5), ('md5', md5))):
+            self.assertEqual(blockfinder.parse_checksum(text), checksum)
+
+
+class CheckCountryComparison(BaseBlockfinderTest):
+
+    def fetch_with_self_join(self, first_country_code):
+        """ Compare assignments like fetch_country_blocks_in_other_sources
+            did before it swept over sorted assignments. """
+        db = self.database_cache
+        sql = ('SELECT first.source_type, first.start_num, '
+               'first.next_start_num, second.source_type, '
+               'second.start_num, second.next_start_num, '
+               'second.country_code, first.num_type '
+               'FROM assignments AS first '
+               'JOIN assignments AS second '
+               'WHERE first.country_code = ? '
+               'AND first.start_num <= second.next_start_num '
+               'AND first.next_start_num >= second.start_num '
+               'AND first.num_type = second.num_type '
+               'ORDER BY first.source_type, first.start_num, '
+               'second.source_type, second.start_num')
+        return [(str(row[0]), db._from_key(row[1]),
+                 db._from_key(row[2]) - 1, str(row[3]),
+                 db._from_key(row[4]), db._from_key(row[5]) - 1,
+                 str(row[6]), str(row[7]))
+                for row in db.conn.execute(sql, (first_country_code, ))]
+
+    def test_same_rows_as_self_join(self):
+        de = int(ipaddr.IPv4Address('213.95.6.0'))
+        self.database_cache.replace_assignments([
+            (de - 256, de - 1, 'ipv4', 'NL', 'test'),
+            (de, de + 15, 'ipv4', 'DE', 'test'),
+            (de + 16, de + 4095, 'ipv4', 'AT', 'test'),
+            (de - 2 ** 16, de + 2 ** 16, 'ipv4', 'DE', 'test'),
+            (680, 700, 'asn', 'DE', 'test')], 'maxmind')
+        country_codes = [row[0] for row in self.database_cache.conn.execute(
+            'SELECT DISTINCT country_code FROM assignments')]
+        self.assertTrue(len(country_codes) > 5)
+        for country_code in country_codes:
+            self.assertEqual(
+                list(self.database_cache.fetch_country_blocks_in_other_sources(
+                    country_code)),
+                self.fetch_with_self_join(country_code))
+
+    def test_results_are_streamed(self):
+        results = self.database_cache.fetch_country_blocks_in_other_sources(
+            'DE')
+        self.assertFalse(isinstance(results, list))
+        self.assertEqual(next(results)[0], 'lir')
+
+
+class CheckCountryCidrs(BaseBlockfinderTest):
+
+    def summarize_per_source(self, num_type, country_code):
+        """ Summarize assignments like fetch_rir_blocks_by_country did
+            before country CIDR blocks were stored, but collapsing the
+            blocks of each source type. """
+        blocks = set()
+        for source_type in ('rir', 'lir'):
+            networks = []
+            for start_num, end_num, ranges_country_code, _ in \
+                    self.database_cache.fetch_ranges(num_type, source_type):
+                if ranges_country_code == country_code:
+                    networks.extend(ipaddr.summarize_address_range(
+                        ipaddr.ip_address(start_num),
+                        ipaddr.ip_address(end_num)))
+            blocks.update(str(network) for network in
+                          ipaddr.collapse_addresses(networks))
+        return blocks
+
+    def test_same_addresses_as_summarized_assignments(self):
+        country_codes = [row[0] for row in self.database_cache.conn.execute(
+            "SELECT DISTINCT country_code FROM assignments WHERE "
+            "num_type != 'asn'")]
+        self.assertTrue(len(country_codes) > 5)
+        for country_code in country_codes:
+            for num_type in ('ipv4', 'ipv6'):
+                blocks = self.lookup.fetch_rir_blocks_by_country(
+                    num_type, country_code)
+                self.assertEqual(len(blocks), len(set(blocks)))
+                self.assertEqual(
+                    set(blocks),
+                    self.summarize_per_source(num_type, country_code))
+                starts = [ipaddr.ip_network(block).network_address
+                          for block in blocks]
+                self.assertEqual(starts, sorted(starts))
+
+    def test_asn_blocks(self):
+        self.assertEqual(
+            self.lookup.fetch_rir_blocks_by_country('asn', 'NZ'),
+            [str(start_num) for start_num, _ in
+             self.database_cache.fetch_assignments('asn', 'NZ')])
+        self.assertEqual(
+            self.lookup.fetch_rir_blocks_by_country('mm', 'NZ'), [])
+
+    def test_adjacent_assignments_are_merged(self):
+        net = int(ipaddr.IPv4Address('192.0.2.0'))
+        self.database_cache.replace_assignments([
+            (net, net + 255, 'ipv4', 'ZZ', 'test'),
+            (net + 256, net + 511, 'ipv4', 'ZZ', 'test'),
+            (net + 300, net + 400, 'ipv4', 'ZZ', 'test'),
+            (net + 1025, net + 1030, 'ipv4', 'ZZ', 'test'),
+            (0, 2 ** 120 - 1, 'ipv6', 'ZZ', 'test')], 'maxmind')
+        self.assertEqual(
+            self.database_cache.fetch_country_cidrs('ipv4', 'ZZ'),
+            ['192.0.2.0/23', '192.0.6.1/32', '192.0.6.2/31',
+             '192.0.6.4/31', '192.0.6.6/32'])
+        self.assertEqual(
+            self.database_cache.fetch_country_cidrs('ipv6', 'ZZ'),
+            ['::/8'])
+
+    def test_regenerated_with_assignments(self):
+        de = self.database_cache.fetch_country_cidrs('ipv4', 'DE')
+        self.assertEqual(de, ['213.95.6.32/28'])
+        self.database_cache.delete_assignments('lir')
+        self.assertEqual(self.database_cache.fetch_country_cidrs('ipv4', 'DE'),
+                         [])
+        self.downloader_parser.parse_lir_files(['test_lir_data.gz'])
+        self.assertEqual(self.database_cache.fetch_country_cidrs('ipv4', 'DE'),
+                         de)
+        self.database_cache.replace_assignments(
+            [(0, 255, 'ipv4', 'DE', 'ripencc')], 'lir')
+        self.assertEqual(self.database_cache.fetch_country_cidrs('ipv4', 'DE'),
+                         ['0.0.0.0/24'])
+
+
+class CheckResultCache(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.results_path = os.path.join(self.test_dir,
+                                         blockfinder.ResultCache.dir_name)
+        self.result_cache = blockfinder.ResultCache(self.database_cache,
+                                                    self.results_path)
+        self.calls = []
+
+    def compute(self, *params):
+        self.calls.append(params)
+        for i in range(params[0]):
+            yield 'line %d\nof %r' % (i, params)
+
+    def capture(self, callback, *args):
+        output = []
+
+        class Output(object):
+            def write(self, text):
+                output.append(text)
+
+        stdout, sys.stdout = sys.stdout, Output()
+        try:
+            callback(*args)
+        finally:
+            sys.stdout = stdout
+        return ''.join(output)
+
+    def test_results_are_stored(self):
+        first = list(self.result_cache.fetch('test', (3, 'a'), self.compute))
+        self.assertEqual(first[2], "line 2\nof (3, 'a')")
+        self.assertEqual(
+            list(self.result_cache.fetch('test', (3, 'a'), self.compute)),
+            first)
+        self.assertEqual(self.calls, [(3, 'a')])
+        self.assertEqual(len(os.listdir(self.results_path)), 1)
+        list(self.result_cache.fetch('test', (3, 'b'), self.compute))
+        list(self.result_cache.fetch('other', (3, 'a'), self.compute))
+        self.assertEqual(len(self.calls), 3)
+
+    def test_results_are_invalidated_by_imports(self):
+        self.assertEqual(self.lookup.fetch_rir_blocks_by_country('ipv4', 'DE'),
+                         ['213.95.6.32/28'])
+        self.database_cache.replace_assignments(
+            [(0, 255, 'ipv4', 'DE', 'ripencc')], 'lir')
+        self.assertEqual(self.lookup.fetch_rir_blocks_by_country('ipv4', 'DE'),
+                         ['0.0.0.0/24'])
+        list(self.result_cache.fetch('test', (1, ), self.compute))
+        self.database_cache.replace_asn_descriptions([])
+        list(self.result_cache.fetch('test', (1, ), self.compute))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_incomplete_results_are_not_stored(self):
+        results = self.result_cache.fetch('test', (3, ), self.compute)
+        next(results)
+        results.close()
+
+        def failing(count):
+            yield 'line'
+            raise IOError('disk full')
+        self.assertRaises(IOError, list,
+                          self.result_cache.fetch('test', (3, ), failing))
+        self.assertEqual(os.listdir(self.results_path), [])
+        self.assertEqual(
+            len(list(self.result_cache.fetch('test', (3, ), self.compute))),
+            3)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_unreplaceable_results_are_not_stored(self):
+        os.makedirs(self.result_cache._file_path('test', (3, )))
+        self.assertEqual(
+            len(list(self.result_cache.fetch('test', (3, ), self.compute))),
+            3)
+        self.assertEqual(
+            len(list(self.result_cache.fetch('test', (3, ), self.compute))),
+            3)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len(os.listdir(self.results_path)), 1)
+
+    def test_least_recently_used_results_are_evicted(self):
+        for count in range(1, 5):
+            list(self.result_cache.fetch('test', (count, ), self.compute))
+            file_path = self.result_cache._file_path('test', (count, ))
+            os.utime(file_path, (1000 + count, 1000 + count))
+        list(self.result_cache.fetch('test', (1, ), self.compute))
+        sizes = dict((count, os.path.getsize(
+            self.result_cache._file_path('test', (count, ))))
+            for count in range(1, 5))
+        self.result_cache.max_bytes = sizes[1] + sizes[4] + sizes[3]
+        self.result_cache.evict()
+        self.assertEqual(sorted(os.listdir(self.results_path)), sorted(
+            os.path.basename(self.result_cache._file_path('test', (count, )))
+            for count in (1, 3, 4)))
+
+    def test_disabled(self):
+        self.result_cache.max_bytes = 0
+        list(self.result_cache.fetch('test', (1, ), self.compute))
+        list(self.result_cache.fetch('test', (1, ), self.compute))
+        self.assertEqual(len(self.calls), 2)
+        self.assertFalse(os.path.exists(self.results_path))
+
+    def test_lookup_output_is_cached(self):
+        compare = self.capture(
+            self.lookup.lookup_countries_in_different_source, 'DE')
+        self.assertTrue("Assignments in 'lir':" in compare)
+        org = self.capture(self.lookup.lookup_org_by_range, '10.0.0.0',
+                           '10.0.0.255')
+        self.assertEqual(org, 'Did not find any matching announcements in '
+                              'range 10.0.0.0 10.0.0.255.\n')
+        self.database_cache.fetch_country_blocks_in_other_sources = None
+        self.database_cache.fetch_org_by_ip_range = None
+        self.assertEqual(self.capture(
+            self.lookup.lookup_countries_in_different_source, 'DE'), compare)
+        self.assertEqual(self.capture(self.lookup.lookup_org_by_range,
+                                      '10.0.0.0', '10.0.0.255'), org)
+
+    def test_erased_with_database(self):
+        list(self.result_cache.fetch('test', (1, ), self.compute))
+        self.database_cache.commit_and_close_database()
+        self.database_cache.erase_database()
+        self.assertFalse(os.path.exists(self.results_path))
+
+
+class CheckConnectionPool(BaseBlockfinderTest):
+
+    def setUp(self):
+        BaseBlockfinderTest.setUp(self)
+        self.pool = blockfinder.DatabaseCache(self.test_dir, pooled=True)
+        self.pool.connect_to_database()
+
+    def tearDown(self):
+        self.pool.commit_and_close_database()
+        BaseBlockfinderTest.tearDown(self)
+
+    def test_concurrent_lookups_from_32_threads(self):
+        pool = self.pool
+        pl = int(ipaddr.IPv4Address('193.9.25.1'))
+        it = int(ipaddr.IPv4Address('80.16.151.184'))
+        kp = pool.fetch_assignments('ipv4', 'KP')
+        rir_ranges = list(pool.fetch_ranges('ipv4', 'rir'))
+        downloader_parser = blockfinder.DownloaderParser(
+            self.test_dir, pool, "Mozilla")
+        errors = []
+        start = threading.Event()
+
+        def read(thread_num):
+            start.wait()
+            try:
+                for i in range(20):
+                    ranges = pool.fetch_ranges('ipv4', 'rir')
+                    first = next(ranges)
+                    answers = (pool.fetch_country_code('ipv4', 'rir', pl),
+                               pool.fetch_country_code('ipv4', 'lir', it),
+                               pool.fetch_assignments('ipv4', 'KP'))
+                    if answers != ('PL', 'IT', kp):
+                        errors.append(repr(answers))
+                    if [first] + list(ranges) != rir_ranges:
+                        errors.append('ranges changed in thread %d'
+                                      % thread_num)
+                    if thread_num % 8 == 0:
+                        pool.insert_asn_description(
+                            thread_num * 100 + i, 'test', 'AS%d' % i)
+                        pool.commit_changes()
+            except Exception as e:
+                errors.append(repr(e))
+
+        def write():
+            start.wait()
+            try:
+                for i in range(3):
+                    downloader_parser.parse_rir_files(['test_rir_data'])
+            except Exception as e:
+                errors.append(repr(e))
+
+        threads = [threading.Thread(target=read, args=(i, ))
+                   for i in range(32)]
+        threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(pool.get_generation('rir'), 5)
+        self.assertEqual(pool.conn.execute(
+            'SELECT COUNT(*) FROM asn_descriptions').fetchone()[0], 80)
+        self.assertEqual(len(pool._pool_connections), 33)
+
+    def test_threads_use_own_connections(self):
+        connections = []
+
+        def connect():
+            connections.append(self.pool.conn)
+            self.pool.fetch_country_code('asn', 'rir', 681)
+            self.pool.close_thread_connection()
+
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join()
+        self.assertNotEqual(connections[0], self.pool.conn)
+        self.assertEqual(self.pool._pool_connections, [self.pool.conn])
+        self.assertEqual(self.pool.fetch_country_code('asn', 'rir', 681),
+                         'NZ')
+
+
 class NormalizationTest(unittest.TestCase):
 
     def test_comment_stripping(self):
@@ -138,8 +2421,20 @@ class NormalizationTest(unittest.TestCase):
 
 if __name__ == '__main__':
     failures = 0
-    for test_class in [CheckReverseLookup,
-                       CheckBlockFinder, NormalizationTest]:
+    for test_class in [CheckReverseLookup, CheckBlockFinder,
+                       CheckQueryPlans, CheckNumberEncoding,
+                       CheckMigrations, CheckBulkLoad,
+                       CheckAtomicReload, CheckConcurrentAccess,
+                       CheckMemoryLookupEngine, CheckCompiledDatabase,
+                       CheckMMDBExport, CheckPrefixTrie,
+                       CheckRIRParser, CheckParallelImport, CheckLIRParser,
+                       CheckIncrementalImport, CheckDecompression,
+                       CheckResumableImport, CheckConcurrentDownloads,
+                       CheckConditionalDownloads, CheckResumedDownloads,
+                       CheckProgressReporter, CheckVerifiedDownloads,
+                       CheckCountryComparison, CheckCountryCidrs,
+                       CheckResultCache, CheckConnectionPool,
+                       NormalizationTest]:
         test_suite = unittest.makeSuite(test_class)
         test_runner = unittest.TextTestRunner(verbosity=2)
         results = test_runner.run(test_suite)